@@ -0,0 +1,274 @@
+# External imports
+import math
+import re
+import sys
+from collections import defaultdict
+from smtplib import SMTP_PORT
+from typing import Dict, List, Optional, Set, Tuple
+import trio
+
+# Local imports
+from deadlines import DOMAIN, JOB, Deadlines
+from dns_resolver import AsyncResolver
+from exceptions import CheckTimeoutError, EmailValidationError
+from logging_mod import logging
+from metrics import METRICS_HOST
+from main import check_person, discover_domain, run_retry
+from patterns import PatternRanker
+from person import Person
+from pipeline import NAME_PATTERN
+from proxy_pool import LEAST_LOADED
+from retry import RetryPolicy
+from run_context import RunContext, open_run
+
+logger = logging.getLogger(__name__)
+
+BATCH_LINE_RE = re.compile(
+    rf"({NAME_PATTERN}),({NAME_PATTERN}),([A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+)\s*$"
+)
+
+
+def read_batch(input_file: str) -> Dict[str, List[Person]]:
+    """
+    Read a batch input file with "first,last,domain" lines, grouping the
+    Persons by domain.
+
+    :param input_file: Path of the input file
+
+    :returns: Dict[str, List[Person]] of the Persons to check per domain name.
+    """
+    groups = defaultdict(list)
+    with open(input_file, "r", encoding="utf-8") as file:
+        for count, line in enumerate(file, start=1):
+            match = BATCH_LINE_RE.match(line)
+            if not match:
+                # Log wrong entries, deducting new lines
+                logger.error(
+                    "Line: %d | Entry format is not aligned '%s', should be 'first,last,domain' "
+                    "AND len(first/last) >= 2.",
+                    count,
+                    line.rstrip(),
+                )
+                continue
+            first, last, domain = match.groups()
+            groups[sys.intern(domain.lower())].append(Person(first, last))
+    return dict(groups)
+
+
+async def _check_person(
+    run: RunContext,
+    person: Person,
+    candidates: Dict[str, Tuple[str, ...]],
+    ranker: Optional[PatternRanker],
+    mx_records: List[str],
+    final_results: Set[str],
+    budget: trio.Semaphore,
+    deadline: float,
+):
+    "Check one Person, releasing its slot of the global budget when done."
+    try:
+        person_result = await check_person(
+            person=person,
+            addresses=list(candidates),
+            mx_records=mx_records,
+            pool=run.pool,
+            final_results=final_results,
+            result_store=run.result_store,
+            retry_queue=run.retry_queue,
+            ranker=ranker,
+            candidates=candidates,
+            result_sink=run.result_sink,
+            deadlines=run.deadlines,
+            deadline=deadline,
+        )
+        if person_result.error is not None:
+            run.failures.append(person_result)
+    finally:
+        budget.release()
+
+
+async def _run_domain(
+    run: RunContext,
+    domain_str: str,
+    persons: List[Person],
+    final_results: Set[str],
+    budget: trio.Semaphore,
+    nursery: trio.Nursery,
+    smtp_timeout: float,
+    job_deadline: float = math.inf,
+):
+    """
+    Discover the domain once, then schedule the checks of its Persons,
+    each waiting for a slot of the global budget.
+
+    The discovery and checks are bounded by the `domain` budget of the
+    run's deadlines, and the `job_deadline`.
+    """
+    deadline = run.deadlines.deadline(DOMAIN, job_deadline)
+    try:
+        async with budget:
+            with trio.move_on_at(deadline) as discovery_scope:
+                mx_records = await discover_domain(
+                    domain_str=domain_str,
+                    dns_resolver=run.dns_resolver,
+                    pool=run.pool,
+                    smtp_timeout=smtp_timeout,
+                    mock_sender_email=run.pool.sender,
+                    domain_cache=run.domain_cache,
+                    retry_policy=run.retry_policy,
+                )
+        if discovery_scope.cancelled_caught:
+            raise CheckTimeoutError()
+    except EmailValidationError as exc:
+        logger.error("Skipping %d entries of domain %s: %s", len(persons), domain_str, exc)
+        return
+
+    engine = run.domain_patterns.get(domain_str)
+    # Learns the naming convention of the domain to cut the probes
+    ranker = run.ranker(domain_str)
+
+    for person in persons:
+        await budget.acquire()
+        nursery.start_soon(
+            _check_person,
+            run,
+            person,
+            engine.templated(person, domain_str),
+            ranker,
+            mx_records,
+            final_results,
+            budget,
+            deadline,
+        )
+
+
+async def main_batch(
+    input_file: str,
+    smtp_timeout: float = float(20),
+    smtp_port: int = SMTP_PORT,
+    mock_sender_email: str = "jim@gmail.com",
+    proxy_type: str = None,
+    proxy_addr: str = None,
+    proxy_port: str = None,
+    proxy_username: str = None,
+    proxy_password: str = None,
+    proxies_file: Optional[str] = None,
+    proxy_strategy: str = LEAST_LOADED,
+    proxy_max_connections: Optional[int] = None,
+    smtp_max_connections: int = 5,
+    max_concurrency: int = 100,
+    coalesce_window: Optional[float] = 0.05,
+    hedge_delay: Optional[float] = 0.3,
+    adaptive_rate: bool = True,
+    retry_temporary: bool = True,
+    dns_resolver: Optional[AsyncResolver] = None,
+    dns_nameservers: Optional[List[str]] = None,
+    dns_timeout: float = 5,
+    retry_policy: Optional[RetryPolicy] = None,
+    domain_cache_path: Optional[str] = None,
+    result_store_path: Optional[str] = None,
+    patterns_file: Optional[str] = None,
+    learn_patterns: bool = True,
+    output_file: Optional[str] = None,
+    output_format: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    metrics_log_interval: Optional[float] = None,
+    metrics_host: str = METRICS_HOST,
+    deadlines: Optional[Deadlines] = None,
+    report: bool = True,
+) -> Dict[str, Set[str]]:
+    """
+    Check a batch of "first,last,domain" entries spanning many domains.
+
+    Each domain goes through MX discovery and the Catch-All probe once,
+    then its Persons are checked. All domains run side by side, with at
+    most `max_concurrency` discoveries and checks in flight overall, so
+    throughput grows with the number of distinct MX clusters.
+
+    With a `proxies_file` (a `socks5://[user:password@]host:port` URL per
+    line), the MX servers are spread over the proxies, so throughput
+    also grows with the number of egress IPs. `proxy_max_connections`
+    bounds the sessions working through each proxy at a time.
+
+    :param smtp_port: The port of the MX servers, 25 unless testing
+    :param coalesce_window: Seconds the RCPTs of different Persons wait to share a
+                            transaction, None to disable it (see `RcptBatcher`)
+    :param hedge_delay: Seconds before racing the next MX while connecting to an unknown
+                        one, None to try them one by one (see `SMTPPool.order_hosts`)
+    :param dns_nameservers: The nameservers to query, unless a `dns_resolver` is given
+    :param dns_timeout: Seconds to wait for a DNS answer, unless a `dns_resolver` is given
+    :param retry_policy: When to retry temporary outcomes, see `RetryPolicy`
+    :param patterns_file: JSON file of the email patterns per domain, see `DomainPatterns`
+    :param learn_patterns: Learn the email patterns of each domain to probe fewer
+                           addresses, see `PatternRanker`
+    :param output_file: File to stream the verdict of every address to, "-" for stdout
+    :param output_format: `JSONL` or `CSV`, by default after the extension of `output_file`
+    :param metrics_port: Serve the metrics in the Prometheus text format on this port
+    :param metrics_log_interval: Log a summary of the metrics every this many seconds
+    :param metrics_host: The interface to serve the metrics on, "" for all of them
+    :param deadlines: Time limits of the SMTP stages, and budgets of each Person, domain
+                      and the whole job, see `Deadlines`
+    :param report: Print the found email addresses and failures at the end
+
+    :returns: Dict[str, Set[str]] of the found email addresses per domain name.
+    """
+    deadlines = deadlines or Deadlines()
+    job_deadline = deadlines.deadline(JOB)
+    groups = read_batch(input_file)
+    logger.debug("Read %d entries of %d domains.", sum(map(len, groups.values())), len(groups))
+    final_results = {domain_str: set() for domain_str in groups}
+    budget = trio.Semaphore(max_concurrency)
+
+    async with open_run(
+        deadlines=deadlines,
+        deadline=job_deadline,
+        smtp_timeout=smtp_timeout,
+        smtp_port=smtp_port,
+        mock_sender_email=mock_sender_email,
+        proxy_type=proxy_type,
+        proxy_addr=proxy_addr,
+        proxy_port=proxy_port,
+        proxy_username=proxy_username,
+        proxy_password=proxy_password,
+        proxies_file=proxies_file,
+        proxy_strategy=proxy_strategy,
+        proxy_max_connections=proxy_max_connections,
+        smtp_max_connections=smtp_max_connections,
+        max_concurrency=max_concurrency,
+        coalesce_window=coalesce_window,
+        hedge_delay=hedge_delay,
+        adaptive_rate=adaptive_rate,
+        retry_temporary=retry_temporary,
+        dns_resolver=dns_resolver,
+        dns_nameservers=dns_nameservers,
+        dns_timeout=dns_timeout,
+        retry_policy=retry_policy,
+        domain_cache_path=domain_cache_path,
+        result_store_path=result_store_path,
+        patterns_file=patterns_file,
+        learn_patterns=learn_patterns,
+        output_file=output_file,
+        output_format=output_format,
+        metrics_port=metrics_port,
+        metrics_log_interval=metrics_log_interval,
+        metrics_host=metrics_host,
+    ) as run:
+        # Temporary outcomes are retried later, while the other checks go on
+        async with run.retrying(run_retry):
+            async with trio.open_nursery() as domains_nursery:
+                for domain_str, persons in groups.items():
+                    domains_nursery.start_soon(
+                        _run_domain,
+                        run,
+                        domain_str,
+                        persons,
+                        final_results[domain_str],
+                        budget,
+                        domains_nursery,
+                        smtp_timeout,
+                        job_deadline,
+                    )
+
+    if report:
+        run.report(final_results)
+    return final_results
@@ -0,0 +1,401 @@
+# External imports
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+import trio
+
+# Local imports
+import fake_servers
+from batch import main_batch, read_batch
+from logging_mod import configure_logging, logging
+from main import main
+from metrics import SMTP_REPLIES
+from patterns import DEFAULT_ENGINE
+from person import Person
+from results import AddressResult, DELIVERABLE, UNDELIVERABLE
+from single_flight import SingleFlight
+from smtp_check import smtp_check
+from smtp_pool import SMTPPool
+
+logger = logging.getLogger(__name__)
+
+# Benchmark modes
+SMTP_CHECK = "smtp_check"  # `smtp_check` per Person, over a shared pool
+MAIN = "main"  # `main.main` on a names file of the first domain
+BATCH = "batch"  # `batch.main_batch` on all the domains
+MEMORY = "memory"  # `measure_footprint`, offline
+
+_SYLLABLES = "ba ce di fo gu ha ke li mo nu pa re si to vu za".split()
+
+
+def _word(index: int) -> str:
+    "A distinct pronounceable name per index."
+    index += len(_SYLLABLES)
+    syllables = []
+    while index:
+        index, digit = divmod(index, len(_SYLLABLES))
+        syllables.append(_SYLLABLES[digit])
+    return "".join(reversed(syllables))
+
+
+def synthetic_persons(count: int, domains: List[str]) -> List[Tuple[Person, str]]:
+    "`count` distinct Persons, dealt round-robin over `domains`."
+    return [
+        (Person(_word(index), _word(index * 7 + 3)), domains[index % len(domains)])
+        for index in range(count)
+    ]
+
+
+def deliverable_addresses(persons: List[Tuple[Person, str]], ratio: float) -> List[str]:
+    "The first.last address of `ratio` of the Persons, spread evenly."
+    step = 1 / ratio if ratio else None
+    return [
+        f"{person.first}.{person.last}@{domain}"
+        for index, (person, domain) in enumerate(persons)
+        if step and int(index % step) == 0
+    ]
+
+
+def _serve(domains: List[str], ports, dns_port: int, smtp_port: int, smtp_kwargs: dict):
+    """
+    Run the fake servers, in their own process so they don't skew the
+    measures, and put their (DNS port, SMTP port) in the `ports` queue.
+    """
+    configure_logging(level=logging.WARNING, background=False)
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            ports.put(
+                await nursery.start(
+                    partial(fake_servers.serve, domains, dns_port, smtp_port, **smtp_kwargs)
+                )
+            )
+
+    trio.run(run)
+
+
+async def _run_smtp_check(
+    persons: List[Tuple[Person, str]],
+    domains: List[str],
+    smtp_port: int,
+    concurrency: int,
+    max_connections: int,
+    coalesce_window: Optional[float],
+) -> List[float]:
+    "Check every Person with `smtp_check`, `concurrency` at a time."
+    mx_records = {domain: [fake_servers.mx_ip(index)] for index, domain in enumerate(domains)}
+    latencies = []
+    final_results = set()
+    send_channel, receive_channel = trio.open_memory_channel(concurrency)
+
+    async with SMTPPool(
+        sender="bench@example.com",
+        port=smtp_port,
+        max_connections=max_connections,
+        coalesce_window=coalesce_window,
+    ) as pool:
+
+        async def worker():
+            async for person, domain in receive_channel:
+                address_results = {}
+                try:
+                    await smtp_check(
+                        email_addresses=DEFAULT_ENGINE.addresses(person, domain),
+                        mx_records=mx_records[domain],
+                        from_address=pool.sender,
+                        final_results=final_results,
+                        entity=person,
+                        pool=pool,
+                        address_results=address_results,
+                    )
+                except Exception as exc:
+                    logger.debug("Entity - %s; %s: %s", person, type(exc).__name__, exc)
+                latencies.extend(
+                    result.latency
+                    for result in address_results.values()
+                    if result.latency is not None
+                )
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(concurrency):
+                nursery.start_soon(worker)
+            async with send_channel:
+                for item in persons:
+                    await send_channel.send(item)
+    return latencies
+
+
+async def _run_entry_point(
+    mode: str,
+    persons: List[Tuple[Person, str]],
+    domains: List[str],
+    dns_port: int,
+    smtp_port: int,
+    concurrency: int,
+    max_connections: int,
+    coalesce_window: Optional[float],
+) -> List[float]:
+    "Check every Person with `main` or `main_batch`, reading the latencies from their output."
+    resolver = fake_servers.FakeDNSServer(port=dns_port).resolver()
+    options = dict(
+        dns_resolver=resolver,
+        smtp_port=smtp_port,
+        smtp_max_connections=max_connections,
+        max_concurrency=concurrency,
+        coalesce_window=coalesce_window,
+        retry_temporary=False,
+        report=False,
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "input.csv")
+        output_file = os.path.join(directory, "output.jsonl")
+        with open(input_file, "w", encoding="utf-8") as file:
+            for person, domain in persons:
+                if mode == BATCH:
+                    file.write(f"{person.first},{person.last},{domain}\n")
+                elif domain == domains[0]:
+                    file.write(f"{person.first},{person.last}\n")
+        if mode == BATCH:
+            await main_batch(input_file, output_file=output_file, **options)
+        else:
+            await main(domains[0], input_file, output_file=output_file, **options)
+        with open(output_file, "r", encoding="utf-8") as file:
+            records = [json.loads(line) for line in file]
+    return [record["latency"] for record in records if record["latency"] is not None]
+
+
+def _replies(command: str) -> int:
+    "The number of replies to `command` received, whatever the MX."
+    return int(
+        sum(count for key, count in SMTP_REPLIES.values.items() if key[0] == command)
+    )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure_footprint(
+    persons: int = 100000, domains: int = 100, deliverable_ratio: float = 0.05
+) -> Dict[str, float]:
+    """
+    Measure the memory a batch job holds per name, offline: its Persons
+    as read by `read_batch`, and the settled results of all their
+    candidate addresses as kept for the run by `SingleFlight` (in a
+    `ResultTable`), against the same results in a plain dict of
+    `AddressResult`s.
+
+    :returns: Dict[str, float] of the numbers of names and addresses,
+              and the bytes held per name, as traced by `tracemalloc`.
+    """
+    domain_names = [f"bench{index}.test" for index in range(domains)]
+    entries = synthetic_persons(persons, domain_names)
+    deliverable = set(deliverable_addresses(entries, deliverable_ratio))
+    mx_records = {domain: fake_servers.mx_ip(index) for index, domain in enumerate(domain_names)}
+
+    def probe_results(groups):
+        "The results of the checks of all the Persons, with a reply decoded per address."
+        for domain, group in groups.items():
+            for addresses in DEFAULT_ENGINE.expand(group, domain):
+                for address in addresses:
+                    ok = address in deliverable
+                    yield AddressResult(
+                        address=address,
+                        verdict=DELIVERABLE if ok else UNDELIVERABLE,
+                        mx=mx_records[domain],
+                        code=250 if ok else 550,
+                        text=(b"2.1.5 OK" if ok else b"5.1.1 No such user").decode(),
+                        checked_at=time.time(),
+                        latency=0.05,
+                    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "input.csv")
+        with open(input_file, "w", encoding="utf-8") as file:
+            for person, domain in entries:
+                file.write(f"{person.first},{person.last},{domain}\n")
+        tracemalloc.start()
+        try:
+            groups = read_batch(input_file)
+            persons_bytes = tracemalloc.get_traced_memory()[0]
+
+            probes = SingleFlight()
+            for result in probe_results(groups):
+                probes.claim(result.address)
+                probes.release(result.address, result)
+            table_bytes = tracemalloc.get_traced_memory()[0] - persons_bytes
+
+            plain = {result.address: result for result in probe_results(groups)}
+            dict_bytes = tracemalloc.get_traced_memory()[0] - persons_bytes - table_bytes
+        finally:
+            tracemalloc.stop()
+
+    return dict(
+        names=persons,
+        addresses=len(plain),
+        person_bytes_per_name=persons_bytes / persons,
+        result_table_bytes_per_name=table_bytes / persons,
+        result_dict_bytes_per_name=dict_bytes / persons,
+        total_bytes_per_name=(persons_bytes + table_bytes) / persons,
+    )
+
+
+def run_benchmark(
+    mode: str = SMTP_CHECK,
+    persons: int = 2000,
+    domains: int = 4,
+    deliverable_ratio: float = 0.5,
+    concurrency: int = 100,
+    smtp_max_connections: int = 5,
+    coalesce_window: Optional[float] = 0.05,
+    dns_port: int = 0,
+    smtp_port: int = 0,
+    trace_memory: bool = False,
+    **smtp_kwargs,
+) -> Dict[str, float]:
+    """
+    Check `persons` synthetic Persons spread over `domains` fake domains,
+    served by fake DNS and MX servers (see `fake_servers`) in a separate
+    process, and measure the checks.
+
+    :param dns_port: The port of the fake DNS server, 0 for a free one
+    :param smtp_port: The port of the fake MX servers, 0 for a free one
+    :param smtp_max_connections: The client's connections limit per MX
+    :param coalesce_window: See `RcptBatcher`, None to check each Person on its own
+    :param smtp_kwargs: Arguments of the `FakeSMTPServer`s, e.g. `latency`
+    :param trace_memory: Also measure the peak of Python allocations with
+                         `tracemalloc`, which slows the run down
+
+    :returns: Dict[str, float] of the measures: the addresses checked per
+              second, the p50/p99 latency of an address's check (in
+              seconds) and the peak memory (in MiB, and bytes per Person
+              when traced).
+    """
+    domain_names = [f"bench{index}.test" for index in range(domains)]
+    entries = synthetic_persons(persons, domain_names)
+    smtp_kwargs["deliverable"] = deliverable_addresses(entries, deliverable_ratio)
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    server = context.Process(
+        target=_serve, args=(domain_names, ports, dns_port, smtp_port, smtp_kwargs), daemon=True
+    )
+    server.start()
+    try:
+        try:
+            dns_port, smtp_port = ports.get(timeout=30)
+        except queue.Empty:
+            raise RuntimeError("The fake servers did not start (are their ports free?)")
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        if mode == SMTP_CHECK:
+            latencies = trio.run(
+                _run_smtp_check,
+                entries,
+                domain_names,
+                smtp_port,
+                concurrency,
+                smtp_max_connections,
+                coalesce_window,
+            )
+        else:
+            latencies = trio.run(
+                _run_entry_point,
+                mode,
+                entries,
+                domain_names,
+                dns_port,
+                smtp_port,
+                concurrency,
+                smtp_max_connections,
+                coalesce_window,
+            )
+        elapsed = time.perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        tracemalloc.stop()
+    finally:
+        server.terminate()
+        server.join()
+
+    measures = dict(
+        addresses=len(latencies),
+        seconds=elapsed,
+        addresses_per_second=len(latencies) / elapsed if elapsed else 0,
+        p50_latency=_percentile(latencies, 0.5),
+        p99_latency=_percentile(latencies, 0.99),
+        # Client side, from the metrics
+        connections=_replies("connect"),
+        transactions=_replies("mail"),
+        # In KiB on Linux
+        peak_rss_mib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+    if trace_memory:
+        measures["peak_traced_mib"] = traced_peak / 2**20
+        measures["peak_traced_bytes_per_name"] = traced_peak / persons
+    return measures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the checks against local fake DNS and MX servers."
+    )
+    parser.add_argument("--mode", choices=[SMTP_CHECK, MAIN, BATCH, MEMORY], default=SMTP_CHECK)
+    parser.add_argument("-n", "--persons", type=int, default=2000)
+    parser.add_argument("-d", "--domains", type=int, default=4)
+    parser.add_argument("--deliverable-ratio", type=float, default=0.5)
+    parser.add_argument("-c", "--concurrency", type=int, default=100)
+    parser.add_argument("--max-connections", type=int, default=5, help="Per MX, client side")
+    parser.add_argument("--coalesce-window", type=float, default=0.05, help="Negative: off")
+    parser.add_argument("--dns-port", type=int, default=0, help="Default: a free port")
+    parser.add_argument("--smtp-port", type=int, default=0, help="Default: a free port")
+    parser.add_argument("--latency", type=float, default=0.01, help="Server round trip")
+    parser.add_argument("--greylist-time", type=float, default=0)
+    parser.add_argument("--temporary-rate", type=float, default=0)
+    parser.add_argument("--permanent-rate", type=float, default=0)
+    parser.add_argument("--server-max-connections", type=int, default=None)
+    parser.add_argument("--no-pipelining", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true", help="Measure with tracemalloc")
+    parser.add_argument(
+        "--log-level",
+        type=str.upper,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        default="WARNING",
+    )
+    args = parser.parse_args()
+
+    configure_logging(level=args.log_level)
+    if args.mode == MEMORY:
+        measures = measure_footprint(args.persons, args.domains, args.deliverable_ratio)
+    else:
+        measures = run_benchmark(
+            mode=args.mode,
+            persons=args.persons,
+            domains=args.domains,
+            deliverable_ratio=args.deliverable_ratio,
+            concurrency=args.concurrency,
+            smtp_max_connections=args.max_connections,
+            coalesce_window=args.coalesce_window if args.coalesce_window >= 0 else None,
+            dns_port=args.dns_port,
+            smtp_port=args.smtp_port,
+            trace_memory=args.trace_memory,
+            latency=args.latency,
+            greylist_time=args.greylist_time,
+            temporary_rate=args.temporary_rate,
+            permanent_rate=args.permanent_rate,
+            max_connections=args.server_max_connections,
+            pipelining=not args.no_pipelining,
+        )
+    for name, value in measures.items():
+        print(f"{name:>22}: {value:.4g}" if isinstance(value, float) else f"{name:>22}: {value}")
@@ -0,0 +1,292 @@
+# External imports
+import argparse
+import os
+import pprint
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import trio
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Local imports
+from batch import main_batch
+from deadlines import Deadlines
+from exceptions import ConfigError, UnknownProxyError
+from logging_mod import configure_logging, logging, logging_level
+from main import main
+from proxy_pool import LEAST_LOADED, ROUND_ROBIN, Proxy
+from result_sink import CSV, JSONL
+from retry import RetryPolicy
+from shard import BATCH, NAMES, run_sharded
+
+logger = logging.getLogger(__name__)
+
+
+def _list(value) -> List[str]:
+    "A list of strings, from a config list or a comma-separated option."
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return [str(item) for item in value]
+
+
+def _bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+class Option:
+    """
+    A setting of a job, read from the config file (as `name`) and the
+    command line (as `--name`, with dashes), the latter prevailing.
+
+    :param kwarg: The argument of `main`/`main_batch` it maps to, if any
+    """
+
+    def __init__(
+        self,
+        name: str,
+        type: Callable[[Any], Any] = str,
+        help: str = "",
+        kwarg: Optional[str] = None,
+        choices: Optional[Sequence] = None,
+    ):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.kwarg = kwarg
+        self.choices = choices
+
+    def add_to(self, parser: argparse.ArgumentParser):
+        flag = "--" + self.name.replace("_", "-")
+        if self.type is _bool:
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, help=self.help)
+        else:
+            parser.add_argument(flag, type=self.type, choices=self.choices, help=self.help)
+
+    def convert(self, value):
+        "Validate a value of the config file."
+        try:
+            value = self.type(value)
+        except (TypeError, ValueError) as exc:
+            raise ConfigError(f"Invalid value {value!r} of {self.name!r}: {exc}")
+        if self.choices and value not in self.choices:
+            raise ConfigError(f"Invalid value {value!r} of {self.name!r}, not in {self.choices}")
+        return value
+
+
+OPTIONS = [
+    Option("input", help="'first,last' names file of --domain, or 'first,last,domain' file"),
+    Option("domain", help="The domain of the names file; omit for a batch file"),
+    Option("output", help="Stream the verdicts to this file, '-' for stdout", kwarg="output_file"),
+    Option("output_format", choices=[JSONL, CSV], kwarg="output_format"),
+    Option("sender", help="The MAIL FROM address", kwarg="mock_sender_email"),
+    Option("smtp_timeout", float, "Seconds per SMTP stage", kwarg="smtp_timeout"),
+    Option("smtp_port", int, "The port of the MX servers", kwarg="smtp_port"),
+    Option("dns_timeout", float, "Seconds per DNS query", kwarg="dns_timeout"),
+    Option("nameservers", _list, "Comma-separated nameservers", kwarg="dns_nameservers"),
+    Option("max_concurrency", int, "Persons checked at a time", kwarg="max_concurrency"),
+    Option(
+        "smtp_max_connections", int, "Connections per MX (and proxy)", "smtp_max_connections"
+    ),
+    Option(
+        "coalesce_window",
+        float,
+        "Seconds RCPTs wait to share a transaction with other Persons' (negative: off)",
+        kwarg="coalesce_window",
+    ),
+    Option(
+        "hedge_delay",
+        float,
+        "Seconds before racing the next MX when connecting (negative: off)",
+        kwarg="hedge_delay",
+    ),
+    Option("adaptive_rate", _bool, "Back off when MX servers throttle", kwarg="adaptive_rate"),
+    Option("proxy", help="A single proxy, as socks5://[user:password@]host:port"),
+    Option("proxies_file", help="File of proxy URLs, one per line", kwarg="proxies_file"),
+    Option("proxy_strategy", choices=[LEAST_LOADED, ROUND_ROBIN], kwarg="proxy_strategy"),
+    Option(
+        "proxy_max_connections",
+        int,
+        "Sessions at a time per proxy of the proxies file",
+        kwarg="proxy_max_connections",
+    ),
+    Option("domain_cache", help="SQLite cache of the domains' MX", kwarg="domain_cache_path"),
+    Option("result_store", help="SQLite store of the verdicts", kwarg="result_store_path"),
+    Option("patterns_file", help="JSON file of email patterns per domain", kwarg="patterns_file"),
+    Option("learn_patterns", _bool, "Learn the domains' email patterns", kwarg="learn_patterns"),
+    Option("retry_temporary", _bool, "Retry temporary outcomes later", kwarg="retry_temporary"),
+    Option("retry_initial_delay", float, "Seconds before the first retry"),
+    Option("retry_max_delay", float, "Maximum seconds between retries"),
+    Option("retry_greylist_delay", float, "Minimum seconds before retrying greylisting"),
+    Option("retry_max_attempts", int, "Retries of an address"),
+    Option("deadline_connect", float, "Seconds to connect to an MX"),
+    Option("deadline_greeting", float, "Seconds for an MX's greeting"),
+    Option("deadline_starttls", float, "Seconds for STARTTLS and the TLS handshake"),
+    Option("deadline_rcpt", float, "Seconds for the reply to each RCPT"),
+    Option("deadline_person", float, "Seconds to check a Person (each attempt)"),
+    Option("deadline_domain", float, "Seconds to check a domain, retries included"),
+    Option("deadline_job", float, "Seconds for the whole job"),
+    Option("metrics_port", int, "Serve Prometheus metrics on this port", kwarg="metrics_port"),
+    Option("metrics_host", help="Metrics interface (empty: all)", kwarg="metrics_host"),
+    Option("metrics_log_interval", float, "Log metrics every N seconds", "metrics_log_interval"),
+    Option("log_level", str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+    Option("log_file", help="Also log to this file"),
+    Option("processes", int, "Spread the job over this many worker processes"),
+    Option("shards", int, "Split the input into this many shards (with --processes)"),
+]
+_OPTIONS = {option.name: option for option in OPTIONS}
+
+# Tables of the config file whose keys are prefixed, e.g. [retry] max_attempts
+_TABLES = ("retry", "deadline")
+
+
+def load_config(path: str) -> Dict[str, Any]:
+    """
+    Load the settings of a job from a TOML (or, with PyYAML installed,
+    YAML) file. Keys are the names of the command line options, with
+    underscores; the `[retry]` and `[deadline]` tables hold the `retry_*`
+    and `deadline_*` ones.
+
+    Relative paths in the file are relative to the working directory.
+    """
+    if path.lower().endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError("Reading YAML config files requires PyYAML")
+        load, errors = yaml.safe_load, (OSError, yaml.YAMLError)
+    else:
+        if tomllib is None:
+            raise ConfigError("Reading TOML config files requires Python 3.11 or tomli")
+        load, errors = tomllib.load, (OSError, tomllib.TOMLDecodeError)
+    try:
+        with open(path, "rb") as file:
+            raw = load(file) or {}
+    except errors as exc:
+        raise ConfigError(f"Can't read the config file {path}: {exc}")
+    if not isinstance(raw, dict):
+        raise ConfigError(f"The config file {path} isn't a table of settings")
+
+    settings = {}
+    for key, value in raw.items():
+        key = key.replace("-", "_")
+        if key in _TABLES and isinstance(value, dict):
+            items = {f"{key}_{name.replace('-', '_')}": item for name, item in value.items()}
+        else:
+            items = {key: value}
+        for name, item in items.items():
+            if name not in _OPTIONS:
+                raise ConfigError(f"Unknown setting {name!r} in {path}")
+            settings[name] = _OPTIONS[name].convert(item)
+    return settings
+
+
+def job_kwargs(settings: Dict[str, Any]) -> Dict[str, Any]:
+    "The arguments of `main`/`main_batch` (besides the input) for the `settings`."
+    kwargs = {
+        _OPTIONS[name].kwarg: value
+        for name, value in settings.items()
+        if _OPTIONS[name].kwarg
+    }
+    if settings.get("proxy"):
+        try:
+            proxy = Proxy.from_url(settings["proxy"])
+        except (ValueError, UnknownProxyError) as exc:
+            raise ConfigError(str(exc))
+        kwargs.update(
+            proxy_type=proxy.proxy_type,
+            proxy_addr=proxy.addr,
+            proxy_port=proxy.port,
+            proxy_username=proxy.username,
+            proxy_password=proxy.password,
+        )
+    # Negative values disable these
+    for name in ("coalesce_window", "hedge_delay"):
+        if settings.get(name, 0) < 0:
+            kwargs[name] = None
+    policy = {
+        name[len("retry_") :]: value
+        for name, value in settings.items()
+        if name.startswith("retry_") and name != "retry_temporary"
+    }
+    if policy:
+        kwargs["retry_policy"] = RetryPolicy(**policy)
+    deadlines = {
+        name[len("deadline_") :]: value
+        for name, value in settings.items()
+        if name.startswith("deadline_")
+    }
+    if deadlines:
+        kwargs["deadlines"] = Deadlines(**deadlines)
+    return kwargs
+
+
+def run_job(settings: Dict[str, Any]):
+    """
+    Run the job described by `settings` (see `OPTIONS`): the names file
+    of a single domain with `main`, or a batch file with `main_batch`,
+    in this process or over several (see `shard.run_sharded`).
+    """
+    if not settings.get("input"):
+        raise ConfigError("No input file given")
+    if settings.get("log_level"):
+        # Inherited by the worker processes
+        os.environ["EMAIL_VALIDATOR_LOG_LEVEL"] = settings["log_level"]
+    configure_logging(
+        level=settings.get("log_level") or logging_level, log_file=settings.get("log_file")
+    )
+    kwargs = job_kwargs(settings)
+    domain_str = settings.get("domain")
+
+    if settings.get("processes"):
+        if domain_str:
+            kwargs["domain_str"] = domain_str
+        final_results = run_sharded(
+            settings["input"],
+            mode=NAMES if domain_str else BATCH,
+            processes=settings["processes"],
+            shards=settings.get("shards"),
+            **kwargs,
+        )
+        print("-------\nThe final emails list is:")
+        pprint.pprint(final_results)
+        return final_results
+    if domain_str:
+        return trio.run(partial(main, domain_str, settings["input"], **kwargs))
+    return trio.run(partial(main_batch, settings["input"], **kwargs))
+
+
+def run_cli(argv: Optional[List[str]] = None):
+    "Parse the command line (and config file), and run the job."
+    parser = argparse.ArgumentParser(
+        description="Find the valid email addresses of people at their domain.",
+        epilog="Every option can also be set in the config file, the command line prevailing.",
+    )
+    parser.add_argument("-c", "--config", help="TOML (or YAML) file of the job's settings")
+    for option in OPTIONS:
+        option.add_to(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        settings = load_config(args.config) if args.config else {}
+        settings.update(
+            {
+                name: value
+                for name, value in vars(args).items()
+                if name in _OPTIONS and value is not None
+            }
+        )
+        run_job(settings)
+    except ConfigError as exc:
+        parser.error(str(exc))
+
+
+if __name__ == "__main__":
+    run_cli()
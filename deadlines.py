@@ -0,0 +1,64 @@
+# External imports
+import math
+from typing import Optional
+import trio
+
+# The budgets of `Deadlines`
+PERSON = "person"
+DOMAIN = "domain"
+JOB = "job"
+
+
+class Deadlines:
+    """
+    Time limits, in seconds (None for none), enforced with trio cancel
+    scopes, so they hold whatever the servers do: a reply trickled byte
+    by byte never trips the SMTP `timeout`, which only bounds each read.
+
+    Stage limits of an SMTP session, which fail the stage with an
+    `SMTPStageTimeout` and drop the connection (by default, the SMTP
+    `timeout`):
+    - `connect`: opening the connection, through the proxy if any
+    - `greeting`: the server's greeting once connected
+    - `starttls`: STARTTLS, the TLS handshake and the EHLO after it
+    - `rcpt`: the reply to each RCPT TO
+
+    Budgets, after which the work left is given up, its addresses
+    getting the `TIMED_OUT` verdict:
+    - `person`: each attempt at checking a Person
+    - `domain`: the discovery and the checks of a domain, retries included
+    - `job`: the whole run
+
+    DNS queries are bounded by the resolver's `timeout`.
+    """
+
+    def __init__(
+        self,
+        connect: Optional[float] = None,
+        greeting: Optional[float] = None,
+        starttls: Optional[float] = None,
+        rcpt: Optional[float] = None,
+        person: Optional[float] = None,
+        domain: Optional[float] = None,
+        job: Optional[float] = None,
+    ):
+        self.connect = connect
+        self.greeting = greeting
+        self.starttls = starttls
+        self.rcpt = rcpt
+        self.person = person
+        self.domain = domain
+        self.job = job
+
+    def deadline(self, budget: str, parent: float = math.inf) -> float:
+        """
+        :param budget: `PERSON`, `DOMAIN` or `JOB`
+        :param parent: The deadline of the enclosing work
+
+        :returns: The deadline (on the trio clock) of the `budget` starting
+                  now, no later than `parent`.
+        """
+        limit = getattr(self, budget)
+        if limit is None:
+            return parent
+        return min(parent, trio.current_time() + limit)
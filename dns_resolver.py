@@ -0,0 +1,214 @@
+# External imports
+import itertools
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+from dns import asyncresolver, resolver
+from dns.exception import Timeout
+import trio
+
+# Local imports
+from exceptions import DNSLookupError
+from logging_mod import logging
+from metrics import DNS_CACHE_HITS, DNS_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAMESERVERS = ["8.8.8.8", "1.1.1.1"]
+
+_MISSING = object()
+
+
+class DNSCache:
+    """
+    An in-memory LRU cache of DNS answers honoring their TTLs.
+
+    A `None` value is a negative entry (NXDOMAIN / no answer), cached
+    like any other answer so missing records aren't queried again.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, Tuple[float, Optional[List[str]]]]" = OrderedDict()
+
+    def get(self, key: Hashable, default=_MISSING):
+        "Return the cached value for `key`, or `default` if absent or expired."
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expiration, value = entry
+        if expiration <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Optional[List[str]], ttl: float):
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class AsyncResolver:
+    """
+    A non-blocking DNS resolver (dnspython's async API, running under
+    trio) with a shared `DNSCache`.
+
+    Positive answers are cached for their TTL (capped at `max_ttl`),
+    NXDOMAIN and empty answers for `negative_ttl` seconds. Failed queries
+    (timeouts, server failures) aren't cached, and raise `DNSLookupError`.
+
+    `nameservers` and `port` can point it at a local stub nameserver.
+
+    Each query is given up after `timeout` seconds, retries included,
+    enforced with a cancel scope on top of dnspython's own lifetime.
+    """
+
+    def __init__(
+        self,
+        nameservers: Sequence[str] = DEFAULT_NAMESERVERS,
+        port: int = 53,
+        timeout: float = 5,
+        cache_size: int = 4096,
+        max_ttl: float = 3600,
+        negative_ttl: float = 300,
+        ipv6: bool = True,
+    ):
+        self._resolver = asyncresolver.Resolver(configure=False)
+        self._resolver.nameservers = list(nameservers)
+        self._resolver.port = port
+        self._resolver.lifetime = timeout
+        self.timeout = timeout
+        self.cache = DNSCache(max_size=cache_size)
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.ipv6 = ipv6
+
+    async def query(self, name: str, rdtype: str) -> Optional[List[str]]:
+        """
+        DNS Query for the records of type `rdtype` of `name`, served from
+        the cache when possible.
+
+        :param name: The domain name to be queried
+        :param rdtype: The record type, e.g. 'MX', 'A', 'AAAA'
+
+        :returns: List[str] of the records' text, None if there are none.
+
+        :raises DNSLookupError: If the query failed.
+        """
+        key = (name.lower().rstrip("."), rdtype)
+        cached = self.cache.get(key)
+        if cached is not _MISSING:
+            DNS_CACHE_HITS.inc(rdtype=rdtype)
+            return cached
+
+        started = trio.current_time()
+        try:
+            with trio.fail_after(self.timeout):
+                answer = await self._resolver.resolve(name, rdtype)
+        except (resolver.NoAnswer, resolver.NXDOMAIN) as exc:
+            DNS_QUERY_SECONDS.observe(trio.current_time() - started, rdtype=rdtype, outcome="none")
+            # Hosts without IPv6 are the norm, not an error
+            log = logger.debug if rdtype == "AAAA" else logger.error
+            log("Error during querying DNS type %s %s: %r", rdtype, name, exc)
+            self.cache.set(key, None, self.negative_ttl)
+            return None
+        except (resolver.NoNameservers, Timeout, trio.TooSlowError) as exc:
+            DNS_QUERY_SECONDS.observe(trio.current_time() - started, rdtype=rdtype, outcome="error")
+            logger.error("Error during querying DNS type %s %s: %r", rdtype, name, exc)
+            raise DNSLookupError(name, rdtype, f"({type(exc).__name__})") from exc
+
+        DNS_QUERY_SECONDS.observe(trio.current_time() - started, rdtype=rdtype, outcome="ok")
+        records = [rdata.to_text() for rdata in answer]
+        logger.debug(
+            "Queried %s (%r) successfully. Resulted in %d records.", name, rdtype, len(records)
+        )
+        self.cache.set(key, records, min(answer.rrset.ttl, self.max_ttl))
+        return records
+
+    async def query_mx(self, domain: str) -> Optional[List[str]]:
+        """
+        DNS Query to find MX records of the provided domain name.
+
+        The exchange servers are sorted by preference, the most preferred
+        first. Servers of equal preference are shuffled, to spread the
+        load over them as RFC 5321 asks.
+
+        :param domain: The domain name to be queried
+
+        :returns: List[str] of the resulted exchange servers, None if no server was found.
+
+        :raises DNSLookupError: If the query failed.
+        """
+        records = await self.query(domain, "MX")
+        if not records:
+            return None
+        exchanges = []
+        for record in records:
+            preference, _, exchange = record.partition(" ")
+            exchanges.append((int(preference), random.random(), exchange.strip()))
+        return [exchange for _, _, exchange in sorted(exchanges)]
+
+    async def query_addresses(self, host: str) -> Optional[List[str]]:
+        """
+        DNS Query to find the A (and AAAA if enabled) records of the
+        provided host name, concurrently. The IPv4 and IPv6 addresses are
+        interleaved, an IPv4 one first, so trying them in order alternates
+        between the families (RFC 8305).
+
+        :param host: The host name to be queried
+
+        :returns: List[str] of the resulted IP addresses, None if no IP address was found.
+
+        :raises DNSLookupError: If no address was found, and a query failed.
+        """
+        rdtypes = ["A", "AAAA"] if self.ipv6 else ["A"]
+        answers: Dict[str, Optional[List[str]]] = {}
+        failures: List[DNSLookupError] = []
+
+        async def _query(rdtype: str):
+            try:
+                answers[rdtype] = await self.query(host, rdtype)
+            except DNSLookupError as exc:
+                answers[rdtype] = None
+                failures.append(exc)
+
+        async with trio.open_nursery() as nursery:
+            for rdtype in rdtypes:
+                nursery.start_soon(_query, rdtype)
+
+        addresses = []
+        families = itertools.zip_longest(*(answers[rdtype] or [] for rdtype in rdtypes))
+        for address in itertools.chain.from_iterable(families):
+            if address is not None and address not in addresses:
+                addresses.append(address)
+        if not addresses and failures:
+            raise failures[0]
+        return addresses or None
+
+    async def resolve_hosts(self, hosts: Sequence[str]) -> Dict[str, Optional[List[str]]]:
+        """
+        Resolve the addresses of all `hosts` concurrently.
+
+        :returns: Dict[str, List[str]] of the IP addresses per host (None if there are none).
+                  The hosts whose lookup failed are absent.
+        """
+        results: Dict[str, Optional[List[str]]] = {}
+
+        async def _resolve(host: str):
+            try:
+                results[host] = await self.query_addresses(host)
+            except DNSLookupError:
+                pass
+
+        async with trio.open_nursery() as nursery:
+            for host in hosts:
+                nursery.start_soon(_resolve, host)
+        return {host: results[host] for host in hosts if host in results}
@@ -0,0 +1,172 @@
+# External imports
+import json
+import time
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+# Local imports
+from exceptions import SMTPMessage
+from logging_mod import logging
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+DomainFacts = namedtuple(
+    typename="DomainFacts",
+    field_names=[
+        "domain",
+        "mx_records",
+        "mx_addresses",
+        "catch_all",
+        "starttls",
+        "temporary_errors",
+    ],
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (
+    domain TEXT PRIMARY KEY,
+    mx_records TEXT,
+    mx_addresses TEXT,
+    mx_checked_at REAL,
+    catch_all INTEGER,
+    catch_all_checked_at REAL,
+    starttls INTEGER,
+    starttls_checked_at REAL,
+    temporary_errors TEXT,
+    temporary_errors_at REAL,
+    patterns TEXT
+)
+"""
+
+
+class DomainCache(SQLiteStore):
+    """
+    An on-disk (SQLite) cache of per-domain facts: MX records and their
+    resolved IPs, Catch-All verdict, STARTTLS support and the last seen
+    temporary errors.
+
+    Each fact expires on its own: `get` returns `None` for facts older
+    than their TTL, so only those are looked up on the network again.
+
+    The learned email patterns statistics (see `PatternRanker`) are kept
+    as well, without expiration.
+
+    Facts are written in the background during a run, see `SQLiteStore`.
+    """
+
+    def __init__(
+        self,
+        path: str = "domain_cache.sqlite3",
+        mx_ttl: float = 24 * 3600,
+        catch_all_ttl: float = 7 * 24 * 3600,
+        starttls_ttl: float = 7 * 24 * 3600,
+        temporary_error_ttl: float = 15 * 60,
+        **store_kwargs,
+    ):
+        super().__init__(path, **store_kwargs)
+        self.mx_ttl = mx_ttl
+        self.catch_all_ttl = catch_all_ttl
+        self.starttls_ttl = starttls_ttl
+        self.temporary_error_ttl = temporary_error_ttl
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(domains)")]
+            # Caches created before the patterns were learned
+            if "patterns" not in columns:
+                self._conn.execute("ALTER TABLE domains ADD COLUMN patterns TEXT")
+
+    def _fresh(self, checked_at: Optional[float], ttl: float) -> bool:
+        return checked_at is not None and time.time() - checked_at < ttl
+
+    def get(self, domain: str) -> DomainFacts:
+        """
+        Return the known facts about `domain`; unknown or expired facts
+        are `None`.
+        """
+        row = self._conn.execute(
+            "SELECT mx_records, mx_addresses, mx_checked_at, catch_all, catch_all_checked_at, "
+            "starttls, starttls_checked_at, temporary_errors, temporary_errors_at "
+            "FROM domains WHERE domain = ?",
+            (domain.lower(),),
+        ).fetchone()
+        if row is None:
+            return DomainFacts(domain, None, None, None, None, None)
+        (
+            mx_records,
+            mx_addresses,
+            mx_checked_at,
+            catch_all,
+            catch_all_checked_at,
+            starttls,
+            starttls_checked_at,
+            temporary_errors,
+            temporary_errors_at,
+        ) = row
+
+        fresh_mx = self._fresh(mx_checked_at, self.mx_ttl)
+        return DomainFacts(
+            domain=domain,
+            mx_records=json.loads(mx_records) if fresh_mx else None,
+            mx_addresses=json.loads(mx_addresses) if fresh_mx else None,
+            catch_all=(
+                bool(catch_all) if self._fresh(catch_all_checked_at, self.catch_all_ttl) else None
+            ),
+            starttls=(
+                bool(starttls) if self._fresh(starttls_checked_at, self.starttls_ttl) else None
+            ),
+            temporary_errors=(
+                {
+                    host: SMTPMessage(*message, exceptions=())
+                    for host, message in json.loads(temporary_errors).items()
+                }
+                if self._fresh(temporary_errors_at, self.temporary_error_ttl)
+                else None
+            ),
+        )
+
+    def _update(self, domain: str, **columns):
+        names = list(columns)
+        self._write("INSERT OR IGNORE INTO domains (domain) VALUES (?)", [(domain.lower(),)])
+        self._write(
+            f"UPDATE domains SET {', '.join(f'{name} = ?' for name in names)} WHERE domain = ?",
+            [tuple(columns[name] for name in names) + (domain.lower(),)],
+        )
+
+    def set_mx(self, domain: str, mx_records: List[str], mx_addresses: List[str]):
+        "Record the MX records of `domain` and their IPs (empty lists if none)."
+        self._update(
+            domain,
+            mx_records=json.dumps(mx_records),
+            mx_addresses=json.dumps(mx_addresses),
+            mx_checked_at=time.time(),
+        )
+
+    def set_catch_all(self, domain: str, catch_all: bool):
+        self._update(domain, catch_all=int(catch_all), catch_all_checked_at=time.time())
+
+    def set_starttls(self, domain: str, supported: bool):
+        self._update(domain, starttls=int(supported), starttls_checked_at=time.time())
+
+    def set_temporary_errors(self, domain: str, error_messages: Dict[str, SMTPMessage]):
+        "Record the temporary errors (`SMTPTemporaryError.error_messages`) seen on `domain`."
+        self._update(
+            domain,
+            temporary_errors=json.dumps(
+                {
+                    host: [message.command, message.code, message.text]
+                    for host, message in error_messages.items()
+                }
+            ),
+            temporary_errors_at=time.time(),
+        )
+
+    def get_patterns(self, domain: str) -> Optional[dict]:
+        "The patterns statistics of `domain` (see `PatternRanker.to_dict`), if any."
+        row = self._conn.execute(
+            "SELECT patterns FROM domains WHERE domain = ?", (domain.lower(),)
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_patterns(self, domain: str, stats: dict):
+        self._update(domain, patterns=json.dumps(stats))
@@ -1,5 +1,6 @@
 from collections import namedtuple
-from typing import Dict
+from smtplib import SMTPServerDisconnected
+from typing import Dict, Optional
 
 SMTPMessage = namedtuple(
     typename="SmtpMessage", field_names=["command", "code", "text", "exceptions"]
@@ -48,6 +49,19 @@ class NoMXError(DNSError):
         self.message = f"Domain {domain} doesn't have valid MX records"
 
 
+class DNSLookupError(DNSError):
+    """
+    Raised when a DNS query failed (timeout, no nameserver answering), so
+    whether the records exist is unknown. Unlike `NoMXError`, it's
+    temporary.
+    """
+
+    def __init__(self, name: str, rdtype: str, reason: str = ""):
+        self.name = name
+        self.rdtype = rdtype
+        self.message = f"The DNS query of the {rdtype} records of {name} failed {reason}".rstrip()
+
+
 class NoValidMXError(DNSError):
     """
     Raised when the domain has MX records configured, but none of them
@@ -136,6 +150,29 @@ class SMTPTemporaryError(SMTPError):
     message = "Temporary error in email address verification:"
 
 
+class CheckTimeoutError(EmailValidationError):
+    """
+    Raised when a check ran out of its time budget (see `Deadlines`)
+    before completion.
+    """
+
+    message = "The time budget ran out before the check completed."
+
+
+class SMTPStageTimeout(SMTPServerDisconnected):
+    """
+    Raised when a stage of the SMTP communication ran past its deadline
+    (see `Deadlines`). The connection is dropped, so it's handled as a
+    disconnect, except that it isn't retried on a new connection.
+
+    `stage` is the name of the stage, one of the limits of `Deadlines`.
+    """
+
+    def __init__(self, message: str, stage: Optional[str] = None):
+        super().__init__(message)
+        self.stage = stage
+
+
 class TLSNegotiationError(EmailValidationError):
     "Raised when an error happens during the TLS negotiation."
     _str = "During TLS negotiation, the following exception(s) happened: {exc}"
@@ -152,3 +189,10 @@ class UnknownProxyError(ParameterError):
 
     def __init__(self, proxy_type):
         self.message = f"The proxy type {proxy_type} is not known\n Try one of 'socks4', 'socks5'"
+
+
+class ConfigError(ParameterError):
+    "Raised when a configuration file can't be read, or has unknown or invalid settings."
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,303 @@
+# External imports
+import argparse
+import random
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import trio
+
+# Local imports
+from dns_resolver import AsyncResolver
+from logging_mod import configure_logging, logging
+
+logger = logging.getLogger(__name__)
+
+DNS_PORT = 5353
+# The standard port of MX servers. Binding port 0 picks a free one instead.
+SMTP_PORT = 25
+
+
+class FakeDNSServer:
+    """
+    A stub DNS responder (UDP) serving the MX and A records of the
+    domains added with `add_domain`, and NXDOMAIN for any other name.
+
+    Point an `AsyncResolver` at it with `resolver`. With port 0, a free
+    port is picked, and set to `port` once running.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = DNS_PORT, ttl: int = 300):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.queries = 0
+        self._records: Dict[Tuple[str, str], List[str]] = {}
+
+    def add_domain(self, domain: str, mx_ip: str = "127.0.0.1", mx_host: Optional[str] = None):
+        "Serve an MX record of `domain`, to `mx_host` (`mx.<domain>` by default) at `mx_ip`."
+        mx_host = (mx_host or f"mx.{domain}").lower().rstrip(".") + "."
+        self._records[(domain.lower().rstrip(".") + ".", "MX")] = [f"10 {mx_host}"]
+        self._records[(mx_host, "A")] = [mx_ip]
+
+    def resolver(self, **kwargs) -> AsyncResolver:
+        return AsyncResolver([self.host], port=self.port, ipv6=False, **kwargs)
+
+    def _answer(self, data: bytes) -> bytes:
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        key = (question.name.to_text().lower(), dns.rdatatype.to_text(question.rdtype))
+        if key in self._records:
+            response.answer.append(
+                dns.rrset.from_text_list(question.name, self.ttl, "IN", key[1], self._records[key])
+            )
+        elif not any(name == key[0] for name, _ in self._records):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        return response.to_wire()
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        sock = trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM)
+        with sock:
+            await sock.bind((self.host, self.port))
+            self.port = sock.getsockname()[1]
+            task_status.started()
+            while True:
+                data, address = await sock.recvfrom(4096)
+                self.queries += 1
+                try:
+                    await sock.sendto(self._answer(data), address)
+                except dns.exception.DNSException:
+                    logger.debug("Ignoring malformed DNS query from %s", address)
+
+
+class FakeSMTPServer:
+    """
+    A stand-in MX server, answering the commands used to check email
+    addresses.
+
+    - `deliverable` addresses are accepted, others rejected with 550;
+      every address of the `catch_all` domains is accepted.
+    - `latency` seconds pass before the server answers what it read
+      from the connection, a network round trip: pipelined commands
+      cost one.
+    - With `greylist_time`, the first RCPT of an address gets a 451
+      until that many seconds passed, like greylisting servers do.
+    - `temporary_rate` and `permanent_rate` are the ratios of RCPTs
+      answered with an injected 451 and 554.
+    - Beyond `max_connections` concurrent connections, new ones are
+      greeted with a 421 and closed.
+    - Beyond `max_recipients` RCPTs in a transaction, they get a 452.
+    - PIPELINING is advertised if `pipelining`. STARTTLS never is.
+
+    Every counter is in `stats`, including the `round_trips` of commands
+    (several when pipelined) answered at once. Binding to port 25 takes privileges
+    (root, or CAP_NET_BIND_SERVICE on Linux): with port 0, a free port is
+    picked and set to `port` once running, for the `SMTPPool`'s `port`.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = SMTP_PORT,
+        deliverable: Iterable[str] = (),
+        catch_all: Iterable[str] = (),
+        latency: float = 0,
+        greylist_time: float = 0,
+        temporary_rate: float = 0,
+        permanent_rate: float = 0,
+        max_connections: Optional[int] = None,
+        max_recipients: Optional[int] = None,
+        pipelining: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.deliverable = {address.lower() for address in deliverable}
+        self.catch_all = {domain.lower() for domain in catch_all}
+        self.latency = latency
+        self.greylist_time = greylist_time
+        self.temporary_rate = temporary_rate
+        self.permanent_rate = permanent_rate
+        self.max_connections = max_connections
+        self.max_recipients = max_recipients
+        self.pipelining = pipelining
+        self.stats = dict(connections=0, refused=0, commands=0, rcpt=0, accepted=0, round_trips=0)
+        self.active = 0
+        self._random = random.Random(seed)
+        self._greylisted: Dict[str, float] = {}
+
+    def _rcpt(self, address: str) -> bytes:
+        self.stats["rcpt"] += 1
+        draw = self._random.random()
+        if draw < self.temporary_rate:
+            return b"451 4.3.0 Temporary failure, try again\r\n"
+        if draw < self.temporary_rate + self.permanent_rate:
+            return b"554 5.7.1 Rejected by policy\r\n"
+        if self.greylist_time:
+            first_seen = self._greylisted.setdefault(address, trio.current_time())
+            if trio.current_time() - first_seen < self.greylist_time:
+                return b"451 4.7.1 Greylisted, try again later\r\n"
+        if address in self.deliverable or address.rpartition("@")[2] in self.catch_all:
+            self.stats["accepted"] += 1
+            return b"250 2.1.5 OK\r\n"
+        return b"550 5.1.1 No such user\r\n"
+
+    def _reply(self, line: str, session: Dict[str, int]) -> Tuple[bytes, bool]:
+        """
+        The reply to a command line, and whether to close the connection
+        after it. `session` is the state of the connection.
+        """
+        self.stats["commands"] += 1
+        verb = line[:4].upper()
+        if verb == "EHLO":
+            extensions = b"250-SIZE 35882577\r\n"
+            if self.pipelining:
+                extensions += b"250-PIPELINING\r\n"
+            return b"250-fake.local\r\n" + extensions + b"250 8BITMIME\r\n", False
+        if verb == "RCPT":
+            session["recipients"] += 1
+            if self.max_recipients is not None and session["recipients"] > self.max_recipients:
+                return b"452 4.5.3 Too many recipients\r\n", False
+            argument = line[line.find(":") + 1 :].split() or [""]
+            address = argument[0].strip("<>").lower()
+            return self._rcpt(address), False
+        if verb == "QUIT":
+            return b"221 2.0.0 Bye\r\n", True
+        if verb in ("MAIL", "RSET"):
+            session["recipients"] = 0
+        if verb in ("HELO", "MAIL", "RSET", "NOOP"):
+            return b"250 2.0.0 OK\r\n", False
+        return b"502 5.5.2 Command not recognized\r\n", False
+
+    async def _handle(self, stream: trio.SocketStream):
+        self.stats["connections"] += 1
+        try:
+            if self.max_connections is not None and self.active >= self.max_connections:
+                self.stats["refused"] += 1
+                await stream.send_all(b"421 4.7.0 Too many connections\r\n")
+                return
+            self.active += 1
+            try:
+                await self._session(stream)
+            finally:
+                self.active -= 1
+        except trio.BrokenResourceError:
+            pass
+        finally:
+            await trio.aclose_forcefully(stream)
+
+    async def _session(self, stream: trio.SocketStream):
+        await trio.sleep(self.latency)
+        await stream.send_all(b"220 fake.local ESMTP\r\n")
+        session = dict(recipients=0)
+        buffer = b""
+        while True:
+            data = await stream.receive_some(65536)
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b"\r\n")
+            if not lines:
+                continue
+            await trio.sleep(self.latency)
+            self.stats["round_trips"] += 1
+            replies = []
+            closing = False
+            for line in lines:
+                reply, closing = self._reply(line.decode("ascii", "replace"), session)
+                replies.append(reply)
+                if closing:
+                    break
+            await stream.send_all(b"".join(replies))
+            if closing:
+                return
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        async with trio.open_nursery() as nursery:
+            listeners = await nursery.start(
+                partial(trio.serve_tcp, self._handle, self.port, host=self.host)
+            )
+            self.port = listeners[0].socket.getsockname()[1]
+            task_status.started(listeners)
+
+
+def mx_ip(index: int) -> str:
+    "A distinct loopback address for the MX of the `index`-th fake domain."
+    return f"127.0.{index // 250}.{index % 250 + 2}"
+
+
+async def serve(
+    domains: List[str],
+    dns_port: int = DNS_PORT,
+    smtp_port: int = SMTP_PORT,
+    task_status=trio.TASK_STATUS_IGNORED,
+    **smtp_kwargs,
+):
+    """
+    Serve `domains` from a `FakeDNSServer`, each with its own
+    `FakeSMTPServer` (on its own loopback address, so per-MX limits
+    apply as with real servers), until cancelled.
+
+    With port 0, free ports are picked: the MX servers all get the one
+    picked for the first. The ports are passed to `task_status.started`,
+    as a (DNS port, SMTP port) tuple.
+
+    :param smtp_kwargs: Arguments of every `FakeSMTPServer`
+    """
+    dns_server = FakeDNSServer(port=dns_port)
+    async with trio.open_nursery() as nursery:
+        await nursery.start(dns_server.run)
+        for index, domain in enumerate(domains):
+            dns_server.add_domain(domain, mx_ip=mx_ip(index))
+            smtp_server = FakeSMTPServer(host=mx_ip(index), port=smtp_port, **smtp_kwargs)
+            await nursery.start(smtp_server.run)
+            smtp_port = smtp_server.port
+        logger.info(
+            "Serving %d fake domains, DNS on port %d, SMTP on port %d ...",
+            len(domains),
+            dns_server.port,
+            smtp_port,
+        )
+        task_status.started((dns_server.port, smtp_port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake DNS and MX servers for local tests.")
+    parser.add_argument("domains", nargs="+", help="The domains to serve")
+    parser.add_argument("--dns-port", type=int, default=DNS_PORT)
+    parser.add_argument("--smtp-port", type=int, default=SMTP_PORT)
+    parser.add_argument("--deliverable", default=None, help="File of deliverable addresses")
+    parser.add_argument("--catch-all", action="store_true", help="Accept every address")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds per round trip")
+    parser.add_argument("--greylist-time", type=float, default=0)
+    parser.add_argument("--temporary-rate", type=float, default=0)
+    parser.add_argument("--permanent-rate", type=float, default=0)
+    parser.add_argument("--max-connections", type=int, default=None)
+    parser.add_argument("--no-pipelining", action="store_true")
+    args = parser.parse_args()
+
+    configure_logging()
+    deliverable = []
+    if args.deliverable:
+        with open(args.deliverable, "r", encoding="utf-8") as file:
+            deliverable = [line.strip() for line in file if line.strip()]
+    trio.run(
+        partial(
+            serve,
+            args.domains,
+            dns_port=args.dns_port,
+            smtp_port=args.smtp_port,
+            deliverable=deliverable,
+            catch_all=args.domains if args.catch_all else (),
+            latency=args.latency,
+            greylist_time=args.greylist_time,
+            temporary_rate=args.temporary_rate,
+            permanent_rate=args.permanent_rate,
+            max_connections=args.max_connections,
+            pipelining=not args.no_pipelining,
+        )
+    )
@@ -1,12 +1,104 @@
+import atexit
+import itertools
 import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional, Union
 
 formatting = "%(asctime)s | %(levelname)s | %(message)s"
-logging_level = logging.DEBUG
-logging.basicConfig(
-    handlers=[
-        logging.StreamHandler(),  # Print to console
-    ],
-    level=logging._checkLevel(logging_level),
-    format=formatting,
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# Overridden by the EMAIL_VALIDATOR_LOG_LEVEL environment variable
+logging_level = os.environ.get("EMAIL_VALIDATOR_LOG_LEVEL", "INFO")
+
+# The logger of the per-RCPT messages, sampled by `SampleFilter`
+RCPT_LOGGER = "rcpt"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    A `QueueHandler` leaving the records as they are, for the listener
+    thread to format: the stock one merges the message and arguments
+    (and the traceback) before queuing, on the event loop. The queue
+    doesn't leave the process, so the records needn't be made picklable,
+    but objects passed as arguments shouldn't be mutated afterwards.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets one record out of every `every` through, for messages too
+    frequent to be logged one by one. Warnings and errors always pass.
+    """
+
+    def __init__(self, every: int = 100):
+        super().__init__()
+        self.every = max(1, every)
+        self._counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or next(self._counter) % self.every == 0
+
+
+def configure_logging(
+    level: Union[int, str] = logging_level,
+    log_file: Optional[str] = None,
+    rcpt_sample_every: int = 100,
+    background: bool = True,
+):
+    """
+    Set up the root logger, replacing any previous setup. Called by the
+    entry points (see `cli.run_cli`): importing the modules leaves the
+    logging of the application using them alone.
+
+    With `background`, records are handed to a queue and formatted and
+    written by a listener thread, so the event loop never blocks on the
+    console or the file, nor formats the messages. Messages should be
+    given with lazy %-style arguments, which are only formatted if the
+    record is emitted.
+
+    :param level: The level name or number
+    :param log_file: Also log to this file
+    :param rcpt_sample_every: Only log one per-RCPT debug message out of this many
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    handlers = [logging.StreamHandler()]  # Print to console
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    formatter = logging.Formatter(formatting, datefmt="%Y-%m-%d %H:%M:%S")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging._checkLevel(level.upper() if isinstance(level, str) else level))
+    if background:
+        log_queue = queue.SimpleQueue()
+        root.addHandler(_LazyQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, *handlers)
+        _listener.start()
+    else:
+        for handler in handlers:
+            root.addHandler(handler)
+
+    rcpt_logger = logging.getLogger(RCPT_LOGGER)
+    rcpt_logger.filters.clear()
+    rcpt_logger.addFilter(SampleFilter(rcpt_sample_every))
+
+
+def _stop_listener():
+    "Write out the queued records at exit."
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
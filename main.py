@@ -1,177 +1,539 @@
 # External imports
 import binascii
+import math
 import os
-from typing import List
-from dns.resolver import Resolver
-from dns import resolver
+import time
+from typing import Dict, List, Optional, Set, Tuple
 import trio
 from functools import partial
-from exceptions import NoMXError, SMTPCatchAll, NoValidMXError
-import re
-import pprint
+from smtplib import SMTP_PORT
+from exceptions import (
+    CheckTimeoutError,
+    DNSLookupError,
+    Error,
+    NoMXError,
+    NoValidMXError,
+    SMTPCatchAll,
+    SMTPError,
+    SMTPMessage,
+    SMTPTemporaryError,
+)
 
 # Local imports
+from deadlines import DOMAIN, JOB, PERSON, Deadlines
+from dns_resolver import AsyncResolver
+from domain_cache import DomainCache
 from logging_mod import logging
+from metrics import METRICS_HOST, TASKS_IN_FLIGHT
+from patterns import PatternRanker
 from person import Person
+from pipeline import process_names_file
+from proxy_pool import LEAST_LOADED
+from result_sink import ResultSink
+from result_store import ResultStore
+from results import AddressResult, DELIVERABLE, PersonResult, TEMPORARY, TIMED_OUT
+from retry import RetryPolicy, RetryQueue
+from run_context import open_run
 from smtp_check import smtp_check
+from smtp_pool import SMTPPool
 
 logger = logging.getLogger(__name__)
 
-#
-# These variables would have been supplied via a theoretical calling function or command line arguments..
-#
-
-DOMAIN_STR = "gmail.com"
-NAMES_FILE = "names.csv"
-PROXY_TYPE = "socks5"
-PROXY_ADDR = "82.196.7.200"
-PROXY_PORT = 2434
-PROXY_USERNAME = "vpn"
-PROXY_PASSWORD = "unlimited"
-
 
 async def main(
     domain_str: str,
     names_file: str,
     smtp_timeout: float = float(20),
+    smtp_port: int = SMTP_PORT,
     mock_sender_email: str = "jim@gmail.com",
     proxy_type: str = None,
     proxy_addr: str = None,
     proxy_port: str = None,
     proxy_username: str = None,
     proxy_password: str = None,
-):
+    proxies_file: Optional[str] = None,
+    proxy_strategy: str = LEAST_LOADED,
+    proxy_max_connections: Optional[int] = None,
+    smtp_max_connections: int = 5,
+    max_concurrency: int = 100,
+    coalesce_window: Optional[float] = 0.05,
+    hedge_delay: Optional[float] = 0.3,
+    adaptive_rate: bool = True,
+    retry_temporary: bool = True,
+    dns_resolver: Optional[AsyncResolver] = None,
+    dns_nameservers: Optional[List[str]] = None,
+    dns_timeout: float = 5,
+    retry_policy: Optional[RetryPolicy] = None,
+    domain_cache_path: Optional[str] = None,
+    result_store_path: Optional[str] = None,
+    patterns_file: Optional[str] = None,
+    learn_patterns: bool = True,
+    output_file: Optional[str] = None,
+    output_format: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    metrics_log_interval: Optional[float] = None,
+    metrics_host: str = METRICS_HOST,
+    deadlines: Optional[Deadlines] = None,
+    report: bool = True,
+) -> Set[str]:
+    deadlines = deadlines or Deadlines()
+    # The run checks a single domain, bounded by both budgets
+    deadline = deadlines.deadline(DOMAIN, deadlines.deadline(JOB))
+    async with open_run(
+        deadlines=deadlines,
+        deadline=deadline,
+        smtp_timeout=smtp_timeout,
+        smtp_port=smtp_port,
+        mock_sender_email=mock_sender_email,
+        proxy_type=proxy_type,
+        proxy_addr=proxy_addr,
+        proxy_port=proxy_port,
+        proxy_username=proxy_username,
+        proxy_password=proxy_password,
+        proxies_file=proxies_file,
+        proxy_strategy=proxy_strategy,
+        proxy_max_connections=proxy_max_connections,
+        smtp_max_connections=smtp_max_connections,
+        max_concurrency=max_concurrency,
+        coalesce_window=coalesce_window,
+        hedge_delay=hedge_delay,
+        adaptive_rate=adaptive_rate,
+        retry_temporary=retry_temporary,
+        dns_resolver=dns_resolver,
+        dns_nameservers=dns_nameservers,
+        dns_timeout=dns_timeout,
+        retry_policy=retry_policy,
+        domain_cache_path=domain_cache_path,
+        result_store_path=result_store_path,
+        patterns_file=patterns_file,
+        learn_patterns=learn_patterns,
+        output_file=output_file,
+        output_format=output_format,
+        metrics_port=metrics_port,
+        metrics_log_interval=metrics_log_interval,
+        metrics_host=metrics_host,
+    ) as run:
+        with trio.move_on_at(deadline) as discovery_scope:
+            mx_records_resolved = await discover_domain(
+                domain_str=domain_str,
+                dns_resolver=run.dns_resolver,
+                pool=run.pool,
+                smtp_timeout=smtp_timeout,
+                mock_sender_email=mock_sender_email,
+                domain_cache=run.domain_cache,
+                retry_policy=run.retry_policy,
+            )
+        if discovery_scope.cancelled_caught:
+            logger.error("Domain %s couldn't be discovered within the time budget.", domain_str)
+            raise CheckTimeoutError()
+
+        pattern_engine = run.domain_patterns.get(domain_str)
+        # Learns the naming convention of the domain to cut the probes
+        ranker = run.ranker(domain_str)
+        final_results = set()
+
+        async def check_new_person(p: Person):
+            candidates = pattern_engine.templated(p, domain_str)
+            person_result = await check_person(
+                person=p,
+                addresses=list(candidates),
+                mx_records=mx_records_resolved,
+                pool=run.pool,
+                final_results=final_results,
+                result_store=run.result_store,
+                retry_queue=run.retry_queue,
+                ranker=ranker,
+                candidates=candidates,
+                result_sink=run.result_sink,
+                deadlines=deadlines,
+                deadline=deadline,
+            )
+            if person_result.error is not None:
+                run.failures.append(person_result)
+
+        # Temporary outcomes are retried later, while new Persons keep coming
+        async with run.retrying(run_retry):
+            # A fixed pool of workers consumes the Persons streamed from the file
+            await process_names_file(names_file, check_new_person, workers=max_concurrency)
+
+        if report:
+            run.report(final_results)
+        return final_results
+
+
+async def check_person(
+    person: Person,
+    addresses: List[str],
+    mx_records: List[str],
+    pool: SMTPPool,
+    final_results: Set[str],
+    result_store: Optional[ResultStore] = None,
+    retry_queue: Optional[RetryQueue] = None,
+    attempt: int = 0,
+    ranker: Optional[PatternRanker] = None,
+    candidates: Optional[Dict[str, Tuple[str, ...]]] = None,
+    result_sink: Optional[ResultSink] = None,
+    deadlines: Optional[Deadlines] = None,
+    deadline: float = math.inf,
+    probed_before: Tuple[str, ...] = (),
+    found_before: Tuple[str, ...] = (),
+) -> PersonResult:
+    """
+    Check the candidate email addresses of a Person, adding the
+    deliverable ones to `final_results`.
+
+    Errors of this module are captured into the returned `PersonResult`
+    (with the servers' `SMTPMessage`s when known) instead of being
+    raised, so one Person's failure doesn't cancel the other checks.
+
+    With a `retry_queue`, the addresses with a temporary outcome (4xx
+    replies, or `SMTPTemporaryError` from all the servers) are scheduled
+    for another attempt instead of being given up. A retry probes exactly
+    these addresses, without enriching them with trailing digits.
+
+    With a `ranker` and the `candidates` the addresses were generated
+    from (see `PatternEngine.templated`), the addresses are probed most
+    likely first, as the ranker plans it, and the outcome is learned
+    once the Person is final: when no retry of it is scheduled.
+
+    With `deadlines`, the attempt is given up after the `person` budget
+    (or at the `deadline` of the domain/job, if sooner): the addresses
+    left without a verdict get a `TIMED_OUT` one, and aren't retried. So
+    do those left when a stage of the MX server times out.
+
+    :param attempt: The number of retries already done for these addresses
+    :param probed_before: The addresses probed by the previous attempts, for the ranker
+    :param found_before: The deliverable addresses found by the previous attempts
+    :param result_sink: Where to stream the verdict of every address
+
+    :returns: The PersonResult of this attempt.
+    """
+    stop_on_hit, probe_digits = False, True
+    if ranker is not None and candidates is not None:
+        addresses = ranker.rank(addresses, candidates)
+        stop_on_hit, probe_digits = ranker.plan()
+    if attempt:
+        # Exactly the addresses left temporary: enriching them again would
+        # probe variants of variants (e.g. "jsmith11")
+        probe_digits = False
+
+    address_results = {}
+    found = []
+    temporary = []
+    reason = ""
+    error = None
+    error_messages = {}
+    person_deadline = deadlines.deadline(PERSON, deadline) if deadlines else deadline
+    TASKS_IN_FLIGHT.inc(stage="person")
+    with trio.move_on_at(person_deadline) as budget_scope:
+        try:
+            found = await smtp_check(
+                email_addresses=addresses,
+                mx_records=mx_records,
+                from_address=pool.sender,
+                final_results=final_results,
+                entity=person,
+                pool=pool,
+                result_store=result_store,
+                address_results=address_results,
+                stop_on_hit=stop_on_hit,
+                probe_digits=probe_digits,
+                result_sink=result_sink,
+            )
+            temporary = [
+                address
+                for address, result in address_results.items()
+                if result.verdict == TEMPORARY
+            ]
+            reason = " ".join(address_results[address].text for address in temporary)
+        except SMTPTemporaryError as exc:
+            error, error_messages = exc, exc.error_messages
+            temporary = [
+                address
+                for address in addresses
+                if address not in address_results or address_results[address].verdict == TEMPORARY
+            ]
+            reason = str(exc)
+        except SMTPError as exc:
+            error, error_messages = exc, exc.error_messages
+        except Error as exc:
+            error = exc
+        finally:
+            TASKS_IN_FLIGHT.dec(stage="person")
+    if budget_scope.cancelled_caught:
+        error, error_messages = CheckTimeoutError(), {}
+        found = [
+            address for address, result in address_results.items() if result.verdict == DELIVERABLE
+        ]
+        final_results.update(found)
+        temporary = [
+            address for address, result in address_results.items() if result.verdict == TEMPORARY
+        ]
+        reason = " ".join(address_results[address].text for address in temporary)
+        for address in addresses:
+            if address not in address_results:
+                address_results[address] = AddressResult(
+                    address=address,
+                    verdict=TIMED_OUT,
+                    mx=None,
+                    code=None,
+                    text=str(error),
+                    checked_at=time.time(),
+                )
+                if result_sink:
+                    result_sink.write(person, address_results[address])
+
+    if error is not None:
+        logger.error("Entity - %s; %s: %s", person, type(error).__name__, error)
+
+    probed_before += tuple(
+        address for address, result in address_results.items() if result.verdict != TIMED_OUT
+    )
+    found_before += tuple(found or ())
+    retrying = False
+    if temporary and retry_queue is not None:
+        logger.debug("Entity - %s; %d addresses with temporary outcomes.", person, len(temporary))
+        retrying = retry_queue.schedule(
+            partial(
+                check_person,
+                person=person,
+                addresses=temporary,
+                mx_records=mx_records,
+                pool=pool,
+                final_results=final_results,
+                result_store=result_store,
+                retry_queue=retry_queue,
+                ranker=ranker,
+                candidates=candidates,
+                result_sink=result_sink,
+                deadlines=deadlines,
+                deadline=deadline,
+                probed_before=probed_before,
+                found_before=found_before,
+            ),
+            attempt=attempt + 1,
+            reason=reason,
+        )
+    # Learned once per Person, from all its attempts
+    learned = probed_before or found_before
+    if not retrying and ranker is not None and candidates is not None and learned:
+        ranker.record(candidates, probed=probed_before, deliverable=found_before)
+
+    return PersonResult(
+        person=person,
+        addresses=addresses,
+        deliverable=sorted(found or []),
+        error=error,
+        error_messages=error_messages,
+    )
+
+
+async def run_retry(job: partial, attempt: int):
+    "The `RetryQueue` worker for the jobs scheduled by `check_person`."
+    await job(attempt=attempt)
+
 
-    # Check for MX records, raise error if not. If the domain name is wrong, this will have no results
-    mx_records = query_mx(domain_str)
+async def discover_domain(
+    domain_str: str,
+    dns_resolver: AsyncResolver,
+    pool: SMTPPool,
+    smtp_timeout: float = float(20),
+    mock_sender_email: str = "jim@gmail.com",
+    domain_cache: Optional[DomainCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> List[str]:
+    """
+    Find the exchange servers' IP addresses of the provided domain name,
+    and make sure they don't accept all email addresses.
+
+    Facts still fresh in the `domain_cache` are used instead of network
+    lookups, and the facts learned are saved back to it.
+
+    A Catch-All probe answered with a temporary error (e.g. greylisted),
+    or refused one (e.g. a 421 at the greeting of a throttling server),
+    tells nothing, so it's asked again as the `retry_policy` says, and
+    the domain is given up if it's still not answered. Refusals are then
+    cached, failing the next discoveries of the domain without a
+    `retry_policy` until their TTL passes.
+
+    :param domain_str: The domain name to be checked
+    :param dns_resolver: The (caching) resolver to query with
+    :param pool: The SMTP sessions pool used for the Catch-All probe
+    :param domain_cache: Optional persistent cache of per-domain facts
+    :param retry_policy: When to retry a deferred Catch-All probe, if at all
+
+    :returns: List[str] of the exchange servers' IP addresses.
+
+    :raises NoMXError: If the domain has no MX records.
+    :raises DNSLookupError: If the MX records, or all their addresses, couldn't be looked up.
+    :raises NoValidMXError: If none of the MX records could be resolved.
+    :raises SMTPCatchAll: If the SMTP servers accept all email addresses.
+    :raises SMTPTemporaryError: If the servers recently answered with temporary errors,
+                                or kept deferring the Catch-All probe.
+    """
+    facts = domain_cache.get(domain_str) if domain_cache else None
+
+    if facts and facts.catch_all:
+        logger.error("Domain %s is known to accept all emails (cached).", domain_str)
+        raise SMTPCatchAll(domain_str)
+    if facts and facts.temporary_errors and retry_policy is None:
+        logger.error("Domain %s recently answered with temporary errors (cached).", domain_str)
+        raise SMTPTemporaryError(error_messages=facts.temporary_errors)
+
+    if facts and facts.mx_records is not None:
+        mx_records, mx_records_resolved = facts.mx_records, facts.mx_addresses
+        logger.debug("Using cached MX records of %s.", domain_str)
+    else:
+        mx_records, mx_records_resolved, complete = await _resolve_domain(
+            domain_str, dns_resolver
+        )
+        # Failed lookups aren't answers: only complete ones are cached
+        if domain_cache and complete:
+            domain_cache.set_mx(domain_str, mx_records, mx_records_resolved)
+
+    # Check for MX records, raise error if not. If the domain name is wrong, this will have
+    # no results
     if not mx_records:
-        logger.error(f"Domain {domain_str} doesn't have valid MX records")
+        logger.error("Domain %s doesn't have valid MX records", domain_str)
         raise NoMXError(domain_str)
 
-    mx_records_resolved = []
-    for rec in mx_records:
-        A_res = query_A(rec)
-        if A_res:
-            mx_records_resolved.extend(A_res)
-        else:
-            logger.debug(f"No DNS translation for {rec}")
-
     if not mx_records_resolved:
         logger.error(
-            f"Domain {domain_str} doesn't have a respective valid A record to the MX records"
+            "Domain %s doesn't have a respective valid A record to the MX records", domain_str
         )
         raise NoValidMXError(domain_str)
 
+    if facts and facts.catch_all is False:
+        return mx_records_resolved
+
     # Check if CHECK ALL is configured on the SMTP server
     rand_email = random_email(domain_str)
     logger.debug("Checking if SMTP servers have Check-All configured...")
-    if await smtp_check(
-        email_addresses=[rand_email],
-        mx_records=mx_records_resolved,
-        timeout=smtp_timeout,
-        from_address=mock_sender_email,
-        final_results=set(),
-        entity=Person("not", "real"),
-    ):
+    attempt = 0
+    while True:
+        probe_results = {}
+        deferral, refused = None, False
+        try:
+            catch_all = await smtp_check(
+                email_addresses=[rand_email],
+                mx_records=mx_records_resolved,
+                timeout=smtp_timeout,
+                from_address=mock_sender_email,
+                final_results=set(),
+                entity=Person("not", "real"),
+                pool=pool,
+                address_results=probe_results,
+                probe_digits=False,
+            )
+        except SMTPTemporaryError as exc:
+            # Refused before the probe got an answer
+            deferral, refused = exc, True
+        finally:
+            if domain_cache:
+                starttls = [
+                    pool.starttls_support[ip]
+                    for ip in mx_records_resolved
+                    if ip in pool.starttls_support
+                ]
+                if starttls:
+                    domain_cache.set_starttls(domain_str, any(starttls))
+
+        if deferral is None:
+            probe = probe_results.get(rand_email)
+            if catch_all or probe is None or probe.verdict != TEMPORARY:
+                break
+            deferral = SMTPTemporaryError(
+                error_messages={
+                    probe.mx: SMTPMessage(
+                        command="RCPT TO", code=probe.code, text=probe.text, exceptions=()
+                    )
+                }
+            )
+        attempt += 1
+        reason = " ".join(str(message.text) for message in deferral.error_messages.values())
+        if retry_policy is None or attempt > retry_policy.max_attempts:
+            logger.error("Domain %s deferred the Catch-All probe: %s", domain_str, reason)
+            # A deferred RCPT isn't cached: the domain may well accept all emails once
+            # the deferral is over
+            if domain_cache and refused:
+                domain_cache.set_temporary_errors(domain_str, deferral.error_messages)
+            raise deferral
+        delay = retry_policy.delay(attempt, reason)
+        logger.debug(
+            "Domain %s deferred the Catch-All probe, retrying in %.0fs.", domain_str, delay
+        )
+        # Greylisting expects the same sender and recipient again
+        await trio.sleep(delay)
+
+    if domain_cache:
+        if facts and facts.temporary_errors:
+            # Answered since
+            domain_cache.set_temporary_errors(domain_str, {})
+        domain_cache.set_catch_all(domain_str, bool(catch_all))
+    if catch_all:
         logger.error(
-            f"Domain {domain_str} is accepting all emails, no way of knowing what emails exist."
+            "Domain %s is accepting all emails, no way of knowing what emails exist.", domain_str
         )
         raise SMTPCatchAll(domain_str)
 
-    final_results = set()
-
-    count = 1
-    with open(names_file, "r", encoding="utf-8") as file:
+    return mx_records_resolved
 
-        async with trio.open_nursery() as parent_nursery:
-            # Read file line by line
-            while True:
-                line = file.readline()
 
-                # EOF
-                if not line:
-                    break
+async def _resolve_domain(
+    domain_str: str, dns_resolver: AsyncResolver
+) -> Tuple[List[str], List[str], bool]:
+    """
+    Query the MX records of the domain, and resolve all the exchange
+    servers concurrently.
 
-                # Input name validation
-                if not hasattr(re.match(r"[A-Za-z]{2,}\,[A-Za-z]{2,}\s*$", line), "group"):
+    :returns: Tuple of the MX records and their IP addresses (empty lists
+              if none), both in order of MX preference, and whether every
+              lookup got an answer.
 
-                    # Log wrong entries, deducting new lines
-                    logging.error(
-                        f"Line: {count} | Name format is not aligned '{line[:-1]}', should be 'first,last' AND len(first/last) >= 2."
-                    )
-                    count += 1
-                    continue
-
-                split = line.split(",")
-                p = Person(split[0].rstrip(), split[1].rstrip())
-                logger.debug(f"Generated Person {p}.")
-
-                parent_nursery.start_soon(
-                    partial(
-                        smtp_check,
-                        email_addresses=[pre + "@" + domain_str for pre in p.enum_all()],
-                        mx_records=mx_records_resolved,
-                        timeout=smtp_timeout,
-                        from_address=mock_sender_email,
-                        final_results=final_results,
-                        entity=p,
-                        proxy_type=proxy_type,
-                        proxy_addr=proxy_addr,
-                        proxy_port=proxy_port,
-                        proxy_username=proxy_username,
-                        proxy_password=proxy_password,
-                    )
-                )
-                count += 1
+    :raises DNSLookupError: If the MX query failed, or those of all the
+                            exchange servers did.
+    """
+    mx_records = await query_mx(domain_str, dns_resolver)
+    if not mx_records:
+        return [], [], True
 
-        print("-------\nThe final emails list is:")
-        pprint.pprint(final_results)
+    mx_records_resolved = []
+    resolved = await dns_resolver.resolve_hosts(mx_records)
+    for rec in mx_records:
+        A_res = resolved.get(rec)
+        if A_res:
+            mx_records_resolved.extend(A_res)
+        elif rec in resolved:
+            logger.debug("No DNS translation for %s", rec)
+        else:
+            logger.debug("The DNS lookup of %s failed", rec)
+    if not resolved:
+        raise DNSLookupError(mx_records[0], "A")
+    return mx_records, mx_records_resolved, len(resolved) == len(mx_records)
 
 
-def query_mx(domain: str) -> List[str]:
+async def query_mx(domain: str, dns_resolver: AsyncResolver) -> List[str]:
     """
     DNS Query to find MX records of the provided domain name.
 
     :param domain: The domain name to be queried
+    :param dns_resolver: The (caching) resolver to query with
 
     :returns: List[str] of the resulted exchange servers, None if no server was found.
     """
-    my_resolver = Resolver()
-    my_resolver.nameservers = ["8.8.8.8", "1.1.1.1"]
-    try:
-        mx_record = my_resolver.resolve(domain, "MX")
-        mail_exchangers = [exchange.to_text().split()[-1] for exchange in mx_record]
-        logger.debug(
-            f"Queried {domain} ('MX') successfully. Resulted in {len(mail_exchangers)} records."
-        )
-        return mail_exchangers
-    except (resolver.NoAnswer, resolver.NXDOMAIN, resolver.NoNameservers):
-        logger.error(f"Error during querying DNS type MX {domain}")
-        return None
+    return await dns_resolver.query_mx(domain)
 
 
-def query_A(domain: str) -> List[str]:
+async def query_A(domain: str, dns_resolver: AsyncResolver) -> List[str]:
     """
-    DNS Query to find A records of the provided domain name.
+    DNS Query to find A (and AAAA) records of the provided domain name.
 
     :param domain: The domain name to be queried
+    :param dns_resolver: The (caching) resolver to query with
 
     :returns: List[str] of the resulted IP addresses , None if no IP address was found.
     """
-    my_resolver = Resolver()
-    my_resolver.nameservers = ["8.8.8.8", "1.1.1.1"]
-    final_IPs_list = set()
-    try:
-        results = my_resolver.resolve(domain, "A")
-        logger.debug(f"Queried {domain} ('A') successfully.")
-        for res in results:
-            logger.debug(f"Adding the exchange server IP '{res}' to list-to-check.")
-            final_IPs_list.add(res.to_text())
-        return list(final_IPs_list)
-
-    except (resolver.NoAnswer, resolver.NXDOMAIN, resolver.NoNameservers):
-        logger.error(f"Error during querying DNS type A {domain}")
-        return None
+    return await dns_resolver.query_addresses(domain)
 
 
 def random_email(domain: str) -> str:
@@ -188,15 +550,7 @@ def random_email(domain: str) -> str:
 
 
 if __name__ == "__main__":
-    trio.run(
-        partial(
-            main,
-            domain_str=DOMAIN_STR,
-            names_file=NAMES_FILE,
-            proxy_type=PROXY_TYPE,
-            proxy_addr=PROXY_ADDR,
-            proxy_port=PROXY_PORT,
-            proxy_username=PROXY_USERNAME,
-            proxy_password=PROXY_PASSWORD,
-        )
-    )
+    # The command line interface, see `cli.py`
+    from cli import run_cli
+
+    run_cli()
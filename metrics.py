@@ -0,0 +1,300 @@
+# External imports
+import bisect
+import math
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+import trio
+
+# Local imports
+from logging_mod import logging
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histograms' buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Metrics are only served to local clients unless told otherwise
+METRICS_HOST = "127.0.0.1"
+
+
+class _Metric:
+    "A family of metrics of one name, one value per combination of labels."
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    "Cumulative bucket counts, sum and count of observed values, like Prometheus'."
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Per-bucket counts (the last one for +Inf), sum
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, key: Tuple[str, ...]) -> int:
+        return sum(self.values[key][0])
+
+    def quantile(self, key: Tuple[str, ...], q: float) -> float:
+        "Estimate a quantile as the upper bound of the bucket it falls in."
+        counts = self.values[key][0]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{float(bound)!r}"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    "Holds metric families, and renders them in the Prometheus text format."
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# The registry of the built-in metrics, shared by the whole process
+REGISTRY = Registry()
+
+DNS_QUERY_SECONDS = REGISTRY.histogram(
+    "email_validator_dns_query_seconds",
+    "Latency of the DNS queries sent (cache misses).",
+    ["rdtype", "outcome"],
+)
+DNS_CACHE_HITS = REGISTRY.counter(
+    "email_validator_dns_cache_hits_total", "DNS queries answered from the cache.", ["rdtype"]
+)
+SMTP_COMMAND_SECONDS = REGISTRY.histogram(
+    "email_validator_smtp_command_seconds",
+    "Latency of the SMTP stages (connect, starttls, ehlo, mail, rcpt) until their reply.",
+    ["command", "mx", "proxy"],
+)
+SMTP_REPLIES = REGISTRY.counter(
+    "email_validator_smtp_replies_total",
+    "SMTP replies received, by reply code.",
+    ["command", "mx", "proxy", "code"],
+)
+SMTP_ERRORS = REGISTRY.counter(
+    "email_validator_smtp_errors_total",
+    "SMTP stages which failed without a reply (disconnects, timeouts, TLS failures).",
+    ["command", "mx", "proxy"],
+)
+SESSIONS_IN_USE = REGISTRY.gauge(
+    "email_validator_smtp_sessions_in_use", "Pooled SMTP sessions checked out.", ["mx", "proxy"]
+)
+RCPT_DEDUPLICATED = REGISTRY.counter(
+    "email_validator_rcpt_deduplicated_total",
+    "RCPTs not sent, the address being settled or probed already in this run.",
+    ["source"],
+)
+TASKS_IN_FLIGHT = REGISTRY.gauge(
+    "email_validator_tasks_in_flight", "Tasks currently running, by stage.", ["stage"]
+)
+
+
+class Exporter:
+    "Base class of the exporters, which run alongside the checks until cancelled."
+
+    def __init__(self, registry: Registry = REGISTRY):
+        self.registry = registry
+
+    async def run(self):
+        raise NotImplementedError
+
+
+class PrometheusExporter(Exporter):
+    """
+    Serves the metrics in the Prometheus text format over HTTP, on any
+    path. Only to local clients by default: the metrics name the MX
+    servers and proxies in use. An empty `host` listens on all interfaces.
+    """
+
+    def __init__(
+        self, port: int = 9464, host: str = METRICS_HOST, registry: Registry = REGISTRY
+    ):
+        super().__init__(registry)
+        self.port = port
+        self.host = host
+
+    async def _handle(self, stream: trio.SocketStream):
+        try:
+            with trio.move_on_after(5):
+                request = b""
+                while b"\r\n\r\n" not in request and len(request) < 8192:
+                    data = await stream.receive_some(4096)
+                    if not data:
+                        break
+                    request += data
+                body = self.registry.render().encode()
+                await stream.send_all(
+                    b"HTTP/1.0 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+        except trio.BrokenResourceError:
+            pass
+        finally:
+            await stream.aclose()
+
+    async def run(self):
+        logger.info("Serving metrics on %s:%d ...", self.host or "*", self.port)
+        await trio.serve_tcp(self._handle, self.port, host=self.host or None)
+
+
+class LogSummaryExporter(Exporter):
+    """
+    Logs a summary every `interval` seconds: tasks in flight, and the
+    slowest SMTP stages per MX and proxy (by p95 latency) with their
+    counts, so the limiting stage and server stand out.
+    """
+
+    def __init__(self, interval: float = 30, top: int = 5, registry: Registry = REGISTRY):
+        super().__init__(registry)
+        self.interval = interval
+        self.top = top
+
+    def summary(self) -> str:
+        lines = []
+        tasks = ", ".join(
+            f"{key[0]}={value:g}" for key, value in sorted(TASKS_IN_FLIGHT.values.items())
+        )
+        lines.append(f"Tasks in flight: {tasks or 'none'}")
+        stages = sorted(
+            SMTP_COMMAND_SECONDS.values,
+            key=lambda key: SMTP_COMMAND_SECONDS.quantile(key, 0.95),
+            reverse=True,
+        )
+        for key in stages[: self.top]:
+            command, mx, proxy = key
+            errors = SMTP_ERRORS.values.get(key, 0)
+            lines.append(
+                f"  {command} @ {mx}{' via ' + proxy if proxy else ''}: "
+                f"{SMTP_COMMAND_SECONDS.count(key)} done, {errors:g} failed, "
+                f"p50 <= {SMTP_COMMAND_SECONDS.quantile(key, 0.5)}s, "
+                f"p95 <= {SMTP_COMMAND_SECONDS.quantile(key, 0.95)}s"
+            )
+        dns_queries = sum(DNS_QUERY_SECONDS.count(key) for key in DNS_QUERY_SECONDS.values)
+        dns_hits = sum(DNS_CACHE_HITS.values.values())
+        lines.append(f"DNS: {dns_queries} queries, {dns_hits:g} cache hits")
+        return "\n".join(lines)
+
+    async def run(self):
+        while True:
+            await trio.sleep(self.interval)
+            logger.info("Metrics summary:\n%s", self.summary())
+
+
+@asynccontextmanager
+async def run_exporters(exporters: Sequence[Exporter]) -> AsyncIterator[None]:
+    "Run the `exporters` in the background for the duration of the block."
+    async with trio.open_nursery() as nursery:
+        for exporter in exporters:
+            nursery.start_soon(exporter.run)
+        yield
+        nursery.cancel_scope.cancel()
+
+
+def make_exporters(
+    metrics_port: Optional[int] = None,
+    metrics_log_interval: Optional[float] = None,
+    metrics_host: str = METRICS_HOST,
+) -> List[Exporter]:
+    "The exporters enabled by the arguments of the entry points."
+    exporters = []
+    if metrics_port:
+        exporters.append(PrometheusExporter(port=metrics_port, host=metrics_host))
+    if metrics_log_interval:
+        exporters.append(LogSummaryExporter(interval=metrics_log_interval))
+    return exporters
@@ -0,0 +1,352 @@
+# External imports
+import json
+import re
+import unicodedata
+from functools import lru_cache
+from operator import itemgetter
+from string import Formatter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Local imports
+from logging_mod import logging
+
+logger = logging.getLogger(__name__)
+
+# The patterns the candidates were originally generated with, in the same order
+DEFAULT_TEMPLATES = (
+    "{first}",
+    "{f}{last}",
+    "{f2}{last}",
+    "{first}{l3}",
+    "{first}{last}",
+    "{last}{first}",
+    "{last}.{first}",
+    "{first}.{last}",
+)
+
+# Surname particles never used alone as a surname ("van der Berg")
+NAME_PARTICLES = frozenset(
+    "al bin da das de del della der di do dos du el la le st te ten ter van von y".split()
+)
+
+# "{first}", "{last}", "{f}"/"{l}" (initial) and "{f3}"/"{l3}" (first N letters)
+_FIELD_RE = re.compile(r"(first|last|f|l)(\d*)$")
+_LITERAL_RE = re.compile(r"[a-z0-9._-]*$")
+_NAME_SPLIT_RE = re.compile(r"[\s-]+")
+_NAME_DROP_RE = re.compile(r"[^a-z0-9]")
+
+
+class PatternError(ValueError):
+    "Raised for templates with unknown fields or characters."
+
+
+def _compile(templates: Iterable[str]) -> Callable[[str, str, str], Tuple[str, ...]]:
+    """
+    Compile the templates into a single function of (first, last,
+    suffix) returning all their local parts followed by the suffix, so
+    that expanding a name costs one call and a few string operations.
+
+    The fields of all the templates (e.g. "f2", the first two letters of
+    the first name) are computed once per name, into a list of values
+    followed by the literals of the templates and the suffix. Each
+    template is an `itemgetter` of its components in that list, which
+    are joined.
+    """
+    # The fields, as (index in (first, last), length or None for all)
+    fields: Dict[str, Tuple[int, Optional[int]]] = {}
+    literals: Dict[str, None] = {}
+    # The components of each template, as ("field", name) or ("literal", text)
+    parsed = []
+    for template in templates:
+        components = []
+        for literal, field, spec, conversion in Formatter().parse(template):
+            if literal:
+                if not _LITERAL_RE.match(literal):
+                    raise PatternError(f"Invalid characters {literal!r} in template {template!r}")
+                literals[literal] = None
+                components.append(("literal", literal))
+            if field is None:
+                continue
+            match = _FIELD_RE.match(field)
+            if spec or conversion or not match:
+                raise PatternError(f"Unknown field {field!r} in template {template!r}")
+            name, length = match.groups()
+            if name in ("first", "last") and length:
+                raise PatternError(f"Unknown field {field!r} in template {template!r}")
+            index = 0 if name.startswith("f") else 1
+            fields[field] = (index, None if name in ("first", "last") else int(length or 1))
+            components.append(("field", field))
+        if not components:
+            raise PatternError(f"Empty template {template!r}")
+        if template.startswith(".") or template.endswith("."):
+            raise PatternError(f"Template {template!r} starts or ends with a dot")
+        parsed.append(components)
+
+    slices = tuple(fields.values())
+    constants = list(literals)
+    positions = {("field", field): position for position, field in enumerate(fields)}
+    positions.update(
+        {("literal", literal): len(fields) + position for position, literal in enumerate(literals)}
+    )
+    suffix_position = len(fields) + len(literals)
+    getters = [
+        itemgetter(*[positions[component] for component in components], suffix_position)
+        for components in parsed
+    ]
+
+    def expand(first: str, last: str, suffix: str) -> Tuple[str, ...]:
+        names = (first, last)
+        values = [names[index][:length] for index, length in slices]
+        values += constants
+        values.append(suffix)
+        return tuple(["".join(getter(values)) for getter in getters])
+
+    return expand
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name: str) -> Tuple[str, ...]:
+    """
+    Normalize a first or last name into the forms found in email
+    addresses: lower case ASCII, without diacritics, apostrophes and
+    the like.
+
+    :returns: Tuple[str, ...] of the name parts, split on hyphens and spaces.
+    """
+    # Fast path for the common case
+    if name.isascii() and name.isalpha():
+        return (name.lower(),)
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    ascii_name = "".join(char for char in decomposed if not unicodedata.combining(char))
+    parts = (_NAME_DROP_RE.sub("", part) for part in _NAME_SPLIT_RE.split(ascii_name))
+    return tuple(part for part in parts if part)
+
+
+@lru_cache(maxsize=65536)
+def name_variants(parts: Tuple[str, ...], surname: bool = False) -> Tuple[str, ...]:
+    """
+    The forms of a multi-part name to generate candidates with: the
+    parts joined ("garcialopez"), then its first and, for surnames, its
+    last meaningful part ("garcia", "lopez").
+    """
+    variants = ["".join(parts)]
+    if len(parts) > 1:
+        meaningful = [part for part in parts if part not in NAME_PARTICLES] or list(parts)
+        variants.append(meaningful[0])
+        if surname:
+            variants.append(meaningful[-1])
+    return tuple(dict.fromkeys(variant for variant in variants if variant))
+
+
+class PatternEngine:
+    """
+    Generates the candidate local parts of Persons from templates such
+    as `{f}{last}`, `{first}.{last}` or `{first}{l3}`.
+
+    Names are normalized first (see `normalize_name`). With
+    `split_compound`, the templates are also applied to the separate
+    parts of multi-part names (see `name_variants`). The candidates of a
+    Person are deduplicated, in template order.
+    """
+
+    def __init__(self, templates: Iterable[str] = DEFAULT_TEMPLATES, split_compound: bool = True):
+        self.templates = tuple(templates)
+        self.split_compound = split_compound
+        self._expand = _compile(self.templates)
+        # Shared by the candidates of all the Persons
+        self._singletons = {template: (template,) for template in self.templates}
+
+    def _name_pairs(self, first: str, last: str) -> List[Tuple[str, str]]:
+        "The (first, last) name forms to apply the templates to."
+        first_parts, last_parts = normalize_name(first), normalize_name(last)
+        if not first_parts or not last_parts:
+            return []
+        if self.split_compound:
+            firsts = name_variants(first_parts)
+            lasts = name_variants(last_parts, surname=True)
+        else:
+            firsts, lasts = ("".join(first_parts),), ("".join(last_parts),)
+        return [(first_variant, last_variant) for first_variant in firsts for last_variant in lasts]
+
+    def local_parts(self, first: str, last: str, suffix: str = "") -> List[str]:
+        "The candidate local parts of a name, each followed by `suffix`."
+        first_parts, last_parts = normalize_name(first), normalize_name(last)
+        # Fast path for the common case
+        if len(first_parts) == 1 and len(last_parts) == 1:
+            return list(dict.fromkeys(self._expand(first_parts[0], last_parts[0], suffix)))
+
+        candidates = {}
+        for first_variant, last_variant in self._name_pairs(first, last):
+            candidates.update(dict.fromkeys(self._expand(first_variant, last_variant, suffix)))
+        return list(candidates)
+
+    def templated(self, person, domain: str) -> Dict[str, Tuple[str, ...]]:
+        """
+        Like `addresses`, but map every candidate address to the
+        templates which generate it (several ones for short names).
+        """
+        suffix = "@" + domain
+        candidates = {}
+        for first_variant, last_variant in self._name_pairs(person.first, person.last):
+            for address, template in zip(
+                self._expand(first_variant, last_variant, suffix), self.templates
+            ):
+                templates = candidates.get(address)
+                if templates is None:
+                    candidates[address] = self._singletons[template]
+                elif template not in templates:
+                    candidates[address] = templates + (template,)
+        return candidates
+
+    def addresses(self, person, domain: str) -> List[str]:
+        "The candidate email addresses of `person` at `domain`."
+        return self.local_parts(person.first, person.last, "@" + domain)
+
+    def expand(self, persons: Iterable, domain: str) -> List[List[str]]:
+        "The candidate email addresses of each of `persons` at `domain`."
+        suffix = "@" + domain
+        local_parts = self.local_parts
+        return [local_parts(person.first, person.last, suffix) for person in persons]
+
+
+DEFAULT_ENGINE = PatternEngine()
+
+
+class PatternRanker:
+    """
+    Learns which templates yield deliverable addresses on one domain, to
+    probe the likely candidates first and stop early.
+
+    Every checked Person credits the templates of its deliverable
+    addresses. Once `min_samples` Persons were found and one template
+    covers at least `confidence` of them, the naming convention of the
+    domain is considered known: candidates are probed in ranking order
+    and the probing stops at the first hit. Trailing-digit variants are
+    then only probed if at least `digit_min_ratio` of them were hits.
+    Every `explore_every`-th Person is still fully probed, so the
+    ranking keeps learning.
+    """
+
+    def __init__(
+        self,
+        min_samples: int = 5,
+        confidence: float = 0.8,
+        explore_every: int = 20,
+        digit_min_ratio: float = 0.05,
+    ):
+        self.min_samples = min_samples
+        self.confidence = confidence
+        self.explore_every = explore_every
+        self.digit_min_ratio = digit_min_ratio
+
+        self.hits: Dict[str, int] = {}
+        self.persons = 0
+        self.found = 0
+        self.digit_probes = 0
+        self.digit_hits = 0
+        self._planned = 0
+
+    def score(self, templates: Iterable[str]) -> int:
+        return max((self.hits.get(template, 0) for template in templates), default=0)
+
+    @property
+    def confident(self) -> bool:
+        return (
+            self.found >= self.min_samples
+            and self.score(self.hits) >= self.confidence * self.found
+        )
+
+    def rank(self, addresses: List[str], candidates: Dict[str, Tuple[str, ...]]) -> List[str]:
+        "Sort `addresses` by the ranking of their templates (see `PatternEngine.templated`)."
+        return sorted(addresses, key=lambda address: -self.score(candidates.get(address, ())))
+
+    def plan(self) -> Tuple[bool, bool]:
+        """
+        How to probe the next Person.
+
+        :returns: Tuple[bool, bool] of whether to stop at the first hit,
+                  and whether to probe the trailing-digit variants.
+        """
+        self._planned += 1
+        if not self.confident or self._planned % self.explore_every == 0:
+            return False, True
+        digit_ratio = self.digit_hits / self.digit_probes if self.digit_probes else 0
+        return True, digit_ratio >= self.digit_min_ratio
+
+    def record(
+        self,
+        candidates: Dict[str, Tuple[str, ...]],
+        probed: Iterable[str],
+        deliverable: Iterable[str],
+    ):
+        """
+        Learn from the check of a Person: its `candidates`, the addresses
+        actually `probed` and the `deliverable` ones. Addresses which
+        aren't candidates are trailing-digit variants.
+        """
+        deliverable = set(deliverable)
+        self.persons += 1
+        if deliverable:
+            self.found += 1
+        credited = set()
+        for address in deliverable:
+            credited.update(candidates.get(address, ()))
+        for template in credited:
+            self.hits[template] = self.hits.get(template, 0) + 1
+        self.digit_probes += sum(1 for address in probed if address not in candidates)
+        self.digit_hits += sum(1 for address in deliverable if address not in candidates)
+
+    def to_dict(self) -> dict:
+        return dict(
+            hits=self.hits,
+            persons=self.persons,
+            found=self.found,
+            digit_probes=self.digit_probes,
+            digit_hits=self.digit_hits,
+        )
+
+    def load(self, stats: dict):
+        "Resume from the statistics of `to_dict`."
+        self.hits = dict(stats.get("hits", {}))
+        self.persons = stats.get("persons", 0)
+        self.found = stats.get("found", 0)
+        self.digit_probes = stats.get("digit_probes", 0)
+        self.digit_hits = stats.get("digit_hits", 0)
+
+
+class DomainPatterns:
+    """
+    The `PatternEngine` of each domain: domains listed in
+    `domain_templates` get their own templates, the others use
+    `default` (or `DEFAULT_TEMPLATES`). The "*" key sets the default.
+
+    It also holds the `PatternRanker` of each domain, created with the
+    `ranker_kwargs`.
+    """
+
+    def __init__(self, domain_templates: Optional[Dict[str, List[str]]] = None, **ranker_kwargs):
+        self._ranker_kwargs = ranker_kwargs
+        self.rankers: Dict[str, PatternRanker] = {}
+        domain_templates = dict(domain_templates or {})
+        default = domain_templates.pop("*", None)
+        self.default = PatternEngine(default) if default else DEFAULT_ENGINE
+        self.engines = {
+            domain.lower(): PatternEngine(templates)
+            for domain, templates in domain_templates.items()
+        }
+
+    @classmethod
+    def from_file(cls, path: str) -> "DomainPatterns":
+        "Load a JSON file mapping domain names (or '*') to lists of templates."
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(json.load(file))
+
+    def get(self, domain: str) -> PatternEngine:
+        return self.engines.get(domain.lower(), self.default)
+
+    def ranker(self, domain: str) -> PatternRanker:
+        domain = domain.lower()
+        if domain not in self.rankers:
+            self.rankers[domain] = PatternRanker(**self._ranker_kwargs)
+        return self.rankers[domain]
+
@@ -0,0 +1,98 @@
+# External imports
+import re
+from typing import Awaitable, Callable, Optional
+import trio
+
+# Local imports
+from logging_mod import logging
+from person import Person
+
+logger = logging.getLogger(__name__)
+
+# A first or last name: letters (any script), possibly with single
+# hyphens, apostrophes, dots or spaces between them ("García-López",
+# "O'Brien", "van der Berg")
+NAME_PATTERN = r"[^\W\d_](?:[^\W\d_]|['’. -](?=[^\W\d_]))+"
+NAME_LINE_RE = re.compile(rf"{NAME_PATTERN},{NAME_PATTERN}\s*$")
+
+# Size hint of the chunks of lines read from the input at once
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def parse_name_line(line: str, count: int) -> Optional[Person]:
+    """
+    Parse a "first,last" input line.
+
+    :param line: The raw input line
+    :param count: The line number, for error messages
+
+    :returns: The Person, None (after logging it) if the line is malformed.
+    """
+    # Input name validation
+    if not NAME_LINE_RE.match(line):
+        # Log wrong entries, deducting new lines
+        logger.error(
+            "Line: %d | Name format is not aligned '%s', should be 'first,last' "
+            "AND len(first/last) >= 2.",
+            count,
+            line.rstrip(),
+        )
+        return None
+
+    split = line.split(",")
+    return Person(split[0].rstrip(), split[1].rstrip())
+
+
+async def read_persons(names_file: str, send_channel: trio.MemorySendChannel):
+    """
+    Stream the Persons of a "first,last" names file into `send_channel`,
+    closing it at EOF. Lines are read in chunks in a worker thread, and
+    sending blocks while the channel is full, so a slow consumer stops
+    the reading instead of piling Persons up in memory.
+    """
+    async with send_channel:
+        async with await trio.open_file(names_file, "r", encoding="utf-8") as file:
+            count = 0
+            while True:
+                lines = await file.readlines(READ_CHUNK_SIZE)
+                # EOF
+                if not lines:
+                    break
+                for line in lines:
+                    count += 1
+                    person = parse_name_line(line, count)
+                    if person is not None:
+                        logger.debug("Generated Person %s.", person)
+                        await send_channel.send(person)
+
+
+async def _consume(
+    receive_channel: trio.MemoryReceiveChannel, worker: Callable[[Person], Awaitable]
+):
+    async with receive_channel:
+        async for person in receive_channel:
+            await worker(person)
+
+
+async def process_names_file(
+    names_file: str,
+    worker: Callable[[Person], Awaitable],
+    workers: int = 100,
+    buffer_size: Optional[int] = None,
+):
+    """
+    Run `worker` on every Person of the names file with a fixed pool of
+    `workers` tasks, fed by a bounded memory channel of `buffer_size`
+    Persons (default: `workers`).
+
+    The number of tasks, buffered Persons and hence open connections is
+    constant, whatever the size of the input.
+    """
+    send_channel, receive_channel = trio.open_memory_channel(
+        workers if buffer_size is None else buffer_size
+    )
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(read_persons, names_file, send_channel)
+        async with receive_channel:
+            for _ in range(workers):
+                nursery.start_soon(_consume, receive_channel.clone(), worker)
@@ -0,0 +1,281 @@
+# External imports
+import itertools
+import socket
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import unquote, urlsplit
+import socks
+import trio
+
+# Local imports
+from exceptions import UnknownProxyError
+from logging_mod import logging
+from smtp_client import PROXY_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Proxy selection strategies of `ProxyPool`
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+
+class Proxy:
+    """
+    A SOCKS4/5 egress proxy and its health.
+
+    Each connection attempt through the proxy is recorded: successes
+    feed a moving average of the connect latency, failures of the proxy
+    itself a counter of consecutive failures. After `failure_threshold` of them the proxy
+    is ejected for `ejection_time` seconds (doubled on every ejection in
+    a row, up to `max_ejection_time`), then given another chance.
+
+    With `max_connections`, at most that many sessions work through the
+    proxy at a time, whatever their MX.
+    """
+
+    def __init__(
+        self,
+        proxy_type: str,
+        addr: str,
+        port: int,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        rdns: bool = True,
+        max_connections: Optional[int] = None,
+        failure_threshold: int = 3,
+        ejection_time: float = 60,
+        max_ejection_time: float = 15 * 60,
+    ):
+        if proxy_type.lower() not in PROXY_TYPES:
+            raise UnknownProxyError(proxy_type)
+        self.proxy_type = proxy_type.lower()
+        self.addr = addr
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.rdns = rdns
+        self.max_connections = max_connections
+        self.failure_threshold = failure_threshold
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+
+        self.in_use = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        # Exponentially weighted moving average of the connect latency
+        self.latency = None
+        self.ejected_until = None
+        self._lot = trio.lowlevel.ParkingLot()
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "Proxy":
+        "Parse a `socks5://[user:password@]host:port` URL."
+        parts = urlsplit(url.strip())
+        if not parts.hostname or not parts.port:
+            raise ValueError(f"Invalid proxy URL {url!r}")
+        return cls(
+            proxy_type=parts.scheme,
+            addr=parts.hostname,
+            port=parts.port,
+            username=unquote(parts.username) if parts.username else None,
+            password=unquote(parts.password) if parts.password else None,
+            **kwargs,
+        )
+
+    def __str__(self):
+        return f"{self.proxy_type}://{self.addr}:{self.port}"
+
+    @property
+    def key(self) -> tuple:
+        return (self.proxy_type, self.addr, self.port)
+
+    @property
+    def client_kwargs(self) -> dict:
+        "The proxy arguments of `SMTPClient`."
+        return dict(
+            proxy_type=self.proxy_type,
+            proxy_addr=self.addr,
+            proxy_port=self.port,
+            proxy_rdns=self.rdns,
+            proxy_username=self.username,
+            proxy_password=self.password,
+        )
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until is None or trio.current_time() >= self.ejected_until
+
+    @property
+    def load(self) -> float:
+        "The share of the connection limit in use (the number of sessions without a limit)."
+        return self.in_use / self.max_connections if self.max_connections else self.in_use
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        "Wait until fewer than `max_connections` sessions are working through the proxy."
+        while self.max_connections and self.in_use >= self.max_connections:
+            await self._lot.park()
+        self.in_use += 1
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            self._lot.unpark()
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+
+    def record_failure(self, exc: Exception):
+        """
+        Record a failed connection attempt through the proxy, if the
+        proxy is to blame: it couldn't be reached, or failed the SOCKS
+        negotiation. `exc` is the exception of the attempt, raised from
+        the `socks.ProxyError` in that case.
+
+        The MX being unreachable through the proxy (a SOCKS error reply),
+        or slow to answer, and failures once the proxy has connected to
+        the MX don't count.
+        """
+        cause = exc.__context__
+        if not isinstance(cause, socks.ProxyError) or isinstance(
+            cause, (socks.SOCKS4Error, socks.SOCKS5Error)
+        ):
+            return
+        if isinstance(cause, socks.GeneralProxyError) and isinstance(
+            cause.socket_err, socket.timeout
+        ):
+            # Waiting on the proxy's reply, which comes once the MX answers
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.eject()
+
+    def eject(self):
+        "Stop selecting the proxy for a while."
+        ejection_time = min(self.max_ejection_time, self.ejection_time * 2 ** self.ejections)
+        self.ejections += 1
+        self.consecutive_failures = 0
+        self.ejected_until = trio.current_time() + ejection_time
+        logger.warning("Proxy %s is failing, ejected for %.0fs.", self, ejection_time)
+
+
+def load_proxies(path: str, **proxy_kwargs) -> List[Proxy]:
+    """
+    Read a proxies file with a `socks5://[user:password@]host:port` URL
+    per line. Blank lines and lines starting with "#" are skipped.
+
+    :param proxy_kwargs: Extra arguments of every `Proxy`, e.g. `max_connections`
+
+    :returns: List[Proxy] of the proxies of the file.
+    """
+    proxies = []
+    with open(path, "r", encoding="utf-8") as file:
+        for count, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                proxies.append(Proxy.from_url(line, **proxy_kwargs))
+            except ValueError as exc:
+                logger.error("Line: %d | %s, skipping.", count, exc)
+    return proxies
+
+
+class ProxyPool:
+    """
+    A set of egress proxies to spread the sessions over.
+
+    Every MX host is assigned a proxy on first use, and keeps it as long
+    as it is healthy (sticky assignment): the MX then sees a consistent
+    client IP, which its rate limits and greylisting are based on, while
+    distinct MXs are spread over all the proxies. With `sticky=False` a
+    proxy is selected for every session instead.
+
+    The `strategy` picks the proxy of a new assignment: `ROUND_ROBIN`
+    cycles over the healthy proxies, `LEAST_LOADED` takes the one with
+    the fewest sessions in use (then fewest MXs, then lowest latency).
+    When all the proxies are ejected, the one back soonest is used.
+    """
+
+    def __init__(self, proxies: List[Proxy], strategy: str = LEAST_LOADED, sticky: bool = True):
+        if not proxies:
+            raise ValueError("A proxy pool needs at least one proxy")
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"Unknown proxy selection strategy {strategy!r}")
+        self.proxies = proxies
+        self.strategy = strategy
+        self.sticky = sticky
+        self.assignments: Dict[str, Proxy] = {}
+        self._cycle = itertools.cycle(proxies)
+
+    @classmethod
+    def from_file(
+        cls, path: str, strategy: str = LEAST_LOADED, sticky: bool = True, **proxy_kwargs
+    ) -> "ProxyPool":
+        return cls(load_proxies(path, **proxy_kwargs), strategy=strategy, sticky=sticky)
+
+    async def _check(self, proxy: Proxy, timeout: float):
+        started = trio.current_time()
+        try:
+            with trio.fail_after(timeout):
+                stream = await trio.open_tcp_stream(proxy.addr, proxy.port)
+        except (OSError, trio.TooSlowError) as exc:
+            logger.debug("Proxy %s is unreachable: %r", proxy, exc)
+            proxy.eject()
+            return
+        await stream.aclose()
+        proxy.record_success(trio.current_time() - started)
+
+    async def check_health(self, timeout: float = 5):
+        """
+        Connect to every proxy concurrently, ejecting the unreachable
+        ones right away instead of waiting for them to fail sessions.
+        """
+        async with trio.open_nursery() as nursery:
+            for proxy in self.proxies:
+                nursery.start_soon(self._check, proxy, timeout)
+        logger.debug(
+            "%d/%d proxies are healthy.",
+            sum(proxy.healthy for proxy in self.proxies),
+            len(self.proxies),
+        )
+
+    def _assigned(self, proxy: Proxy) -> int:
+        return sum(1 for assigned in self.assignments.values() if assigned is proxy)
+
+    def _pick(self) -> Proxy:
+        healthy = [proxy for proxy in self.proxies if proxy.healthy]
+        if not healthy:
+            proxy = min(self.proxies, key=lambda proxy: proxy.ejected_until)
+            logger.warning("All proxies are ejected, falling back to %s.", proxy)
+            return proxy
+        if self.strategy == ROUND_ROBIN:
+            while True:
+                proxy = next(self._cycle)
+                if proxy.healthy:
+                    return proxy
+        return min(
+            healthy,
+            key=lambda proxy: (
+                proxy.load,
+                self._assigned(proxy),
+                proxy.latency if proxy.latency is not None else 0,
+            ),
+        )
+
+    def select(self, host: str) -> Proxy:
+        "The proxy to reach `host` through."
+        if not self.sticky:
+            return self._pick()
+        proxy = self.assignments.get(host)
+        if proxy is None or not proxy.healthy:
+            proxy = self._pick()
+            logger.debug("Assigned proxy %s to %s.", proxy, host)
+            self.assignments[host] = proxy
+        return proxy
@@ -0,0 +1,139 @@
+# External imports
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, Iterable
+import trio
+
+# Local imports
+from logging_mod import logging
+
+logger = logging.getLogger(__name__)
+
+# Replies MX servers use to push back on a client sending too fast
+THROTTLE_CODES = (421, 450, 451)
+
+
+class HostRateLimiter:
+    """
+    Adaptive limits for one MX (as seen from one egress IP).
+
+    Two knobs follow an AIMD (additive increase, multiplicative
+    decrease) policy:
+    - `limit`, the number of sessions allowed to work concurrently,
+    - `rate`, the refill rate (per second) of a token bucket paying for
+      each batch of `RCPT TO` sent in a transaction (a single round trip
+      when pipelined), whatever its number of recipients.
+
+    Every healthy batch raises them a little (so the rate grows
+    exponentially while the MX keeps up); a throttling reply
+    (421/450/451) or a disconnect cuts them by `decrease_factor`, at
+    most once per `cooldown` seconds so a burst of errors from requests
+    already in flight counts as a single signal.
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = 2,
+        min_limit: float = 1,
+        max_limit: float = 20,
+        limit_increase: float = 0.1,
+        initial_rate: float = 20,
+        min_rate: float = 0.5,
+        max_rate: float = 1000,
+        rate_increase: float = 1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 5,
+    ):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit_increase = limit_increase
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        # Exponentially weighted moving average of the throttling replies
+        self.throttle_ratio = 0.0
+        self._tokens = 1.0
+        self._refilled_at = None
+        self._decreased_at = None
+        self._lot = trio.lowlevel.ParkingLot()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        "Wait until fewer than `limit` sessions are working on this MX."
+        while self.in_flight >= max(int(self.limit), 1):
+            await self._lot.park()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._lot.unpark()
+
+    async def take(self):
+        "Wait for a token of the bucket, i.e. the right to send one batch of commands."
+        while True:
+            now = trio.current_time()
+            if self._refilled_at is not None:
+                self._tokens = min(
+                    max(self.rate, 1.0), self._tokens + (now - self._refilled_at) * self.rate
+                )
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await trio.sleep((1 - self._tokens) / self.rate)
+
+    def record_success(self):
+        self.successes += 1
+        self.throttle_ratio *= 0.95
+        self.limit = min(self.max_limit, self.limit + self.limit_increase / self.limit)
+        self.rate = min(self.max_rate, self.rate + self.rate_increase)
+        # A raised limit may let parked sessions in
+        self._lot.unpark_all()
+
+    def record_throttle(self):
+        self.throttles += 1
+        self.throttle_ratio = self.throttle_ratio * 0.95 + 0.05
+        now = trio.current_time()
+        if self._decreased_at is not None and now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        logger.debug(
+            "Throttled, backing off to %.1f sessions and %.1f batches/s.", self.limit, self.rate
+        )
+
+    def record_reply(self, code: int):
+        "Feed the reply code of a command to the controller."
+        if code in THROTTLE_CODES:
+            self.record_throttle()
+        else:
+            self.record_success()
+
+    def record_replies(self, codes: Iterable[int]):
+        "Feed the reply codes of a batch of commands, as a single signal."
+        self.record_reply(next((code for code in codes if code in THROTTLE_CODES), 250))
+
+
+class RateController:
+    """
+    Holds one `HostRateLimiter` per key (MX IP and proxy), created on
+    first use with the keyword arguments given here.
+    """
+
+    def __init__(self, **limiter_kwargs):
+        self._limiter_kwargs = limiter_kwargs
+        self.limiters: Dict[Hashable, HostRateLimiter] = {}
+
+    def get(self, key: Hashable) -> HostRateLimiter:
+        if key not in self.limiters:
+            self.limiters[key] = HostRateLimiter(**self._limiter_kwargs)
+        return self.limiters[key]
@@ -0,0 +1,176 @@
+# External imports
+import csv
+import io
+import json
+import sys
+import time
+from typing import List, Optional
+import trio
+
+# Local imports
+from logging_mod import logging
+from results import AddressResult
+
+logger = logging.getLogger(__name__)
+
+JSONL = "jsonl"
+CSV = "csv"
+
+# The fields of every output record
+SINK_FIELDS = ["person", "address", "verdict", "mx", "code", "text", "latency", "checked_at"]
+
+
+class ResultSink:
+    """
+    Streams the verdict of every probed address to a file (or stdout for
+    the path "-") as it is produced, so downstream systems can consume
+    the results while the run goes on.
+
+    Records are buffered and written in bulk once `buffer_size` of them
+    are pending or `flush_interval` seconds passed since the last write,
+    so memory stays bounded whatever the size of the result set.
+
+    During a run, they're written in a worker thread by `run`, a
+    background task (see `sqlite_store.run_writers`), keeping the event
+    loop off the disk. Without it, `write` writes them synchronously.
+    `close` writes those left, and must be called in any case.
+
+    An address retried after a temporary outcome gets a new record; the
+    last record of an address is its final verdict.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1000, flush_interval: float = 1.0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._buffer: List[dict] = []
+        self._flushed_at = time.monotonic()
+        self._wakeup: Optional[trio.Event] = None
+        if path == "-":
+            self._file = sys.stdout
+        else:
+            self._file = open(path, "a", encoding="utf-8", newline="")
+        self._start()
+
+    def _start(self):
+        "Write whatever the format needs before the first record."
+
+    def _format(self, records: List[dict]) -> str:
+        raise NotImplementedError
+
+    def write(self, person, result: AddressResult):
+        "Queue the record of `result`, an address of `person`."
+        self._buffer.append(
+            {
+                "person": str(person),
+                "address": result.address,
+                "verdict": result.verdict,
+                "mx": result.mx,
+                "code": result.code,
+                "text": result.text,
+                "latency": round(result.latency, 4) if result.latency is not None else None,
+                "checked_at": result.checked_at,
+            }
+        )
+        if self._wakeup is not None:
+            # Written by `run`
+            if len(self._buffer) >= self.buffer_size:
+                self._wakeup.set()
+        elif (
+            len(self._buffer) >= self.buffer_size
+            or time.monotonic() - self._flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def _write_records(self, records: List[dict]):
+        self._file.write(self._format(records))
+        self._file.flush()
+
+    def flush(self):
+        "Write the pending records, blocking until done."
+        self._flushed_at = time.monotonic()
+        records, self._buffer = self._buffer, []
+        if records:
+            self._write_records(records)
+            self.written += len(records)
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        "Write the pending records in a worker thread as they come, until cancelled."
+        self._wakeup = trio.Event()
+        task_status.started()
+        try:
+            while True:
+                with trio.move_on_after(self.flush_interval):
+                    await self._wakeup.wait()
+                # Records filling the buffer meanwhile wake it up again
+                self._wakeup = trio.Event()
+                await self.aflush()
+        finally:
+            self._wakeup = None
+
+    async def aflush(self):
+        "Write the pending records in a worker thread."
+        records, self._buffer = self._buffer, []
+        if not records:
+            return
+        try:
+            await trio.to_thread.run_sync(self._write_records, records)
+        except trio.Cancelled:
+            # Cancelled before the thread started: the records are left for `close`
+            self._buffer[:0] = records
+            raise
+        self.written += len(records)
+
+    def close(self):
+        self.flush()
+        if self._file is not sys.stdout:
+            self._file.close()
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONLSink(ResultSink):
+    "A `ResultSink` writing a JSON object per line."
+
+    def _format(self, records: List[dict]) -> str:
+        return "".join(json.dumps(record) + "\n" for record in records)
+
+
+class CSVSink(ResultSink):
+    "A `ResultSink` writing CSV rows, with a header at the start of the file."
+
+    def _start(self):
+        # Appending to an existing file keeps its header
+        if self._file is sys.stdout or self._file.tell() == 0:
+            self._file.write(self._format([dict(zip(SINK_FIELDS, SINK_FIELDS))]))
+
+    def _format(self, records: List[dict]) -> str:
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=SINK_FIELDS, lineterminator="\n")
+        writer.writerows(records)
+        return output.getvalue()
+
+
+def sink_format(path: str, output_format: Optional[str] = None) -> str:
+    "The `output_format` of a sink, guessed from the extension of `path` if not given."
+    if output_format is None:
+        return CSV if path.lower().endswith(".csv") else JSONL
+    return output_format
+
+
+def open_sink(path: str, output_format: Optional[str] = None, **kwargs) -> ResultSink:
+    """
+    Open the `ResultSink` of `output_format` (`JSONL` or `CSV`), guessed
+    from the extension of `path` if not given (JSONL by default).
+    """
+    output_format = sink_format(path, output_format)
+    if output_format == CSV:
+        return CSVSink(path, **kwargs)
+    if output_format == JSONL:
+        return JSONLSink(path, **kwargs)
+    raise ValueError(f"Unknown output format {output_format!r}")
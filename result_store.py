@@ -0,0 +1,91 @@
+# External imports
+from typing import Dict, Iterable, List, Optional
+
+# Local imports
+from logging_mod import logging
+from results import AddressResult, SETTLED_VERDICTS
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    address TEXT PRIMARY KEY,
+    verdict TEXT NOT NULL,
+    mx TEXT,
+    code INTEGER,
+    text TEXT,
+    checked_at REAL NOT NULL
+)
+"""
+
+# SQLite's default limit of host parameters per statement is 999
+_MAX_PARAMS = 900
+
+
+class ResultStore(SQLiteStore):
+    """
+    An on-disk (SQLite) store of the verification result of every email
+    address, so a re-run only checks new addresses and those which had
+    no final verdict (temporary or unknown).
+
+    Results are written in the background during a run, see `SQLiteStore`.
+    """
+
+    def __init__(self, path: str = "results.sqlite3", **store_kwargs):
+        super().__init__(path, **store_kwargs)
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+
+    def get(self, address: str) -> Optional[AddressResult]:
+        return self.get_many([address]).get(address.lower())
+
+    def get_many(self, addresses: Iterable[str]) -> Dict[str, AddressResult]:
+        """
+        Return the stored results of the given addresses, keyed by the
+        lowercased address. Unknown addresses are absent.
+        """
+        keys = list({address.lower() for address in addresses})
+        found = {}
+        for start in range(0, len(keys), _MAX_PARAMS):
+            chunk = keys[start : start + _MAX_PARAMS]
+            rows = self._conn.execute(
+                "SELECT address, verdict, mx, code, text, checked_at FROM results "
+                f"WHERE address IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in rows:
+                found[row[0]] = AddressResult(*row)
+        return found
+
+    def settled(self, addresses: Iterable[str]) -> Dict[str, AddressResult]:
+        "Return the stored results of the given addresses which are final."
+        return {
+            address: result
+            for address, result in self.get_many(addresses).items()
+            if result.verdict in SETTLED_VERDICTS
+        }
+
+    def record_many(self, results: Iterable[AddressResult]):
+        "Save the given results, replacing older ones, in the same transaction."
+        rows: List[tuple] = [
+            (
+                result.address.lower(),
+                result.verdict,
+                result.mx,
+                result.code,
+                result.text,
+                result.checked_at,
+            )
+            for result in results
+        ]
+        if not rows:
+            return
+        self._write(
+            "INSERT OR REPLACE INTO results (address, verdict, mx, code, text, checked_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def record(self, result: AddressResult):
+        self.record_many([result])
@@ -0,0 +1,149 @@
+# External imports
+import math
+from array import array
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional
+
+DELIVERABLE = "deliverable"
+UNDELIVERABLE = "undeliverable"
+TEMPORARY = "temporary"
+UNKNOWN = "unknown"
+# Not checked within the time budget, see `Deadlines`
+TIMED_OUT = "timed_out"
+
+# Verdicts that won't change when asking again
+SETTLED_VERDICTS = (DELIVERABLE, UNDELIVERABLE)
+
+# `latency` is the round trip of the RCPT (batch) which got the verdict
+AddressResult = namedtuple(
+    typename="AddressResult",
+    field_names=["address", "verdict", "mx", "code", "text", "checked_at", "latency"],
+    defaults=[None],
+)
+
+# The outcome of the check of one Person's candidate addresses.
+# `error` is the exception which interrupted it, if any, and
+# `error_messages` the `SMTPMessage` per MX host it carried.
+PersonResult = namedtuple(
+    typename="PersonResult",
+    field_names=["person", "addresses", "deliverable", "error", "error_messages"],
+)
+
+
+def verdict_for_code(code: int, deliverable: bool) -> str:
+    """
+    Classify the reply to `RCPT TO` of an address.
+
+    :param code: The SMTP reply code
+    :param deliverable: Whether the code was accepted as deliverable
+
+    :returns: One of the verdict constants of this module.
+    """
+    if deliverable:
+        return DELIVERABLE
+    if 500 <= code < 600:
+        return UNDELIVERABLE
+    if 400 <= code < 500:
+        return TEMPORARY
+    return UNKNOWN
+
+
+# `ResultTable`'s stand-in for a missing SMTP code
+_NO_CODE = -(2**15)
+
+
+class ResultTable:
+    """
+    A compact mapping of addresses to their `AddressResult`, for the
+    millions of results of a large run.
+
+    The fields are stored in columns: numbers in arrays, and the few
+    distinct verdicts and MX hosts once each, referenced by index. Equal
+    reply texts share one string while fewer than `max_shared_texts`
+    distinct ones were seen. A row costs little more than its address
+    and dict slot; the `AddressResult`s are rebuilt when read.
+    """
+
+    def __init__(self, max_shared_texts: int = 4096):
+        self.max_shared_texts = max_shared_texts
+        self._rows: Dict[str, int] = {}
+        self._labels: List[Optional[str]] = []
+        self._label_ids: Dict[Optional[str], int] = {}
+        self._verdicts = array("I")
+        self._mxs = array("I")
+        self._codes = array("h")
+        self._checked_at = array("d")
+        self._latencies = array("d")
+        self._texts: List[str] = []
+        self._shared_texts: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, address: str) -> bool:
+        return address in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def _label(self, value: Optional[str]) -> int:
+        label = self._label_ids.get(value)
+        if label is None:
+            label = self._label_ids[value] = len(self._labels)
+            self._labels.append(value)
+        return label
+
+    def _text(self, text: str) -> str:
+        shared = self._shared_texts.get(text)
+        if shared is not None:
+            return shared
+        if len(self._shared_texts) < self.max_shared_texts:
+            self._shared_texts[text] = text
+        return text
+
+    def add(self, result: AddressResult, address: Optional[str] = None):
+        "Store `result` under `address` (by default its own), replacing any previous one."
+        address = result.address if address is None else address
+        columns = (
+            self._label(result.verdict),
+            self._label(result.mx),
+            _NO_CODE if result.code is None else result.code,
+            math.nan if result.checked_at is None else result.checked_at,
+            math.nan if result.latency is None else result.latency,
+            self._text(result.text),
+        )
+        row = self._rows.get(address)
+        if row is None:
+            self._rows[address] = len(self._texts)
+            self._verdicts.append(columns[0])
+            self._mxs.append(columns[1])
+            self._codes.append(columns[2])
+            self._checked_at.append(columns[3])
+            self._latencies.append(columns[4])
+            self._texts.append(columns[5])
+        else:
+            (
+                self._verdicts[row],
+                self._mxs[row],
+                self._codes[row],
+                self._checked_at[row],
+                self._latencies[row],
+                self._texts[row],
+            ) = columns
+
+    def get(self, address: str) -> Optional[AddressResult]:
+        row = self._rows.get(address)
+        if row is None:
+            return None
+        code = self._codes[row]
+        checked_at = self._checked_at[row]
+        latency = self._latencies[row]
+        return AddressResult(
+            address=address,
+            verdict=self._labels[self._verdicts[row]],
+            mx=self._labels[self._mxs[row]],
+            code=None if code == _NO_CODE else code,
+            text=self._texts[row],
+            checked_at=None if math.isnan(checked_at) else checked_at,
+            latency=None if math.isnan(latency) else latency,
+        )
@@ -0,0 +1,151 @@
+# External imports
+import heapq
+import itertools
+import math
+import random
+from typing import Any, Awaitable, Callable, List, Tuple
+import trio
+
+# Local imports
+from logging_mod import logging
+
+logger = logging.getLogger(__name__)
+
+# Words MX servers use in their replies when greylisting
+GREYLISTING_HINTS = ("greylist", "graylist", "grey-list", "gray-list", "try again later")
+
+
+class RetryPolicy:
+    """
+    When to retry an address after a temporary (4xx) outcome.
+
+    The n-th retry waits `initial_delay * multiplier ** (n - 1)` seconds,
+    capped at `max_delay`, give or take `jitter` (a ratio). Greylisting
+    servers only accept a retry after a few minutes, so when the reply
+    looks like greylisting the delay is at least `greylist_delay`.
+    After `max_attempts` retries the outcome stays temporary.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = 60,
+        multiplier: float = 2,
+        max_delay: float = 15 * 60,
+        greylist_delay: float = 5 * 60,
+        max_attempts: int = 4,
+        jitter: float = 0.1,
+    ):
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.greylist_delay = greylist_delay
+        self.max_attempts = max_attempts
+        self.jitter = jitter
+
+    def delay(self, attempt: int, reason: str = "") -> float:
+        """
+        :param attempt: The number of the retry, starting at 1
+        :param reason: The text of the temporary reply, if any
+
+        :returns: The number of seconds to wait before the retry.
+        """
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** (attempt - 1))
+        if any(hint in reason.lower() for hint in GREYLISTING_HINTS):
+            delay = max(delay, self.greylist_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RetryQueue:
+    """
+    A queue of work items to retry later, drained by `run` while the
+    rest of the work goes on.
+
+    Items are scheduled with `schedule`, and run by the `worker` given to
+    `run` once due, at most `max_concurrency` at a time. The worker may
+    schedule the item again for a further attempt. `run` returns after
+    `close` was called and no item is left, either queued or running.
+
+    Items which would be due after the `deadline` (on the trio clock)
+    aren't scheduled, so the queue drains by then.
+    """
+
+    def __init__(
+        self, policy: RetryPolicy = None, max_concurrency: int = 10, deadline: float = math.inf
+    ):
+        self.policy = policy or RetryPolicy()
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self._heap: List[Tuple[float, int, Any, int]] = []
+        self._counter = itertools.count()
+        self._wakeup = trio.Event()
+        self._closed = False
+        self._running = 0
+
+    @property
+    def pending(self) -> int:
+        "The number of items queued or running."
+        return len(self._heap) + self._running
+
+    def schedule(self, item: Any, attempt: int, reason: str = "") -> bool:
+        """
+        Queue `item` for its `attempt`-th retry (starting at 1).
+
+        :returns: False if the policy allows no more attempts, or the
+                  retry would be due past the deadline.
+        """
+        if attempt > self.policy.max_attempts:
+            logger.debug("Giving up after %d retries.", attempt - 1)
+            return False
+        delay = self.policy.delay(attempt, reason)
+        if trio.current_time() + delay > self.deadline:
+            logger.debug("Giving up, retry %d would be past the deadline.", attempt)
+            return False
+        logger.debug("Retry %d scheduled in %.0fs.", attempt, delay)
+        due = trio.current_time() + delay
+        heapq.heappush(self._heap, (due, next(self._counter), item, attempt))
+        self._wakeup.set()
+        return True
+
+    def close(self):
+        "No new items will be scheduled, except by the retries themselves."
+        self._closed = True
+        self._wakeup.set()
+
+    async def _wait(self, deadline: float):
+        with trio.move_on_at(deadline):
+            await self._wakeup.wait()
+        if self._wakeup.is_set():
+            self._wakeup = trio.Event()
+
+    async def _run_one(
+        self,
+        worker: Callable[[Any, int], Awaitable],
+        item: Any,
+        attempt: int,
+        semaphore: trio.Semaphore,
+    ):
+        try:
+            await worker(item, attempt)
+        finally:
+            self._running -= 1
+            semaphore.release()
+            self._wakeup.set()
+
+    async def run(self, worker: Callable[[Any, int], Awaitable]):
+        "Run `worker(item, attempt)` for every item as it becomes due."
+        semaphore = trio.Semaphore(self.max_concurrency)
+        async with trio.open_nursery() as nursery:
+            while True:
+                if not self._heap:
+                    if self._closed and not self._running:
+                        break
+                    await self._wait(math.inf)
+                    continue
+                due = self._heap[0][0]
+                if due > trio.current_time():
+                    await self._wait(due)
+                    continue
+                await semaphore.acquire()
+                _, _, item, attempt = heapq.heappop(self._heap)
+                self._running += 1
+                nursery.start_soon(self._run_one, worker, item, attempt, semaphore)
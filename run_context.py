@@ -0,0 +1,221 @@
+# External imports
+import math
+import pprint
+from contextlib import asynccontextmanager
+from smtplib import SMTP_PORT
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+import trio
+
+# Local imports
+from deadlines import Deadlines
+from dns_resolver import DEFAULT_NAMESERVERS, AsyncResolver
+from domain_cache import DomainCache
+from logging_mod import logging
+from metrics import METRICS_HOST, make_exporters, run_exporters
+from patterns import DomainPatterns, PatternRanker
+from proxy_pool import LEAST_LOADED, ProxyPool
+from rate_limit import RateController
+from result_sink import ResultSink, open_sink
+from result_store import ResultStore
+from results import PersonResult
+from retry import RetryPolicy, RetryQueue
+from smtp_pool import SMTPPool
+from sqlite_store import run_writers
+
+logger = logging.getLogger(__name__)
+
+
+class RunContext:
+    """
+    What the checks of a run share (see `open_run`): the resolver, the
+    stores, the email patterns, the SMTP pool, the sink of the verdicts
+    and the queue of the retries, and the Persons which failed.
+    """
+
+    def __init__(
+        self,
+        dns_resolver: AsyncResolver,
+        domain_cache: Optional[DomainCache],
+        result_store: Optional[ResultStore],
+        domain_patterns: DomainPatterns,
+        learn_patterns: bool,
+        pool: SMTPPool,
+        result_sink: Optional[ResultSink],
+        retry_queue: Optional[RetryQueue],
+        deadlines: Deadlines,
+    ):
+        self.dns_resolver = dns_resolver
+        self.domain_cache = domain_cache
+        self.result_store = result_store
+        self.domain_patterns = domain_patterns
+        self.learn_patterns = learn_patterns
+        self.pool = pool
+        self.result_sink = result_sink
+        self.retry_queue = retry_queue
+        self.deadlines = deadlines
+        self.failures: List[PersonResult] = []
+
+    @property
+    def retry_policy(self) -> Optional[RetryPolicy]:
+        "When to retry temporary outcomes, None if they aren't."
+        return self.retry_queue.policy if self.retry_queue else None
+
+    def ranker(self, domain_str: str) -> Optional[PatternRanker]:
+        "The ranker learning the email patterns of the domain, resumed from the cache, if any."
+        if not self.learn_patterns:
+            return None
+        ranker = self.domain_patterns.ranker(domain_str)
+        stats = self.domain_cache.get_patterns(domain_str) if self.domain_cache else None
+        if stats:
+            ranker.load(stats)
+        return ranker
+
+    @asynccontextmanager
+    async def retrying(self, worker: Callable[..., Awaitable]) -> AsyncIterator[trio.Nursery]:
+        """
+        Retry the temporary outcomes with `worker` (see `RetryQueue.run`)
+        in the background of the block, and until they're all done.
+        Yields a nursery for the checks to start in.
+        """
+        async with trio.open_nursery() as nursery:
+            if self.retry_queue:
+                nursery.start_soon(self.retry_queue.run, worker)
+            yield nursery
+            if self.retry_queue:
+                self.retry_queue.close()
+
+    def save_patterns(self):
+        "Save what the rankers learned to the cache, if any."
+        if self.domain_cache:
+            for domain_str, ranker in self.domain_patterns.rankers.items():
+                self.domain_cache.set_patterns(domain_str, ranker.to_dict())
+
+    def report(self, final_results):
+        "Print the found email addresses, and the failures."
+        print("-------\nThe final emails list is:")
+        pprint.pprint(final_results)
+        if self.failures:
+            print(f"-------\n{len(self.failures)} entries could not be checked:")
+            pprint.pprint({str(failure.person): str(failure.error) for failure in self.failures})
+
+
+@asynccontextmanager
+async def open_run(
+    deadlines: Deadlines,
+    deadline: float = math.inf,
+    smtp_timeout: float = float(20),
+    smtp_port: int = SMTP_PORT,
+    mock_sender_email: str = "jim@gmail.com",
+    proxy_type: str = None,
+    proxy_addr: str = None,
+    proxy_port: str = None,
+    proxy_username: str = None,
+    proxy_password: str = None,
+    proxies_file: Optional[str] = None,
+    proxy_strategy: str = LEAST_LOADED,
+    proxy_max_connections: Optional[int] = None,
+    smtp_max_connections: int = 5,
+    max_concurrency: int = 100,
+    coalesce_window: Optional[float] = 0.05,
+    hedge_delay: Optional[float] = 0.3,
+    adaptive_rate: bool = True,
+    retry_temporary: bool = True,
+    dns_resolver: Optional[AsyncResolver] = None,
+    dns_nameservers: Optional[List[str]] = None,
+    dns_timeout: float = 5,
+    retry_policy: Optional[RetryPolicy] = None,
+    domain_cache_path: Optional[str] = None,
+    result_store_path: Optional[str] = None,
+    patterns_file: Optional[str] = None,
+    learn_patterns: bool = True,
+    output_file: Optional[str] = None,
+    output_format: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    metrics_log_interval: Optional[float] = None,
+    metrics_host: str = METRICS_HOST,
+) -> AsyncIterator[RunContext]:
+    """
+    Set up what the checks of a run share, from the arguments of `main`
+    and `main_batch`, and tear it down at the end of the block.
+
+    Writes to the stores and the sink are done in the background, and
+    the metrics exported, for the duration of the block. What was learned
+    of the email patterns is saved to the cache if the block succeeds;
+    the sink and the stores are closed in any case, writing what's left.
+
+    :param deadline: When the run must be over (trio clock), bounding the retries
+    :param proxy_max_connections: Sessions working through each proxy of the
+                                  `proxies_file` at a time, unbounded if None
+    """
+    if dns_resolver is None:
+        dns_resolver = AsyncResolver(
+            nameservers=dns_nameservers or DEFAULT_NAMESERVERS, timeout=dns_timeout
+        )
+    domain_cache = DomainCache(domain_cache_path) if domain_cache_path else None
+    result_store = ResultStore(result_store_path) if result_store_path else None
+    result_sink = None
+    try:
+        domain_patterns = (
+            DomainPatterns.from_file(patterns_file) if patterns_file else DomainPatterns()
+        )
+        retry_queue = (
+            RetryQueue(policy=retry_policy, max_concurrency=max_concurrency, deadline=deadline)
+            if retry_temporary
+            else None
+        )
+
+        # Egress proxies to spread the MX servers over, if any
+        proxy_pool = None
+        if proxies_file:
+            proxy_pool = ProxyPool.from_file(
+                proxies_file, strategy=proxy_strategy, max_connections=proxy_max_connections
+            )
+            await proxy_pool.check_health(timeout=smtp_timeout)
+
+        # Metrics are served and/or logged periodically while the checks run, if requested
+        exporters = make_exporters(metrics_port, metrics_log_interval, metrics_host)
+        # Verdicts are streamed out as they come, if requested
+        result_sink = open_sink(output_file, output_format) if output_file else None
+        # Writes to the stores and the sink are done in the background
+        writers = (domain_cache, result_store, result_sink)
+
+        # Sessions to the MX servers are shared by all the checks
+        async with run_exporters(exporters), run_writers(writers), SMTPPool(
+            sender=mock_sender_email,
+            port=smtp_port,
+            timeout=smtp_timeout,
+            max_connections=smtp_max_connections,
+            rate_controller=(
+                RateController(max_limit=smtp_max_connections) if adaptive_rate else None
+            ),
+            proxy_pool=proxy_pool,
+            proxy_type=proxy_type,
+            proxy_addr=proxy_addr,
+            proxy_port=proxy_port,
+            proxy_username=proxy_username,
+            proxy_password=proxy_password,
+            coalesce_window=coalesce_window,
+            hedge_delay=hedge_delay,
+            deadlines=deadlines,
+        ) as pool:
+            run = RunContext(
+                dns_resolver=dns_resolver,
+                domain_cache=domain_cache,
+                result_store=result_store,
+                domain_patterns=domain_patterns,
+                learn_patterns=learn_patterns,
+                pool=pool,
+                result_sink=result_sink,
+                retry_queue=retry_queue,
+                deadlines=deadlines,
+            )
+            yield run
+        run.save_patterns()
+    finally:
+        # Commits the writes left
+        if result_sink:
+            result_sink.close()
+        if domain_cache:
+            domain_cache.close()
+        if result_store:
+            result_store.close()
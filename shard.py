@@ -0,0 +1,489 @@
+# External imports
+import argparse
+import multiprocessing
+import os
+import pprint
+import queue
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from functools import partial
+from multiprocessing.managers import BaseManager
+from typing import Deque, Dict, List, Optional, Set, Tuple
+import trio
+
+# Local imports
+from batch import main_batch
+from domain_cache import DomainCache
+from logging_mod import configure_logging, logging
+from main import main
+from result_sink import CSV, sink_format
+from result_store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+# Input formats of the shards
+BATCH = "batch"  # "first,last,domain" lines, see `batch.main_batch`
+NAMES = "names"  # "first,last" lines of a single domain, see `main.main`
+
+DEFAULT_PORT = 50000
+
+# The files written by a run. Each shard writes its own (see `_run_shard`), merged by
+# the coordinator into those of the run.
+PER_SHARD_PATHS = ("output_file", "domain_cache_path", "result_store_path")
+# The stores among them, with the class opening them
+STORES = {"domain_cache_path": DomainCache, "result_store_path": ResultStore}
+
+
+class _Dispatcher:
+    """
+    Hands out the shards of a run to the workers, leasing each shard to
+    its worker until the result is in.
+
+    Workers renew their leases while they work (see `run_worker`). A
+    lease not renewed for `lease_time` seconds expires, its worker
+    presumed dead, and the shard is handed out again; only its first
+    result counts.
+
+    It lives in the process of the `_ShardManager`, which serves it to
+    the coordinator and the workers.
+    """
+
+    def __init__(self, lease_time: float, seeds: Dict[str, bytes]):
+        self.lease_time = lease_time
+        self._seeds = seeds
+        self._lock = threading.Lock()
+        self._queued: Deque[tuple] = deque()
+        self._leases: Dict[int, Tuple[float, tuple]] = {}
+        self._done: Set[int] = set()
+        self._results = queue.Queue()
+
+    def _requeue_expired(self):
+        now = time.monotonic()
+        for index, (expiry, job) in list(self._leases.items()):
+            if expiry <= now:
+                logger.warning("The lease of shard %d expired, handing it out again.", index)
+                del self._leases[index]
+                self._queued.appendleft(job)
+
+    def add(self, job: tuple):
+        "Queue `job`, an (index, mode, lines, options) tuple."
+        with self._lock:
+            self._queued.append(job)
+
+    def seeds(self) -> Dict[str, bytes]:
+        "The contents of the run's stores when it started, per `STORES` key."
+        return self._seeds
+
+    def take(self) -> Optional[tuple]:
+        "Lease the next job to check, None if there's none for now."
+        with self._lock:
+            self._requeue_expired()
+            if not self._queued:
+                return None
+            job = self._queued.popleft()
+            self._leases[job[0]] = (time.monotonic() + self.lease_time, job)
+            return job
+
+    def renew(self, index: int) -> float:
+        "Renew the lease of shard `index`, returning the `lease_time`."
+        with self._lock:
+            if index in self._leases:
+                self._leases[index] = (time.monotonic() + self.lease_time, self._leases[index][1])
+        return self.lease_time
+
+    def finished(self) -> bool:
+        "Whether no shard is left, either queued or leased."
+        with self._lock:
+            return not self._queued and not self._leases
+
+    def finish(
+        self,
+        index: int,
+        results: Optional[Dict[str, Set[str]]],
+        error: Optional[str],
+        files: Dict[str, bytes],
+    ):
+        "Hand in the result of shard `index`, see `_run_shard`."
+        with self._lock:
+            if index in self._done:
+                return
+            self._done.add(index)
+            self._leases.pop(index, None)
+            self._queued = deque(job for job in self._queued if job[0] != index)
+        self._results.put((index, results, error, files))
+
+    def result(self, timeout: float) -> Optional[tuple]:
+        "The next result handed in, None if none came within `timeout` seconds."
+        with self._lock:
+            self._requeue_expired()
+        try:
+            return self._results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+# Set in the process of the `_ShardManager` by `_start_dispatcher`
+_dispatcher: Optional[_Dispatcher] = None
+
+
+def _start_dispatcher(lease_time: float, seeds: Dict[str, bytes]):
+    global _dispatcher
+    _dispatcher = _Dispatcher(lease_time, seeds)
+
+
+def _get_dispatcher() -> _Dispatcher:
+    return _dispatcher
+
+
+class _ShardManager(BaseManager):
+    pass
+
+
+_ShardManager.register("dispatcher", callable=_get_dispatcher)
+
+
+def partition(lines: List[str], shards: int, mode: str = BATCH) -> List[List[str]]:
+    """
+    Split the input lines into `shards` parts.
+
+    Batch lines are partitioned by a hash of their domain, so each domain
+    is discovered once and its MX servers are only reached from one
+    worker, within that worker's per-MX limits. Names lines (all of the
+    same domain) are dealt round-robin.
+
+    :returns: List[List[str]] of the non-empty shards.
+    """
+    parts = [[] for _ in range(shards)]
+    for count, line in enumerate(lines):
+        if mode == BATCH:
+            index = zlib.crc32(line.rsplit(",", 1)[-1].strip().lower().encode()) % shards
+        else:
+            index = count % shards
+        parts[index].append(line)
+    return [part for part in parts if part]
+
+
+def _run_shard(
+    mode: str, lines: List[str], options: dict, seeds: Dict[str, bytes]
+) -> Tuple[Dict[str, Set[str]], Dict[str, bytes]]:
+    """
+    Check the lines of a shard in a fresh trio loop.
+
+    The shard writes its own output file and SQLite stores in a temporary
+    directory, the stores starting from the `seeds`, as concurrent
+    workers would interleave their rows and contend for the locks, and
+    remote ones can't reach the files of the run.
+
+    :returns: The found email addresses per domain name, and the contents
+              of the files written per `PER_SHARD_PATHS` key.
+    """
+    options = dict(options)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for key in PER_SHARD_PATHS:
+            if options.get(key):
+                paths[key] = options[key] = os.path.join(directory, key)
+                if key in seeds:
+                    with open(paths[key], "wb") as file:
+                        file.write(seeds[key])
+        path = os.path.join(directory, "shard.csv")
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(lines)
+        if mode == BATCH:
+            results = trio.run(partial(main_batch, path, report=False, **options))
+        else:
+            domain_str = options.pop("domain_str")
+            found = trio.run(partial(main, domain_str, path, report=False, **options))
+            results = {domain_str: found}
+        files = {}
+        for key, shard_file in paths.items():
+            if os.path.exists(shard_file):
+                with open(shard_file, "rb") as file:
+                    files[key] = file.read()
+    return results, files
+
+
+def _renew_lease(dispatcher, index: int, stop: threading.Event):
+    "Renew the lease of shard `index` until `stop` is set."
+    while True:
+        lease_time = dispatcher.renew(index)
+        if stop.wait(lease_time / 3):
+            return
+
+
+def run_worker(address: Tuple[str, int], authkey: bytes):
+    """
+    Connect to a coordinator (see `serve_shards`) and check the shards it
+    hands out until none is left. Run it on as many processes and hosts
+    as desired.
+
+    As the entry point of the worker processes, it sets up their logging,
+    at the level of the `EMAIL_VALIDATOR_LOG_LEVEL` environment variable.
+    """
+    configure_logging()
+    manager = _ShardManager(address=address, authkey=authkey)
+    manager.connect()
+    dispatcher = manager.dispatcher()
+    seeds = dispatcher.seeds()
+    while True:
+        job = dispatcher.take()
+        if job is None:
+            if dispatcher.finished():
+                return
+            # Shards of other workers may be handed out again
+            time.sleep(1)
+            continue
+        index, mode, lines, options = job
+        logger.info("Worker %d checking shard %d (%d lines) ...", os.getpid(), index, len(lines))
+        stop = threading.Event()
+        renewer = threading.Thread(target=_renew_lease, args=(dispatcher, index, stop), daemon=True)
+        renewer.start()
+        try:
+            results, files = _run_shard(mode, lines, options, seeds)
+            dispatcher.finish(index, results, None, files)
+        except Exception as exc:
+            logger.exception("Shard %d failed.", index)
+            dispatcher.finish(index, None, f"{type(exc).__name__}: {exc}", {})
+        finally:
+            stop.set()
+            renewer.join()
+
+
+def _seeds(options: dict) -> Dict[str, bytes]:
+    "The contents of the stores of the run, see `_run_shard`."
+    seeds = {}
+    for key, store_class in STORES.items():
+        path = options.get(key)
+        if path and os.path.exists(path):
+            # Checkpoints the write-ahead log into the file
+            store_class(path).close()
+            with open(path, "rb") as file:
+                seeds[key] = file.read()
+    return seeds
+
+
+class _Merger:
+    "Merges the files of the shards into those of the run, see `_run_shard`."
+
+    def __init__(self, options: dict):
+        self.output_file = options.get("output_file")
+        self.output_format = options.get("output_format")
+        self.stores = {key: STORES[key](options[key]) for key in STORES if options.get(key)}
+        self.written = False
+
+    def _merge_output(self, data: bytes):
+        if self.output_format == CSV:
+            # The header is written once
+            header, _, data = data.partition(b"\n")
+        if self.output_file == "-":
+            if self.output_format == CSV and not self.written:
+                sys.stdout.buffer.write(header + b"\n")
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+        else:
+            with open(self.output_file, "ab") as file:
+                if self.output_format == CSV and file.tell() == 0:
+                    file.write(header + b"\n")
+                file.write(data)
+        self.written = True
+
+    def merge(self, files: Dict[str, bytes]):
+        if "output_file" in files:
+            self._merge_output(files["output_file"])
+        for key, store in self.stores.items():
+            if key not in files:
+                continue
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, key)
+                with open(path, "wb") as file:
+                    file.write(files[key])
+                store.merge(path)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+
+def serve_shards(
+    input_file: str,
+    mode: str = BATCH,
+    shards: int = 1,
+    address: Tuple[str, int] = ("", DEFAULT_PORT),
+    authkey: Optional[bytes] = None,
+    processes: int = 0,
+    lease_time: float = 300,
+    **options,
+) -> Dict[str, Set[str]]:
+    """
+    Coordinate a sharded run: partition `input_file` into `shards`,
+    serve them to workers (`run_worker`) on `address`, and merge their
+    results.
+
+    The coordinator starts `processes` local workers itself; workers on
+    other hosts can connect to `address` with the same `authkey`, which
+    is required: the workers exchange pickles with the coordinator, so
+    whoever can connect can run code on either side. Every worker runs
+    its own trio loop, SMTP pool and rate limits.
+
+    The shard of a worker which stopped renewing its lease for
+    `lease_time` seconds (e.g. it died) is handed out again.
+
+    The output file and SQLite stores of each shard (see `_run_shard`)
+    are sent back, and merged into the `PER_SHARD_PATHS` files of the
+    run as the shards complete.
+
+    :param options: Arguments of `main_batch` (or `main`, including
+                    `domain_str`), which must be picklable
+
+    :returns: Dict[str, Set[str]] of the found email addresses per domain name.
+
+    :raises ValueError: If no `authkey` is given.
+    """
+    if not authkey:
+        raise ValueError("Serving shards requires a non-empty authkey")
+    with open(input_file, "r", encoding="utf-8") as file:
+        parts = partition(file.readlines(), shards, mode)
+    options = dict(options)
+    if options.get("output_file"):
+        options["output_format"] = sink_format(
+            options["output_file"], options.get("output_format")
+        )
+
+    # Spawned, as forking a process with running threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    manager = _ShardManager(address=address, authkey=authkey, ctx=context)
+    manager.start(_start_dispatcher, (lease_time, _seeds(options)))
+    merger = _Merger(options)
+    workers = []
+    final_results = defaultdict(set)
+    failed = []
+    try:
+        dispatcher = manager.dispatcher()
+        for index, lines in enumerate(parts):
+            dispatcher.add((index, mode, lines, options))
+        logger.info("Serving %d shards on %s ...", len(parts), manager.address)
+
+        workers = [
+            context.Process(target=run_worker, args=(manager.address, authkey))
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        for _ in parts:
+            while True:
+                result = dispatcher.result(1)
+                if result is not None:
+                    break
+                # Without remote workers, nobody is left to check the shards
+                if workers and not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("All the workers exited before the shards were checked")
+            index, results, error, files = result
+            if error:
+                failed.append(index)
+                logger.error("Shard %d failed: %s", index, error)
+                continue
+            merger.merge(files)
+            for domain_str, addresses in results.items():
+                final_results[domain_str] |= addresses
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        merger.close()
+        manager.shutdown()
+    if failed:
+        logger.error("%d shards failed: %s", len(failed), sorted(failed))
+    return dict(final_results)
+
+
+def run_sharded(
+    input_file: str,
+    mode: str = BATCH,
+    processes: Optional[int] = None,
+    shards: Optional[int] = None,
+    **options,
+) -> Dict[str, Set[str]]:
+    """
+    Check `input_file` with `processes` local worker processes (default:
+    one per core), to use every core of the machine.
+
+    Keep in mind that each process has its own per-MX connection limits:
+    in `NAMES` mode they all reach the same MX servers.
+    """
+    processes = processes or os.cpu_count()
+    return serve_shards(
+        input_file,
+        mode=mode,
+        shards=shards or processes,
+        address=("127.0.0.1", 0),
+        authkey=os.urandom(16),
+        processes=processes,
+        **options,
+    )
+
+
+def _address(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host, int(port or DEFAULT_PORT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the email checks over several processes.")
+    parser.add_argument("input_file", nargs="?", help="Input file, first,last[,domain] per line")
+    parser.add_argument("-d", "--domain", help="The domain of a first,last names file")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="Local worker processes")
+    parser.add_argument("-s", "--shards", type=int, default=None, help="Number of shards")
+    parser.add_argument("--serve", type=_address, help="Coordinate workers on HOST:PORT")
+    parser.add_argument("--connect", type=_address, help="Work for the coordinator on HOST:PORT")
+    parser.add_argument("--authkey", default=os.environ.get("SHARD_AUTHKEY", ""))
+    parser.add_argument(
+        "--lease-time",
+        type=float,
+        default=300,
+        help="Seconds before a silent worker's shard is handed out again",
+    )
+    args = parser.parse_args()
+
+    configure_logging()
+    authkey = args.authkey.encode()
+    if args.connect:
+        if not authkey:
+            parser.error("--connect requires the --authkey of the coordinator")
+        run_worker(args.connect, authkey)
+    else:
+        mode, options = (NAMES, dict(domain_str=args.domain)) if args.domain else (BATCH, {})
+        if args.serve:
+            processes = args.processes if args.processes is not None else 0
+            if not authkey:
+                authkey = secrets.token_hex(16).encode()
+                print(f"Workers must connect with: --authkey {authkey.decode()}")
+            final_results = serve_shards(
+                args.input_file,
+                mode=mode,
+                shards=args.shards or max(processes, 1) * 4,
+                address=args.serve,
+                authkey=authkey,
+                processes=processes,
+                lease_time=args.lease_time,
+                **options,
+            )
+        else:
+            final_results = run_sharded(
+                args.input_file,
+                mode=mode,
+                processes=args.processes,
+                shards=args.shards,
+                lease_time=args.lease_time,
+                **options,
+            )
+        print("-------\nThe final emails list is:")
+        pprint.pprint(final_results)
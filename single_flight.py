@@ -0,0 +1,73 @@
+# External imports
+from typing import Dict, Optional, Union
+import trio
+
+# Local imports
+from results import AddressResult, ResultTable, SETTLED_VERDICTS
+
+
+class Flight:
+    "The probe of an address in progress, awaited by the other checks wanting it."
+
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = trio.Event()
+        self.result: Optional[AddressResult] = None
+
+    async def wait(self) -> Optional[AddressResult]:
+        """
+        Wait for the probe to end.
+
+        :returns: The result of the probe, None if it failed without one.
+        """
+        await self.done.wait()
+        return self.result
+
+
+class SingleFlight:
+    """
+    The registry of the addresses probed during a run, so that the same
+    address (from duplicate names, colliding patterns or trailing-digit
+    variants) is never probed twice, nor by two checks at once.
+
+    `claim` tells whether an address is free to probe: if it's already
+    settled, the known result is returned; if another check is probing
+    it, its `Flight` is returned to be awaited. Otherwise the caller now
+    owns the address and must `release` it, with the result it got or
+    None if the probe failed (then a waiting check claims it again).
+
+    Only settled verdicts are kept, in a compact `ResultTable`:
+    temporary ones are shared with the checks waiting at the time, but
+    the address can be probed again afterwards (e.g. by a retry).
+
+    Addresses are compared case-insensitively.
+    """
+
+    def __init__(self):
+        self._results = ResultTable()
+        self._flights: Dict[str, Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def claim(self, address: str) -> Union[AddressResult, Flight, None]:
+        key = address.lower()
+        result = self._results.get(key)
+        if result is not None:
+            return result
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight
+        self._flights[key] = Flight()
+        return None
+
+    def release(self, address: str, result: Optional[AddressResult]):
+        "End the probe of a claimed `address`, waking the checks waiting for it."
+        key = address.lower()
+        if result is not None and result.verdict in SETTLED_VERDICTS:
+            self._results.add(result, key)
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.result = result
+            flight.done.set()
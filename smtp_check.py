@@ -1,180 +1,107 @@
 # External imports
-from smtplib import SMTP, SMTPNotSupportedError, SMTPResponseException, SMTPServerDisconnected
-from socket import timeout
-from ssl import SSLContext, SSLError
-from typing import List, Optional, Tuple, Set
-import socks
+from smtplib import SMTP_PORT, SMTPResponseException, SMTPServerDisconnected
+from ssl import SSLContext
+from typing import Dict, List, Optional, Set
+import time
 import trio
 
 # Local imports
-from logging_mod import logging
+from logging_mod import RCPT_LOGGER, logging
 from exceptions import (
     SMTPCommunicationError,
     SMTPMessage,
+    SMTPStageTimeout,
     SMTPTemporaryError,
     TLSNegotiationError,
-    UnknownProxyError,
 )
+from metrics import RCPT_DEDUPLICATED
 from person import Person
+from result_sink import ResultSink
+from result_store import ResultStore
+from results import AddressResult, DELIVERABLE, TEMPORARY, TIMED_OUT, verdict_for_code
+from single_flight import Flight
+from smtp_pool import SMTPPool, SMTPSession
 
 logger = logging.getLogger(__name__)
+# Sampled, there's a message per RCPT
+rcpt_logger = logging.getLogger(RCPT_LOGGER)
 
+# https://www.greenend.org.uk/rjk/tech/smtpreplies.html#RCPT
+# 452 (too many recipients) isn't one: `SMTPSession` resends those RCPTs
+GOOD_RCPT_CODES = frozenset((250, 251, 552, 441))
 
-class _SMTPChecker(SMTP):
+
+class _SMTPChecker:
     """
-    A specialized variant of `smtplib.SMTP` for checking the validity of
-    email addresses.
+    Checks the validity of email addresses over sessions taken from an
+    `SMTPPool`.
+
+    All the commands used in the check process raise appropriate
+    exceptions: `SMTPServerDisconnected` on connection issues and
+    `SMTPResponseException` on negative SMTP server responses.
+
+    The method `check` runs the check for a given list of SMTP servers.
+
+    The reply to every `RCPT TO` is kept in `address_results`. With a
+    `result_store`, addresses which already have a final verdict there
+    aren't probed again. Nor are the addresses settled or being probed
+    by other checks of the pool (see `SingleFlight`): their result is
+    shared, and kept in `address_results` too.
 
-    All the commands used in the check process are modified to raise
-    appropriate exceptions: `SMTPServerDisconnected` on connection
-    issues and `SMTPResponseException` on negative SMTP server
-    responses. Note that the methods of `smtplib.SMTP` already raise
-    these exceptions on some conditions.
+    With a `result_sink`, every verdict is written to it as it comes,
+    including the stored ones used instead of probing.
 
-    Also, a new method `check` is added to run the check for a given
-    list of SMTP servers.
+    With `stop_on_hit`, the addresses (sorted by likelihood) are probed
+    until one is deliverable. `probe_digits` enables the probing of the
+    trailing-digit variants of the deliverable addresses.
+
+    If the pool has a `batcher`, the RCPTs go through it, packed with
+    those of other checks of the same MX (see `RcptBatcher`).
     """
 
+    __slots__ = (
+        "_pool",
+        "_recips",
+        "_true_results",
+        "_final_results",
+        "__temporary_errors",
+        "entity",
+        "_result_store",
+        "_stop_on_hit",
+        "_probe_digits",
+        "_result_sink",
+        "_settled",
+        "address_results",
+    )
+
     def __init__(
         self,
-        local_hostname: Optional[str],
-        timeout: float,
-        debug: bool,
-        sender: str,
+        pool: SMTPPool,
         recip: List[str],
         final_results: Set[str],
         entity: Person,
-        skip_tls: bool = False,
-        tls_context: Optional[SSLContext] = None,
-        proxy_type=None,
-        proxy_addr=None,
-        proxy_port=None,
-        proxy_rdns=True,
-        proxy_username=None,
-        proxy_password=None,
-        socket_options=None,
+        result_store: Optional[ResultStore] = None,
+        stop_on_hit: bool = False,
+        probe_digits: bool = True,
+        result_sink: Optional[ResultSink] = None,
     ):
         """
         Initialize the object with all the parameters which remain
         constant during the check of one email address on all the SMTP
         servers.
         """
-        super().__init__(local_hostname=local_hostname, timeout=timeout)
-        self.set_debuglevel(debuglevel=2 if debug else False)
-        self.__sender = sender
+        self._pool = pool
         self._recips = recip
         self._true_results = set()
         self._final_results = final_results
         self.__temporary_errors = {}
-        self.__skip_tls = skip_tls
-        self.__tls_context = tls_context
-        # Avoid error on close() after unsuccessful connect
-        self.sock = None
         self.entity = entity
-
-        # Proxy defs
-        self.proxy_type = proxy_type
-        self.proxy_addr = proxy_addr
-        self.proxy_port = proxy_port
-        self.proxy_rdns = proxy_rdns
-        self.proxy_username = proxy_username
-        self.proxy_password = proxy_password
-        self.socket_options = socket_options
-
-        proxy = {
-            "socks4": socks.SOCKS4,
-            "socks5": socks.SOCKS5,
-        }
-
-        if proxy_type:
-            try:
-                self.proxy_type = proxy[proxy_type.lower()]
-            except KeyError:
-                raise UnknownProxyError(proxy_type)
-        else:
-            self.proxy_type = None
-
-        if self.proxy_type:
-            self._get_socket = self.socks_get_socket
-
-        # https://www.greenend.org.uk/rjk/tech/smtpreplies.html#RCPT
-        self.__codes_dict = {"good": [250, 251, 552, 452, 441]}
-
-    def socks_get_socket(self, host, port, timeout):
-        if self.debuglevel > 0:
-            logger.debug(f"Socks SMTP connect: to {host}:{port}")
-        return socks.create_connection(
-            (host, port),
-            timeout=timeout,
-            source_address=None,
-            proxy_type=self.proxy_type,
-            proxy_addr=self.proxy_addr,
-            proxy_port=self.proxy_port,
-            proxy_rdns=self.proxy_rdns,
-            proxy_username=self.proxy_username,
-            proxy_password=self.proxy_password,
-            socket_options=self.socket_options,
-        )
-
-    def putcmd(self, cmd: str, args: str = ""):
-        """
-        Like `smtplib.SMTP.putcmd`, but remember the command for later
-        use in error messages.
-        """
-        if args:
-            self.__command = f"{cmd} {args}"
-        else:
-            self.__command = cmd
-        super().putcmd(cmd=cmd, args=args)
-
-    def connect(
-        self, host: str = "localhost", port: int = 0, source_address: Optional[str] = None
-    ) -> Tuple[int, str]:
-        """
-        Like `smtplib.SMTP.connect`, but raise appropriate exceptions on
-        connection failure or negative SMTP server response.
-        """
-        self.__command = "connect"  # Used for error messages.
-        self._host = host  # Workaround: Missing in standard smtplib!
-        # Use an OS assigned source port if source_address is passed
-        _source_address = None if source_address is None else (source_address, 0)
-        try:
-            code, message = super().connect(host=host, port=port, source_address=_source_address)
-        except OSError as error:
-            raise SMTPServerDisconnected(str(error))
-        if code >= 400:
-            raise SMTPResponseException(code=code, msg=message)
-        return code, message.decode()
-
-    def starttls(self, *args, **kwargs):
-        """
-        Like `smtplib.SMTP.starttls`, but continue without TLS in case
-        either end of the connection does not support it.
-        """
-        try:
-            super().starttls(*args, **kwargs)
-        except SMTPNotSupportedError:
-            # The server does not support the STARTTLS extension
-            pass
-        except RuntimeError:
-            # SSL/TLS support is not available to your Python interpreter
-            pass
-        except (SSLError, timeout) as exc:
-            raise TLSNegotiationError(exc)
-
-    def mail(self, sender: str, options: tuple = None):
-        """
-        Like `smtplib.SMTP.mail`, but raise an appropriate exception on
-        negative SMTP server response.
-        A code > 400 is an error here.
-        """
-        if not options:
-            options = tuple()
-        code, message = super().mail(sender=sender, options=options)
-
-        if code >= 400:
-            raise SMTPResponseException(code=code, msg=message)
-        return code, message
+        self._result_store = result_store
+        self._stop_on_hit = stop_on_hit
+        self._probe_digits = probe_digits
+        self._result_sink = result_sink
+        self._settled: Dict[str, AddressResult] = {}
+        self.address_results: Dict[str, AddressResult] = {}
 
     def _handle_rcpt_codes(self, code: int, msg: str) -> bool:
         """
@@ -182,37 +109,145 @@ class _SMTPChecker(SMTP):
         Returns True if email address is deilverable
         """
         # Parameter msg for future use
-        if code in self.__codes_dict["good"]:
+        if code in GOOD_RCPT_CODES:
             return True
         return False
 
-    async def rcpt(self, recip: str, options: tuple = None):
+    async def rcpt_many(self, session: SMTPSession, recips: List[str], options: tuple = None):
         """
-        Like `smtplib.SMTP.rcpt`, but handle negative SMTP server
-        responses directly.
+        Like `SMTPSession.rcpt_many` (pipelined in a single round trip
+        when the server supports it), but handle negative SMTP server
+        responses directly, and skip addresses with a stored final
+        verdict or already probed in this run.
+
+        The addresses other checks are probing are awaited once ours are
+        sent, so two checks waiting for each other's can't deadlock. If
+        their probe fails, they are probed here instead.
         """
-        if not options:
-            options = tuple()
+        probes = self._pool.probes
+        pending = recips
+        while pending:
+            claimed, flights = [], []
+            for recip in pending:
+                settled = self._settled.get(recip.lower())
+                if settled:
+                    self._use_settled(recip, settled)
+                    continue
+                claim = probes.claim(recip)
+                if claim is None:
+                    claimed.append(recip)
+                elif isinstance(claim, Flight):
+                    flights.append((recip, claim))
+                else:
+                    RCPT_DEDUPLICATED.inc(source="settled")
+                    self._use_shared(recip, claim)
+            if claimed:
+                await self._send_rcpts(session, claimed, options)
+
+            pending = []
+            for recip, flight in flights:
+                result = await flight.wait()
+                if result is None:
+                    pending.append(recip)
+                else:
+                    RCPT_DEDUPLICATED.inc(source="in_flight")
+                    self._use_shared(recip, result)
+
+    async def _send_rcpts(self, session: SMTPSession, recips: List[str], options: tuple):
+        "Probe `recips`, claimed from the pool's `probes`, and release them."
+        probes = self._pool.probes
+        try:
+            started = trio.current_time()
+            replies = await session.rcpt_many(recips=recips, options=options)
+            latency = trio.current_time() - started
+            for recip, (code, message) in zip(recips, replies):
+                probes.release(recip, self._record_reply(session, recip, code, message, latency))
+        finally:
+            # Let the waiting checks probe the rest themselves
+            for recip in recips:
+                probes.release(recip, None)
 
-        code, message = super().rcpt(recip=recip, options=options)
-        if self._handle_rcpt_codes(code, message):
-            logger.debug(f"Found new email~ {recip}.")
+    def _use_settled(self, recip: str, settled: AddressResult):
+        if settled.verdict == DELIVERABLE:
             self._true_results.add(recip)
+        if self._result_sink:
+            self._result_sink.write(self.entity, settled._replace(address=recip))
 
-    def quit(self):
+    def _use_shared(self, recip: str, result: AddressResult):
+        "Take the result of `recip` probed by another check of the pool."
+        result = result._replace(address=recip)
+        if result.verdict == DELIVERABLE:
+            self._true_results.add(recip)
+        self.address_results[recip] = result
+        if self._result_sink:
+            self._result_sink.write(self.entity, result)
+
+    def _record_reply(
+        self, session: SMTPSession, recip: str, code: int, message: bytes, latency: float
+    ) -> AddressResult:
+        deliverable = self._handle_rcpt_codes(code, message)
+        if deliverable:
+            logger.debug("Found new email~ %s.", recip)
+            self._true_results.add(recip)
+        result = AddressResult(
+            address=recip,
+            verdict=verdict_for_code(code, deliverable),
+            mx=session.host,
+            code=code,
+            text=message.decode(errors="ignore"),
+            checked_at=time.time(),
+            latency=latency,
+        )
+        self.address_results[recip] = result
+        rcpt_logger.debug("RCPT %s at %s: %d (%.3fs)", recip, session.host, code, latency)
+        if self._result_sink:
+            self._result_sink.write(self.entity, result)
+        return result
+
+    async def _probe(self, session: SMTPSession, recips: List[str]):
         """
-        Like `smtplib.SMTP.quit`, but make sure that everything is
-        cleaned up properly even if the connection has been lost before.
+        Probe `recips` in pipelined batches. With `stop_on_hit`, the
+        batches start with the first address alone and double in size
+        (as long as the server pipelines), so a likely first candidate
+        costs one RCPT while the rest still takes few round trips.
         """
-        try:
-            return super().quit()
-        except SMTPServerDisconnected:
-            self.ehlo_resp = self.helo_resp = None
-            self.esmtp_features = {}
-            self.does_esmtp = False
-            self.close()
-
-    def _handle_smtpresponseexception(self, exc: SMTPResponseException) -> bool:
+        if not self._stop_on_hit:
+            await self.rcpt_many(session, recips)
+            return
+        window = 1
+        while recips and not self._true_results:
+            batch, recips = recips[:window], recips[window:]
+            await self.rcpt_many(session, batch)
+            window = window * 2 if session.has_extn("pipelining") else 1
+
+    def _record_timeout(self, host: str, recips: List[str], exc: SMTPStageTimeout):
+        "Give the `recips` left without a verdict a `TIMED_OUT` one, as `Deadlines` do."
+        if self._stop_on_hit and self._true_results:
+            # The rest wouldn't have been probed anyway
+            return
+        for recip in recips:
+            if recip in self.address_results or recip.lower() in self._settled:
+                continue
+            result = AddressResult(
+                address=recip,
+                verdict=TIMED_OUT,
+                mx=host,
+                code=None,
+                text=str(exc),
+                checked_at=time.time(),
+            )
+            self.address_results[recip] = result
+            if self._result_sink:
+                self._result_sink.write(self.entity, result)
+
+    def _load_settled(self, addresses: List[str]):
+        "Fetch the final verdicts already stored for `addresses`."
+        if self._result_store:
+            self._settled.update(self._result_store.settled(addresses))
+
+    def _handle_smtpresponseexception(
+        self, exc: SMTPResponseException, host: str, command: str
+    ) -> bool:
         "Handle an `SMTPResponseException`."
         smtp_error = (
             exc.smtp_error.decode(errors="ignore")
@@ -220,12 +255,12 @@ class _SMTPChecker(SMTP):
             else exc.smtp_error
         )
         smtp_message = SMTPMessage(
-            command=self.__command, code=exc.smtp_code, text=smtp_error, exceptions=(exc,)
+            command=command, code=exc.smtp_code, text=smtp_error, exceptions=(exc,)
         )
         if exc.smtp_code >= 500:
-            raise SMTPCommunicationError(error_messages={self._host: smtp_message})
+            raise SMTPCommunicationError(error_messages={host: smtp_message})
         else:
-            self.__temporary_errors[self._host] = smtp_message
+            self.__temporary_errors[host] = smtp_message
         return False
 
     async def _check_one(self, host: str) -> bool:
@@ -238,71 +273,85 @@ class _SMTPChecker(SMTP):
         while collecting the error message for later use.
 
         Raise `AddressNotDeliverableError`. on negative result.
-        """
 
+        If the RCPT stage times out, the addresses left get a `TIMED_OUT`
+        verdict, and the other servers aren't tried. Timeouts of the other
+        stages (connect, greeting, STARTTLS) are failures of the server,
+        like disconnects: the next one is tried.
+        """
+        enriched = []
         try:
-            self.connect(host=host)
-            if not self.__skip_tls:
-                self.starttls(context=self.__tls_context)
-            self.ehlo_or_helo_if_needed()
-            self.mail(sender=self.__sender)
-
-            # Start async and advance only when all subtasks are done
-            async with trio.open_nursery() as nursery:
-                for vari in self._recips:
-                    try:
-                        nursery.start_soon(self.rcpt, vari)
-                    except SMTPServerDisconnected:
-                        logger.warn(f"Server got disconnected while trying variation - {vari}")
-
-            # Hard copy of the true set
-            temp_true_set = self._true_results.copy()
-
-            # Checking for email duplicates with trailing numbers
-            async with trio.open_nursery() as nursery:
-                for true_var in temp_true_set:
+            # Sessions connect lazily, so nothing goes on the wire if
+            # every address already has a final verdict. With a batcher,
+            # the RCPTs share transactions with other checks instead.
+            batcher = self._pool.batcher
+            sessions = batcher.session(host) if batcher else self._pool.session(host)
+            async with sessions as session:
+                # The variations are pipelined when the server supports it,
+                # otherwise sent in lockstep. Concurrency comes from the many
+                # sessions running side by side.
+                await self._probe(session, self._recips)
+
+                # Checking for email duplicates with trailing numbers
+                for true_var in self._true_results if self._probe_digits else ():
                     for i in range(1, 3):
                         email_split = true_var.split("@")
                         email_split[0] = email_split[0] + str(i)
                         if len(email_split) != 2:
                             logger.error(
-                                f"Error parsing email {true_var} - enriched email with trailing nums"
+                                "Error parsing email %s - enriched email with trailing nums",
+                                true_var,
                             )
-                        nursery.start_soon(self.rcpt, "@".join(email_split))
+                        enriched.append("@".join(email_split))
+                self._load_settled(enriched)
+                await self.rcpt_many(session, enriched)
 
-            # Update final set with the results
-            if self._true_results:
-                self._final_results.update(self._true_results)
+                # Update final set with the results
+                if self._true_results:
+                    self._final_results.update(self._true_results)
 
         except SMTPServerDisconnected as exc:
-            self.__temporary_errors[self._host] = SMTPMessage(
-                command=self.__command, code=451, text=str(exc), exceptions=(exc,)
+            if isinstance(exc, SMTPStageTimeout) and exc.stage == "rcpt":
+                self._record_timeout(host, self._recips + enriched, exc)
+                self._final_results.update(self._true_results)
+                return bool(self._true_results)
+            self.__temporary_errors[host] = SMTPMessage(
+                command=session.command, code=451, text=str(exc), exceptions=(exc,)
             )
             return False
         except SMTPResponseException as exc:
-            return self._handle_smtpresponseexception(exc=exc)
+            return self._handle_smtpresponseexception(
+                exc=exc, host=host, command=session.command
+            )
         except TLSNegotiationError as exc:
-            self.__temporary_errors[self._host] = SMTPMessage(
-                command=self.__command, code=-1, text=str(exc), exceptions=exc.args
+            self.__temporary_errors[host] = SMTPMessage(
+                command=session.command, code=-1, text=str(exc), exceptions=exc.args
             )
             return False
-        finally:
-            self.quit()
         if self._true_results:
             return True
         return False
 
     async def check(self, hosts: List[str]) -> bool:
         """
-        Run the check for all given SMTP servers. On positive result,
-        return `True`, else raise exceptions described in `smtp_check`.
+        Run the check for all given SMTP servers, in the order of
+        `SMTPPool.order_hosts`. On positive result, return `True`, else
+        raise exceptions described in `smtp_check`.
+
+        The next server is only tried when one failed or answered with
+        temporary errors: a server's definitive answers are final.
         """
-        for host in hosts:
-            logger.debug(msg=f"Entity - {self.entity}; Trying {host} ...")
+        self._load_settled(self._recips)
+        for host in await self._pool.order_hosts(hosts):
+            logger.debug("Entity - %s; Trying %s ...", self.entity, host)
 
             # If a result was found, then no need to check other servers
             if await self._check_one(host=host):
                 return self._true_results
+            if host not in self.__temporary_errors and not any(
+                result.verdict == TEMPORARY for result in self.address_results.values()
+            ):
+                return []
         # Raise exception for collected temporary errors
         if self.__temporary_errors:
             raise SMTPTemporaryError(error_messages=self.__temporary_errors)
@@ -316,6 +365,7 @@ async def smtp_check(
     final_results: Set[str],
     entity: Person,
     timeout: float = 10,
+    port: int = SMTP_PORT,
     helo_host: Optional[str] = None,
     skip_tls: bool = True,
     tls_context: Optional[SSLContext] = None,
@@ -327,6 +377,12 @@ async def smtp_check(
     proxy_username=None,
     proxy_password=None,
     socket_options=None,
+    pool: Optional[SMTPPool] = None,
+    result_store: Optional[ResultStore] = None,
+    address_results: Optional[Dict[str, AddressResult]] = None,
+    stop_on_hit: bool = False,
+    probe_digits: bool = True,
+    result_sink: Optional[ResultSink] = None,
 ) -> bool:
     """
     Returns `True` as soon as the any of the given server accepts the
@@ -344,17 +400,50 @@ async def smtp_check(
     error message to any of the communication steps before the recipient
     address is checked, and the validity of the email address can not be
     determined either.
+
+    When a shared `pool` is given, sessions are taken from it and the
+    connection parameters are ignored. Otherwise a private pool is used
+    for this check only and closed when it's done.
+
+    When a `result_store` is given, addresses with a final verdict in it
+    are not probed again, and the new results are saved to it.
+
+    The result of every probed address is added to `address_results`
+    when given, even if an exception is raised, and written to the
+    `result_sink` when given.
+
+    With `stop_on_hit`, the probing stops at the first deliverable
+    address, so `email_addresses` should come most likely first.
+    `probe_digits` enables the probing of the trailing-digit variants
+    (e.g. "jsmith1") of the deliverable addresses.
     """
-    smtp_checker = _SMTPChecker(
+    if pool is not None:
+        smtp_checker = _SMTPChecker(
+            pool=pool,
+            recip=email_addresses,
+            final_results=final_results,
+            entity=entity,
+            result_store=result_store,
+            stop_on_hit=stop_on_hit,
+            probe_digits=probe_digits,
+            result_sink=result_sink,
+        )
+        try:
+            return await smtp_checker.check(hosts=mx_records)
+        finally:
+            if result_store:
+                result_store.record_many(smtp_checker.address_results.values())
+            if address_results is not None:
+                address_results.update(smtp_checker.address_results)
+
+    async with SMTPPool(
+        sender=from_address,
+        port=port,
         local_hostname=helo_host,
         timeout=timeout,
         debug=debug,
-        sender=from_address,
-        recip=email_addresses,
-        final_results=final_results,
         skip_tls=skip_tls,
         tls_context=tls_context,
-        entity=entity,
         proxy_type=proxy_type,
         proxy_addr=proxy_addr,
         proxy_port=proxy_port,
@@ -362,5 +451,17 @@ async def smtp_check(
         proxy_password=proxy_password,
         proxy_rdns=proxy_rdns,
         socket_options=socket_options,
-    )
-    return await smtp_checker.check(hosts=mx_records)
+    ) as private_pool:
+        return await smtp_check(
+            email_addresses=email_addresses,
+            mx_records=mx_records,
+            from_address=from_address,
+            final_results=final_results,
+            entity=entity,
+            pool=private_pool,
+            result_store=result_store,
+            address_results=address_results,
+            stop_on_hit=stop_on_hit,
+            probe_digits=probe_digits,
+            result_sink=result_sink,
+        )
@@ -0,0 +1,497 @@
+# External imports
+import math
+import re
+import socket
+import ssl
+from contextlib import asynccontextmanager
+from functools import partial
+from smtplib import (
+    SMTP_PORT,
+    SMTPHeloError,
+    SMTPResponseException,
+    SMTPServerDisconnected,
+    quoteaddr,
+)
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import socks
+import trio
+
+# Local imports
+from deadlines import Deadlines
+from logging_mod import logging
+from exceptions import SMTPStageTimeout, TLSNegotiationError, UnknownProxyError
+from metrics import SMTP_COMMAND_SECONDS, SMTP_ERRORS, SMTP_REPLIES
+
+logger = logging.getLogger(__name__)
+
+CRLF = b"\r\n"
+# Same limit as `smtplib`
+_MAXLINE = 8192
+
+PROXY_TYPES = {
+    "socks4": socks.SOCKS4,
+    "socks5": socks.SOCKS5,
+}
+
+_local_fqdn = None
+
+
+async def _get_local_fqdn() -> str:
+    """
+    Resolve the FQDN of the local host once, in a worker thread, as
+    `socket.getfqdn` may block on DNS.
+    """
+    global _local_fqdn
+    if _local_fqdn is None:
+        fqdn = await trio.to_thread.run_sync(socket.getfqdn)
+        if "." not in fqdn:
+            fqdn = "[127.0.0.1]"
+        _local_fqdn = fqdn
+    return _local_fqdn
+
+
+def _unverified_tls_context() -> ssl.SSLContext:
+    """
+    The equivalent of the context `smtplib.SMTP.starttls` uses by default.
+    MX servers are contacted by IP, so certificates can't be verified.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class SMTPClient:
+    """
+    A non-blocking SMTP client speaking over `trio` streams.
+
+    It implements the subset of `smtplib.SMTP` needed for checking email
+    addresses (EHLO/HELO, STARTTLS, MAIL, RCPT, RSET, QUIT), and raises
+    the same exceptions: `SMTPServerDisconnected` on connection issues
+    (including timeouts) and `SMTPResponseException` on negative SMTP
+    server responses. TLS failures raise `TLSNegotiationError`.
+
+    Connections can optionally be tunnelled through a SOCKS4/5 proxy.
+
+    The latency and outcome of every stage (connect, TLS handshake and
+    each command) are recorded in the `metrics` of the MX and proxy.
+
+    `timeout` bounds each read and write. With `deadlines`, the connect,
+    greeting, STARTTLS and RCPT stages are bounded as a whole, raising
+    `SMTPStageTimeout` past their deadline; they default to `timeout`.
+    """
+
+    def __init__(
+        self,
+        local_hostname: Optional[str] = None,
+        timeout: float = 10,
+        debug: bool = False,
+        proxy_type=None,
+        proxy_addr=None,
+        proxy_port=None,
+        proxy_rdns=True,
+        proxy_username=None,
+        proxy_password=None,
+        socket_options=None,
+        deadlines: Optional[Deadlines] = None,
+    ):
+        self.local_hostname = local_hostname
+        self.timeout = timeout
+        self.deadlines = deadlines
+        self.debuglevel = 2 if debug else 0
+        self.command = None
+        self._host = None
+        self._stream = None
+        self._buffer = bytearray()
+        self._reset_ehlo_state()
+
+        # Proxy defs
+        if proxy_type:
+            try:
+                self.proxy_type = PROXY_TYPES[proxy_type.lower()]
+            except KeyError:
+                raise UnknownProxyError(proxy_type)
+        else:
+            self.proxy_type = None
+        self.proxy_addr = proxy_addr
+        self.proxy_port = proxy_port
+        self.proxy_rdns = proxy_rdns
+        self.proxy_username = proxy_username
+        self.proxy_password = proxy_password
+        self.socket_options = socket_options
+
+    def _reset_ehlo_state(self):
+        self.ehlo_resp = self.helo_resp = None
+        self.esmtp_features: Dict[str, str] = {}
+        self.does_esmtp = False
+
+    @property
+    def connected(self) -> bool:
+        return self._stream is not None
+
+    def _observe(
+        self, command: str, started: float, code: Optional[int] = None, failed: bool = False
+    ):
+        "Record a stage started at `started`, which got a reply `code` (if any) or `failed`."
+        labels = dict(
+            command=command,
+            mx=self._host or "",
+            proxy=f"{self.proxy_addr}:{self.proxy_port}" if self.proxy_type else "",
+        )
+        if failed:
+            SMTP_ERRORS.inc(**labels)
+            return
+        SMTP_COMMAND_SECONDS.observe(trio.current_time() - started, **labels)
+        if code is not None:
+            SMTP_REPLIES.inc(code=code, **labels)
+
+    def _limit(self, stage: Optional[str]) -> float:
+        "The time limit of `stage`, unlimited for None."
+        if stage is None:
+            return math.inf
+        limit = getattr(self.deadlines, stage, None)
+        return self.timeout if limit is None else limit
+
+    async def _timed_out(self, stage: str):
+        "Drop the connection, as `stage` ran past its time limit, and raise."
+        await self.close()
+        raise SMTPStageTimeout(
+            f"The {stage} stage timed out after {self._limit(stage):g}s", stage=stage
+        )
+
+    @asynccontextmanager
+    async def _stage(self, stage: str) -> AsyncIterator[None]:
+        "Bound the body by the time limit of `stage`, see `_timed_out`."
+        with trio.move_on_after(self._limit(stage)) as scope:
+            yield
+        if scope.cancelled_caught:
+            await self._timed_out(stage)
+
+    async def _open_socks_stream(self, host: str, port: int) -> trio.SocketStream:
+        """
+        Open a connection through the SOCKS proxy. PySocks only offers a
+        blocking handshake, so it runs in a worker thread and the
+        resulting socket is handed over to trio.
+        """
+        if self.debuglevel > 0:
+            logger.debug("Socks SMTP connect: to %s:%s", host, port)
+        sock = await trio.to_thread.run_sync(
+            partial(
+                socks.create_connection,
+                (host, port),
+                timeout=self.timeout,
+                source_address=None,
+                proxy_type=self.proxy_type,
+                proxy_addr=self.proxy_addr,
+                proxy_port=self.proxy_port,
+                proxy_rdns=self.proxy_rdns,
+                proxy_username=self.proxy_username,
+                proxy_password=self.proxy_password,
+                socket_options=self.socket_options,
+            ),
+            cancellable=True,
+        )
+        plain_sock = socket.socket(sock.family, sock.type, sock.proto, fileno=sock.detach())
+        return trio.SocketStream(trio.socket.from_stdlib_socket(plain_sock))
+
+    async def connect(
+        self, host: str = "localhost", port: int = SMTP_PORT, source_address: Optional[str] = None
+    ) -> Tuple[int, str]:
+        """
+        Connect to the SMTP server and read its greeting. Raise
+        appropriate exceptions on connection failure or negative SMTP
+        server response.
+        """
+        self.command = "connect"  # Used for error messages.
+        self._host = host
+        if not self.local_hostname:
+            self.local_hostname = await _get_local_fqdn()
+        started = trio.current_time()
+        try:
+            async with self._stage("connect"):
+                if self.proxy_type:
+                    self._stream = await self._open_socks_stream(host, port)
+                else:
+                    self._stream = await trio.open_tcp_stream(
+                        host, port, local_address=source_address
+                    )
+            # The greeting is part of the connection's latency
+            async with self._stage("greeting"):
+                code, message = await self.getreply()
+        except SMTPServerDisconnected:
+            self._observe("connect", started, failed=True)
+            raise
+        except OSError as error:
+            self._observe("connect", started, failed=True)
+            raise SMTPServerDisconnected(str(error) or "Connection timed out")
+        self._observe("connect", started, code)
+        if code >= 400:
+            await self.close()
+            raise SMTPResponseException(code=code, msg=message)
+        return code, message.decode()
+
+    async def send(self, data: bytes):
+        "Send raw data to the server."
+        if self._stream is None:
+            raise SMTPServerDisconnected("please run connect() first")
+        if self.debuglevel > 0:
+            logger.debug("send: %r", data)
+        try:
+            with trio.fail_after(self.timeout):
+                await self._stream.send_all(data)
+        except (OSError, trio.BrokenResourceError, trio.TooSlowError) as error:
+            await self.close()
+            raise SMTPServerDisconnected(f"Server not connected: {error!r}")
+
+    async def putcmd(self, cmd: str, args: str = ""):
+        "Send a command to the server, remembering it for error messages."
+        if args:
+            self.command = f"{cmd} {args}"
+        else:
+            self.command = cmd
+        await self.send(self.command.encode("ascii") + CRLF)
+
+    async def _readline(self) -> bytes:
+        while True:
+            index = self._buffer.find(b"\n")
+            if index >= 0:
+                line = bytes(self._buffer[: index + 1])
+                del self._buffer[: index + 1]
+                return line
+            if len(self._buffer) > _MAXLINE:
+                return bytes(self._buffer)
+            data = await self._stream.receive_some(_MAXLINE)
+            if not data:
+                return bytes(self._buffer)
+            self._buffer.extend(data)
+
+    async def getreply(self) -> Tuple[int, bytes]:
+        """
+        Get a reply from the server, like `smtplib.SMTP.getreply`.
+
+        Returns the reply code (-1 if it can't be parsed) and the reply
+        text, multiline replies being joined with newlines.
+
+        Raises `SMTPServerDisconnected` if the connection is closed or
+        the server doesn't answer within the timeout.
+        """
+        if self._stream is None:
+            raise SMTPServerDisconnected("please run connect() first")
+        resp = []
+        while True:
+            try:
+                with trio.fail_after(self.timeout):
+                    line = await self._readline()
+            except (OSError, trio.BrokenResourceError, trio.TooSlowError) as error:
+                await self.close()
+                raise SMTPServerDisconnected(
+                    f"Connection unexpectedly closed: {error!r}"
+                )
+            if not line:
+                await self.close()
+                raise SMTPServerDisconnected("Connection unexpectedly closed")
+            if self.debuglevel > 0:
+                logger.debug("reply: %r", line)
+            if len(line) > _MAXLINE:
+                await self.close()
+                raise SMTPResponseException(500, "Line too long.")
+            resp.append(line[4:].strip(b" \t\r\n"))
+            try:
+                errcode = int(line[:3])
+            except ValueError:
+                errcode = -1
+                break
+            # Check if multiline response.
+            if line[3:4] != b"-":
+                break
+        return errcode, b"\n".join(resp)
+
+    async def docmd(
+        self, cmd: str, args: str = "", stage: Optional[str] = None
+    ) -> Tuple[int, bytes]:
+        """
+        Send a command, and return its response code and text.
+
+        :param stage: The stage of `deadlines` bounding the command, if any
+        """
+        started = trio.current_time()
+        try:
+            # A plain cancel scope, as this runs for every command
+            with trio.move_on_after(self._limit(stage)) as scope:
+                await self.putcmd(cmd, args)
+                code, message = await self.getreply()
+            if scope.cancelled_caught:
+                await self._timed_out(stage)
+        except (SMTPServerDisconnected, SMTPResponseException):
+            self._observe(cmd.lower(), started, failed=True)
+            raise
+        self._observe(cmd.lower(), started, code)
+        return code, message
+
+    async def helo(self, name: str = "") -> Tuple[int, bytes]:
+        "SMTP 'helo' command."
+        code, msg = await self.docmd("helo", name or self.local_hostname)
+        self.helo_resp = msg
+        return code, msg
+
+    async def ehlo(self, name: str = "") -> Tuple[int, bytes]:
+        "SMTP 'ehlo' command, parsing the advertised ESMTP extensions."
+        self.esmtp_features = {}
+        code, msg = await self.docmd("ehlo", name or self.local_hostname)
+        self.ehlo_resp = msg
+        if code != 250:
+            return code, msg
+        self.does_esmtp = True
+        for line in msg.decode("latin-1").split("\n")[1:]:
+            match = re.match(r"(?P<feature>[A-Za-z0-9][A-Za-z0-9\-]*) ?", line)
+            if match:
+                feature = match.group("feature").lower()
+                self.esmtp_features[feature] = match.string[match.end("feature") :].strip()
+        return code, msg
+
+    def has_extn(self, opt: str) -> bool:
+        "Does the server support a given SMTP service extension?"
+        return opt.lower() in self.esmtp_features
+
+    async def ehlo_or_helo_if_needed(self):
+        """
+        Call `ehlo` and/or `helo` if needed. Raise `SMTPHeloError` if the
+        server didn't reply properly to the hello greeting.
+        """
+        if self.helo_resp is None and self.ehlo_resp is None:
+            code, resp = await self.ehlo()
+            if not 200 <= code <= 299:
+                code, resp = await self.helo()
+                if not 200 <= code <= 299:
+                    raise SMTPHeloError(code, resp)
+
+    async def starttls(self, context: Optional[ssl.SSLContext] = None):
+        """
+        Upgrade the connection to TLS, or continue without TLS in case
+        the server does not support it.
+
+        Raise `TLSNegotiationError` if the handshake failed, or if the
+        server sent more than its reply to STARTTLS in plaintext.
+        """
+        await self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            # The server does not support the STARTTLS extension
+            return
+        stage_started = trio.current_time()
+        try:
+            async with self._stage("starttls"):
+                code, reply = await self.docmd("STARTTLS")
+                if code != 220:
+                    raise SMTPResponseException(code, reply)
+                if self._buffer:
+                    # Plaintext sent past the 220 would be taken as sent over TLS,
+                    # a command injection (CVE-2011-0411)
+                    await self.close()
+                    raise TLSNegotiationError("Data received before the TLS handshake")
+                tls_stream = trio.SSLStream(
+                    self._stream,
+                    context or _unverified_tls_context(),
+                    server_hostname=self._host,
+                )
+                started = trio.current_time()
+                try:
+                    with trio.fail_after(self.timeout):
+                        await tls_stream.do_handshake()
+                except (ssl.SSLError, trio.BrokenResourceError, trio.TooSlowError) as exc:
+                    self._observe("tls_handshake", started, failed=True)
+                    await self.close()
+                    raise TLSNegotiationError(exc)
+                self._observe("tls_handshake", started)
+                self._stream = tls_stream
+                # RFC 3207: the client must discard knowledge obtained from the server
+                self._reset_ehlo_state()
+                await self.ehlo()
+        except SMTPStageTimeout:
+            self._observe("starttls", stage_started, failed=True)
+            raise
+
+    async def mail(self, sender: str, options: tuple = None) -> Tuple[int, bytes]:
+        """
+        SMTP 'mail' command, raising an appropriate exception on
+        negative SMTP server response.
+        A code > 400 is an error here.
+        """
+        await self.ehlo_or_helo_if_needed()
+        optionlist = ""
+        if options and self.does_esmtp:
+            optionlist = " " + " ".join(options)
+        code, message = await self.docmd("mail", f"FROM:{quoteaddr(sender)}{optionlist}")
+        if code >= 400:
+            raise SMTPResponseException(code=code, msg=message)
+        return code, message
+
+    def _rcpt_args(self, recip: str, options: tuple = None) -> str:
+        optionlist = ""
+        if options and self.does_esmtp:
+            optionlist = " " + " ".join(options)
+        return f"TO:{quoteaddr(recip)}{optionlist}"
+
+    async def rcpt(self, recip: str, options: tuple = None) -> Tuple[int, bytes]:
+        "SMTP 'rcpt' command, returning the server response as is."
+        return await self.docmd("rcpt", self._rcpt_args(recip, options), stage="rcpt")
+
+    async def rcpt_many(self, recips: List[str], options: tuple = None) -> List[Tuple[int, bytes]]:
+        """
+        SMTP 'rcpt' commands for several recipients, returning the server
+        responses in the same order.
+
+        When the server advertises PIPELINING (RFC 2920), all the commands
+        are sent in a single write and the replies read afterwards, so
+        the batch costs one round trip. Otherwise they go in lockstep.
+        """
+        if not self.has_extn("pipelining"):
+            # Not `self.rcpt`, which subclasses route through `rcpt_many`
+            return [
+                await self.docmd("rcpt", self._rcpt_args(recip, options), stage="rcpt")
+                for recip in recips
+            ]
+        commands = [f"rcpt {self._rcpt_args(recip, options)}" for recip in recips]
+        self.command = commands[0]
+        # Each reply's latency runs from the single write
+        started = trio.current_time()
+        replies = []
+        limit = self._limit("rcpt")
+        try:
+            await self.send(b"".join(command.encode("ascii") + CRLF for command in commands))
+            for command in commands:
+                # The command whose reply is awaited, for error messages
+                self.command = command
+                with trio.move_on_after(limit) as scope:
+                    replies.append(await self.getreply())
+                if scope.cancelled_caught:
+                    await self._timed_out("rcpt")
+                self._observe("rcpt", started, replies[-1][0])
+        except (SMTPServerDisconnected, SMTPResponseException):
+            self._observe("rcpt", started, failed=True)
+            raise
+        return replies
+
+    async def rset(self) -> Tuple[int, bytes]:
+        "SMTP 'rset' command, aborting the current mail transaction."
+        return await self.docmd("rset")
+
+    async def close(self):
+        "Close the connection to the SMTP server."
+        stream, self._stream = self._stream, None
+        self._buffer.clear()
+        if stream is not None:
+            await trio.aclose_forcefully(stream)
+
+    async def quit(self):
+        """
+        Terminate the SMTP session, making sure that everything is
+        cleaned up properly even if the connection has been lost before.
+        """
+        try:
+            if self._stream is not None:
+                await self.docmd("quit")
+        except (SMTPServerDisconnected, SMTPResponseException):
+            pass
+        finally:
+            self._reset_ehlo_state()
+            await self.close()
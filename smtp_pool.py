@@ -0,0 +1,626 @@
+# External imports
+import copy
+from collections import defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from smtplib import SMTP_PORT, SMTPResponseException, SMTPServerDisconnected
+from ssl import SSLContext
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import trio
+
+# Local imports
+from deadlines import Deadlines
+from exceptions import SMTPStageTimeout, TLSNegotiationError
+from logging_mod import logging
+from metrics import SESSIONS_IN_USE
+from proxy_pool import Proxy, ProxyPool
+from rate_limit import HostRateLimiter, RateController, THROTTLE_CODES
+from single_flight import SingleFlight
+from smtp_client import SMTPClient
+
+logger = logging.getLogger(__name__)
+
+# The reply to a RCPT past the server's recipients limit (RFC 5321, 4.5.3.1.10)
+TOO_MANY_RECIPIENTS = 452
+
+
+class SMTPSession(SMTPClient):
+    """
+    An `SMTPClient` owned by an `SMTPPool`, meant to be reused for the
+    checks of many email addresses against the same MX.
+
+    The session tracks its mail transaction, so callers only need
+    `ensure_transaction` and `rcpt`: it starts a new transaction (RSET
+    and MAIL FROM) once the server's recipients limit is reached, and
+    transparently reconnects once when the server drops the connection.
+
+    With a `rate_limiter`, each batch of RCPTs waits for a token, and
+    replies and disconnects are fed back to it. With a `proxy`, the session connects
+    through it and feeds the outcome of every connection to its health.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        sender: str,
+        port: int = SMTP_PORT,
+        skip_tls: bool = True,
+        tls_context: Optional[SSLContext] = None,
+        max_recipients: int = 100,
+        rate_limiter: Optional[HostRateLimiter] = None,
+        proxy: Optional[Proxy] = None,
+        **client_kwargs,
+    ):
+        if proxy is not None:
+            client_kwargs.update(proxy.client_kwargs)
+        super().__init__(**client_kwargs)
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self.rate_limiter = rate_limiter
+        self.sender = sender
+        self.skip_tls = skip_tls
+        self.tls_context = tls_context
+        self.max_recipients = max_recipients
+        self.in_transaction = False
+        self.transaction_recipients = 0
+        self.supports_starttls = None
+        self.last_used = trio.current_time()
+
+    async def _open(self):
+        "Connect, greet and negotiate TLS if requested."
+        started = trio.current_time()
+        try:
+            await self.connect(host=self.host, port=self.port)
+        except SMTPServerDisconnected as exc:
+            if self.proxy:
+                self.proxy.record_failure(exc)
+            raise
+        if self.proxy:
+            self.proxy.record_success(trio.current_time() - started)
+        await self.ehlo_or_helo_if_needed()
+        self.supports_starttls = self.has_extn("starttls")
+        if not self.skip_tls:
+            await self.starttls(context=self.tls_context)
+        await self.ehlo_or_helo_if_needed()
+
+    async def _start_transaction(self):
+        await self.mail(sender=self.sender)
+        self.in_transaction = True
+        self.transaction_recipients = 0
+
+    def _record_error(self, exc: Exception):
+        if self.rate_limiter is None:
+            return
+        if isinstance(exc, SMTPServerDisconnected) or (
+            isinstance(exc, SMTPResponseException) and exc.smtp_code in THROTTLE_CODES
+        ):
+            self.rate_limiter.record_throttle()
+
+    async def ensure_transaction(self):
+        """
+        Make sure the session is connected and inside a mail transaction,
+        ready for `RCPT TO` commands.
+        """
+        try:
+            await self._ensure_transaction()
+        except (SMTPServerDisconnected, SMTPResponseException) as exc:
+            self._record_error(exc)
+            raise
+
+    async def ensure_connected(self):
+        "Make sure the session is connected and greeted, without starting a transaction."
+        if self.connected:
+            return
+        self.in_transaction = False
+        try:
+            await self._open()
+        except (SMTPServerDisconnected, SMTPResponseException) as exc:
+            self._record_error(exc)
+            raise
+
+    async def _ensure_transaction(self):
+        if not self.connected:
+            self.in_transaction = False
+            await self._open()
+            await self._start_transaction()
+        elif not self.in_transaction:
+            try:
+                await self._start_transaction()
+            except SMTPServerDisconnected:
+                # An idle session the server has since dropped
+                await self.reconnect()
+
+    async def reconnect(self):
+        "Drop the current connection and open a fresh transaction."
+        logger.debug("Reconnecting to %s ...", self.host)
+        await self.close()
+        self._reset_ehlo_state()
+        self.in_transaction = False
+        await self._open()
+        await self._start_transaction()
+
+    async def reset(self):
+        "End the current transaction with RSET, keeping the connection."
+        if self.in_transaction:
+            code, message = await self.rset()
+            if code >= 400:
+                raise SMTPResponseException(code=code, msg=message)
+        self.in_transaction = False
+        self.transaction_recipients = 0
+
+    async def rcpt(self, recip: str, options: tuple = None) -> Tuple[int, bytes]:
+        """
+        Like `SMTPClient.rcpt`, but honor the recipients limit of the
+        server and retry once on a new connection after a disconnect.
+        """
+        return (await self.rcpt_many([recip], options))[0]
+
+    async def rcpt_many(self, recips: List[str], options: tuple = None) -> List[Tuple[int, bytes]]:
+        """
+        Like `SMTPClient.rcpt_many` (pipelined if supported), but honor
+        the recipients limit of the server, splitting the batch across
+        transactions, and retry a batch once on a new connection after a
+        disconnect (but not after a timeout).
+
+        Recipients refused with 452 (too many recipients) are sent again
+        in a new transaction, and `max_recipients` is lowered to what the
+        server accepted. A 452 to the first RCPT of a transaction is
+        returned as is.
+        """
+        replies: List[Optional[Tuple[int, bytes]]] = [None] * len(recips)
+        pending = list(range(len(recips)))
+        while pending:
+            if self.transaction_recipients >= self.max_recipients:
+                await self.reset()
+            await self.ensure_transaction()
+            indexes = pending[: self.max_recipients - self.transaction_recipients]
+            pending = pending[len(indexes) :]
+            batch = [recips[index] for index in indexes]
+            if self.rate_limiter:
+                await self.rate_limiter.take()
+            self.transaction_recipients += len(batch)
+            try:
+                batch_replies = await super().rcpt_many(recips=batch, options=options)
+            except SMTPStageTimeout as exc:
+                # Too slow a server isn't given a second chance
+                self._record_error(exc)
+                raise
+            except SMTPServerDisconnected as exc:
+                self._record_error(exc)
+                await self.reconnect()
+                self.transaction_recipients += len(batch)
+                batch_replies = await super().rcpt_many(recips=batch, options=options)
+            finally:
+                self.last_used = trio.current_time()
+            if self.rate_limiter:
+                self.rate_limiter.record_replies(code for code, _ in batch_replies)
+
+            # The transaction's recipients before this batch
+            start = self.transaction_recipients - len(batch)
+            refused = []
+            for offset, (index, reply) in enumerate(zip(indexes, batch_replies)):
+                if reply[0] == TOO_MANY_RECIPIENTS and (refused or start + offset > 0):
+                    if not refused:
+                        self._lower_recipients_limit(start + offset)
+                    refused.append(index)
+                else:
+                    replies[index] = reply
+            pending = refused + pending
+        return replies
+
+    def _lower_recipients_limit(self, limit: int):
+        "The server refuses more than `limit` recipients per transaction."
+        if limit < self.max_recipients:
+            logger.debug("%s accepts %d recipients per transaction.", self.host, limit)
+            self.max_recipients = limit
+        # Start a new transaction for the rest
+        self.transaction_recipients = self.max_recipients
+
+
+class SMTPPool:
+    """
+    A pool of `SMTPSession`s keyed by (MX host, proxy).
+
+    With a `proxy_pool`, each session goes through the proxy it assigns
+    to the MX host; the single `proxy_*` arguments are a pool of one.
+
+    Sessions are kept open between checks and reset with RSET when
+    returned, so many addresses can be verified with few handshakes.
+    At most `max_connections` sessions are open per key at any time,
+    and idle sessions older than `max_idle_time` seconds are dropped,
+    as servers close them on their side anyway.
+
+    `starttls_support` records per host whether STARTTLS was advertised,
+    and `recipients_limit` how many recipients per transaction it takes.
+
+    `deadlines` bounds the stages of the sessions, see `Deadlines`. The
+    MX servers are contacted on `port`.
+
+    With a `rate_controller`, the sessions working on each key are also
+    bounded by its adaptive limit, and their RCPT rate by its token
+    bucket.
+
+    With a `coalesce_window`, the pool has a `batcher` (see
+    `RcptBatcher`) to share transactions between concurrent checks.
+
+    `order_hosts` picks the MX to check with. Hosts which failed to
+    connect are avoided for `down_time` seconds. With a `hedge_delay`,
+    connections to unknown hosts are raced (see `order_hosts`).
+
+    `probes` is the registry of the addresses probed over the pool's
+    lifetime, so that each is probed only once (see `SingleFlight`).
+    """
+
+    def __init__(
+        self,
+        sender: str,
+        port: int = SMTP_PORT,
+        local_hostname: Optional[str] = None,
+        timeout: float = 10,
+        debug: bool = False,
+        skip_tls: bool = True,
+        tls_context: Optional[SSLContext] = None,
+        max_connections: int = 5,
+        max_recipients: int = 100,
+        max_idle_time: float = 30,
+        rate_controller: Optional[RateController] = None,
+        proxy_pool: Optional[ProxyPool] = None,
+        proxy_type=None,
+        proxy_addr=None,
+        proxy_port=None,
+        proxy_rdns=True,
+        proxy_username=None,
+        proxy_password=None,
+        socket_options=None,
+        coalesce_window: Optional[float] = None,
+        hedge_delay: Optional[float] = 0.3,
+        down_time: float = 60,
+        deadlines: Optional[Deadlines] = None,
+    ):
+        self.sender = sender
+        self.hedge_delay = hedge_delay
+        self.down_time = down_time
+        self.max_connections = max_connections
+        self.max_recipients = max_recipients
+        self.max_idle_time = max_idle_time
+        self.rate_controller = rate_controller
+        self._session_kwargs = dict(
+            sender=sender,
+            port=port,
+            skip_tls=skip_tls,
+            tls_context=tls_context,
+            local_hostname=local_hostname,
+            timeout=timeout,
+            debug=debug,
+            socket_options=socket_options,
+            deadlines=deadlines,
+        )
+        if proxy_pool is None and proxy_type:
+            # Validates the proxy type early, raising `UnknownProxyError`
+            proxy = Proxy(
+                proxy_type=proxy_type,
+                addr=proxy_addr,
+                port=proxy_port,
+                username=proxy_username,
+                password=proxy_password,
+                rdns=proxy_rdns,
+            )
+            proxy_pool = ProxyPool([proxy])
+        self.proxy_pool = proxy_pool
+        self._idle: Dict[tuple, List[SMTPSession]] = defaultdict(list)
+        self._semaphores: Dict[tuple, trio.Semaphore] = {}
+        self.starttls_support: Dict[str, bool] = {}
+        # Lowered by the 452 replies of the hosts
+        self._recipients_limits: Dict[str, int] = {}
+        # Until when the hosts which failed to connect are avoided
+        self._down: Dict[str, float] = {}
+        self._race_locks: Dict[Tuple[str, ...], trio.Lock] = {}
+        self.batcher = (
+            RcptBatcher(self, window=coalesce_window) if coalesce_window is not None else None
+        )
+        self.probes = SingleFlight()
+
+    def _key(self, host: str, proxy: Optional[Proxy]) -> tuple:
+        return (host,) + (proxy.key if proxy else (None, None, None))
+
+    def _semaphore(self, key: tuple) -> trio.Semaphore:
+        if key not in self._semaphores:
+            self._semaphores[key] = trio.Semaphore(self.max_connections)
+        return self._semaphores[key]
+
+    async def _pop_idle(self, key: tuple) -> Optional[SMTPSession]:
+        idle = self._idle[key]
+        while idle:
+            session = idle.pop()
+            if trio.current_time() - session.last_used <= self.max_idle_time:
+                return session
+            # Too old, the server most likely closed it already
+            await session.close()
+        return None
+
+    def _record(self, session: SMTPSession):
+        if session.supports_starttls is not None:
+            self.starttls_support[session.host] = session.supports_starttls
+        if session.max_recipients < self.recipients_limit(session.host):
+            self._recipients_limits[session.host] = session.max_recipients
+
+    def recipients_limit(self, host: str) -> int:
+        "The recipients per transaction `host` accepts, as far as known."
+        return self._recipients_limits.get(host, self.max_recipients)
+
+    @asynccontextmanager
+    async def session(self, host: str) -> AsyncIterator[SMTPSession]:
+        """
+        Check out a session for `host`, waiting if `max_connections`
+        sessions are already in use.
+
+        The session may or may not be connected yet; call
+        `ensure_transaction` (or `rcpt`) before use. It is reset and
+        returned to the pool on a clean exit, and closed if the body
+        raised.
+        """
+        proxy = self.proxy_pool.select(host) if self.proxy_pool else None
+        key = self._key(host, proxy)
+        rate_limiter = self.rate_controller.get(key) if self.rate_controller else None
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(self._semaphore(key))
+            if rate_limiter:
+                await stack.enter_async_context(rate_limiter.slot())
+            if proxy:
+                await stack.enter_async_context(proxy.slot())
+            session = await self._pop_idle(key)
+            if session is not None:
+                # Learned by another session meanwhile
+                session.max_recipients = min(session.max_recipients, self.recipients_limit(host))
+            else:
+                session = SMTPSession(
+                    host=host,
+                    max_recipients=self.recipients_limit(host),
+                    rate_limiter=rate_limiter,
+                    proxy=proxy,
+                    **self._session_kwargs,
+                )
+            labels = dict(mx=host, proxy=f"{proxy.addr}:{proxy.port}" if proxy else "")
+            SESSIONS_IN_USE.inc(**labels)
+            try:
+                yield session
+            except BaseException as exc:
+                if isinstance(exc, SMTPServerDisconnected) and (
+                    # Never got through the greeting, or too slow to set up a session
+                    session.supports_starttls is None
+                    or (isinstance(exc, SMTPStageTimeout) and exc.stage != "rcpt")
+                ):
+                    self._mark_down(host)
+                self._record(session)
+                with trio.CancelScope(shield=True):
+                    await session.close()
+                raise
+            finally:
+                SESSIONS_IN_USE.dec(**labels)
+            self._record(session)
+            try:
+                if session.connected:
+                    await session.reset()
+            except (SMTPServerDisconnected, SMTPResponseException):
+                # The work is done, the session just isn't reusable
+                await session.close()
+            if rate_limiter and len(self._idle[key]) + rate_limiter.in_flight > rate_limiter.limit:
+                # Backed off: don't keep more connections open than allowed to work
+                await session.quit()
+            if session.connected:
+                session.last_used = trio.current_time()
+                self._idle[key].append(session)
+
+    def _mark_down(self, host: str):
+        self._down[host] = trio.current_time() + self.down_time
+
+    def _is_down(self, host: str) -> bool:
+        return self._down.get(host, 0) > trio.current_time()
+
+    def _is_up(self, host: str) -> bool:
+        "Whether a session of `host` got through the greeting, and it didn't fail since."
+        return host in self.starttls_support and not self._is_down(host)
+
+    async def order_hosts(self, hosts: List[str]) -> List[str]:
+        """
+        The order to try `hosts` (sorted by preference) in: hosts which
+        recently failed to connect go last.
+
+        With a `hedge_delay`, if the first host isn't known to be up, the
+        hosts are raced Happy-Eyeballs style: a connection is attempted
+        to the first one, and to the next one whenever an attempt failed
+        or `hedge_delay` seconds passed without a greeting. The first host
+        to complete the greeting goes first, its session kept in the pool,
+        and the other attempts are cancelled. A dead or blackholed host
+        thus costs `hedge_delay` instead of a full timeout.
+
+        Concurrent checks of the same hosts wait for a single race.
+        """
+        ordered = [host for host in hosts if not self._is_down(host)]
+        ordered += [host for host in hosts if self._is_down(host)]
+        if self.hedge_delay is None or not ordered or self._is_up(ordered[0]):
+            return ordered
+        lock = self._race_locks.setdefault(tuple(hosts), trio.Lock())
+        async with lock:
+            if self._is_up(ordered[0]):
+                return ordered
+            winner = await self._race(ordered)
+        if winner is None:
+            return ordered
+        return [winner] + [host for host in ordered if host != winner]
+
+    async def _race(self, hosts: List[str]) -> Optional[str]:
+        "Race connections to `hosts` (see `order_hosts`), returning the winner if any."
+        winner = None
+
+        async def attempt(host: str, failed: trio.Event):
+            nonlocal winner
+            try:
+                async with self.session(host) as session:
+                    await session.ensure_connected()
+            except (SMTPServerDisconnected, SMTPResponseException, TLSNegotiationError) as exc:
+                logger.debug("Connecting to %s failed: %r", host, exc)
+                self._mark_down(host)
+                failed.set()
+                return
+            if winner is None:
+                winner = host
+                nursery.cancel_scope.cancel()
+
+        async with trio.open_nursery() as nursery:
+            for host in hosts:
+                failed = trio.Event()
+                nursery.start_soon(attempt, host, failed)
+                with trio.move_on_after(self.hedge_delay):
+                    await failed.wait()
+        return winner
+
+    async def aclose(self):
+        "QUIT all idle sessions."
+        sessions = [session for idle in self._idle.values() for session in idle]
+        self._idle.clear()
+        async with trio.open_nursery() as nursery:
+            for session in sessions:
+                nursery.start_soon(session.quit)
+
+    async def __aenter__(self) -> "SMTPPool":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+
+class _Batch:
+    "The RCPT requests of several checks, sent together over one session."
+
+    def __init__(self):
+        self.requests: List[List[str]] = []
+        self.size = 0
+        self.full = trio.Event()
+        self.done = trio.Event()
+        self.replies: List[List[Tuple[int, bytes]]] = []
+        self.error: Optional[Exception] = None
+        self.command = None
+        # Whether the batch was given up before its replies were known
+        self.abandoned = False
+
+
+class BatchedSession:
+    """
+    What a check sees of an MX through an `RcptBatcher`: `rcpt_many`
+    (and `rcpt`) like an `SMTPSession`'s, without holding one.
+    """
+
+    def __init__(self, batcher: "RcptBatcher", host: str):
+        self.batcher = batcher
+        self.host = host
+        self.command = None
+
+    def has_extn(self, opt: str) -> bool:
+        "Whether the server advertised `opt`, as far as known."
+        features = self.batcher.features.get(self.host)
+        return features is None or opt.lower() in features
+
+    async def rcpt(self, recip: str, options: tuple = None) -> Tuple[int, bytes]:
+        return (await self.rcpt_many([recip], options))[0]
+
+    async def rcpt_many(self, recips: List[str], options: tuple = None) -> List[Tuple[int, bytes]]:
+        return await self.batcher.rcpt_many(self, recips, options)
+
+
+class RcptBatcher:
+    """
+    Coalesces the RCPTs of concurrent checks headed to the same MX into
+    shared transactions, so a session carries up to `max_batch` (by
+    default the pool's `max_recipients`) recipients per MAIL FROM
+    instead of one Person's few candidates.
+
+    The first request for a host opens a batch and waits `window`
+    seconds (or until the batch is full) for others to join, then sends
+    the whole batch over a pooled session, pipelined if supported, and
+    hands each request its replies. Meanwhile, new requests open the
+    next batch. A failure of the session (disconnect, negative reply to
+    MAIL FROM, TLS failure) is raised to every request of the batch. If
+    the check sending a batch is cancelled, the other requests are sent
+    again in a new batch, so one check's budget doesn't cut the others'.
+
+    For servers known not to pipeline, batches don't wait, as lockstep
+    RCPTs take a round trip each anyway.
+    """
+
+    def __init__(self, pool: SMTPPool, window: float = 0.05, max_batch: Optional[int] = None):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch or pool.max_recipients
+        # The ESMTP features of the hosts, from their last session
+        self.features: Dict[str, Dict[str, str]] = {}
+        self._open: Dict[str, _Batch] = {}
+
+    @asynccontextmanager
+    async def session(self, host: str) -> AsyncIterator[BatchedSession]:
+        "The counterpart of `SMTPPool.session`."
+        yield BatchedSession(self, host)
+
+    async def rcpt_many(
+        self, view: BatchedSession, recips: List[str], options: tuple = None
+    ) -> List[Tuple[int, bytes]]:
+        if not recips:
+            return []
+        host = view.host
+        while True:
+            batch = self._open.get(host)
+            leader = batch is None
+            if leader:
+                batch = self._open[host] = _Batch()
+            index = len(batch.requests)
+            batch.requests.append(recips)
+            batch.size += len(recips)
+            if batch.size >= self.max_batch:
+                self._close(host, batch)
+                batch.full.set()
+
+            if leader:
+                await self._send(host, batch, options)
+            else:
+                await batch.done.wait()
+            if not batch.abandoned:
+                break
+        view.command = batch.command
+        if batch.error is not None:
+            # Each check gets its own exception to raise
+            raise copy.copy(batch.error) from batch.error
+        return batch.replies[index]
+
+    def _close(self, host: str, batch: _Batch):
+        "Let new requests open the next batch."
+        if self._open.get(host) is batch:
+            del self._open[host]
+
+    async def _send(self, host: str, batch: _Batch, options: tuple = None):
+        try:
+            features = self.features.get(host)
+            if features is None or "pipelining" in features:
+                with trio.move_on_after(self.window):
+                    await batch.full.wait()
+            self._close(host, batch)
+            recips = [recip for request in batch.requests for recip in request]
+            async with self.pool.session(host) as session:
+                try:
+                    replies = await session.rcpt_many(recips, options)
+                finally:
+                    batch.command = session.command
+                    if session.connected:
+                        self.features[host] = dict(session.esmtp_features)
+            for request in batch.requests:
+                batch.replies.append(replies[: len(request)])
+                replies = replies[len(request) :]
+        except (SMTPServerDisconnected, SMTPResponseException, TLSNegotiationError) as exc:
+            batch.error = exc
+        except BaseException:
+            # The leader was cancelled (e.g. its Person's budget ran out): the
+            # session was dropped, so the other requests are sent again
+            self._close(host, batch)
+            batch.abandoned = True
+            raise
+        finally:
+            batch.done.set()
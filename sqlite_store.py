@@ -0,0 +1,125 @@
+# External imports
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, List, Optional, Sequence, Tuple
+import trio
+
+# Local imports
+from logging_mod import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore:
+    """
+    Base of the on-disk (SQLite) stores, which keep the event loop off
+    the disk when written to during a run.
+
+    Reads are synchronous, as they're quick. Writes are queued, and
+    committed in batches in a worker thread by `run`, a background task
+    (see `run_writers`): every `flush_interval` seconds, or as soon as
+    `max_pending` writes are queued. Queued writes aren't visible to
+    reads until committed.
+
+    Without `run`, writes are committed by `flush`, or by `close`, which
+    must be called in any case.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_pending: int = 1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._conn = sqlite3.connect(path)
+        # Only used by one thread at a time: `run`'s worker, then `close`
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        # Readers don't wait for the writer's transactions
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._pending: List[Tuple[str, Sequence[tuple]]] = []
+        self._wakeup: Optional[trio.Event] = None
+
+    def _write(self, sql: str, rows: Iterable[tuple]):
+        "Queue `sql`, executed for each of the parameter `rows`."
+        self._pending.append((sql, list(rows)))
+        if self._wakeup is not None and len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def _commit(self, statements: List[Tuple[str, Sequence[tuple]]]):
+        with self._writer:
+            for sql, rows in statements:
+                self._writer.executemany(sql, rows)
+
+    def flush(self):
+        "Commit the queued writes, blocking until done."
+        statements, self._pending = self._pending, []
+        if statements:
+            self._commit(statements)
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        "Commit the queued writes in a worker thread as they come, until cancelled."
+        task_status.started()
+        while True:
+            self._wakeup = trio.Event()
+            with trio.move_on_after(self.flush_interval):
+                await self._wakeup.wait()
+            await self.aflush()
+
+    async def aflush(self):
+        "Commit the queued writes in a worker thread."
+        statements, self._pending = self._pending, []
+        if not statements:
+            return
+        try:
+            await trio.to_thread.run_sync(self._commit, statements)
+        except trio.Cancelled:
+            # Cancelled before the thread started: the writes are left for `close`
+            self._pending[:0] = statements
+            raise
+
+    def merge(self, path: str):
+        """
+        Copy the rows of the store of the same kind at `path` into this
+        one, replacing those of the same keys.
+        """
+        self.flush()
+        self._writer.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            tables = [
+                row[0]
+                for row in self._writer.execute(
+                    "SELECT name FROM other.sqlite_master WHERE type = 'table'"
+                )
+            ]
+            with self._writer:
+                for table in tables:
+                    columns = ", ".join(
+                        row[1] for row in self._writer.execute(f"PRAGMA other.table_info({table})")
+                    )
+                    self._writer.execute(
+                        f"INSERT OR REPLACE INTO main.{table} ({columns}) "
+                        f"SELECT {columns} FROM other.{table}"
+                    )
+        finally:
+            self._writer.execute("DETACH DATABASE other")
+
+    def close(self):
+        "Commit the writes left, and close the database."
+        self.flush()
+        self._writer.close()
+        self._conn.close()
+
+
+@asynccontextmanager
+async def run_writers(writers: Iterable) -> AsyncIterator[None]:
+    """
+    Commit the writes of the `writers` (`SQLiteStore`s, and `ResultSink`s
+    alike; None ones are skipped) in the background for the duration of
+    the block, and those left at its end.
+    """
+    writers = [writer for writer in writers if writer is not None]
+    async with trio.open_nursery() as nursery:
+        for writer in writers:
+            await nursery.start(writer.run)
+        yield
+        nursery.cancel_scope.cancel()
+    for writer in writers:
+        await writer.aflush()
@@ -0,0 +1,32 @@
+# External imports
+from contextlib import asynccontextmanager
+import pytest
+import trio
+
+# Local imports
+from fake_servers import FakeDNSServer, FakeSMTPServer
+
+
+@pytest.fixture
+def fake_domain():
+    """
+    Serve a fake domain on free ports, with its MX on 127.0.0.1:
+
+        async with fake_domain("example.test", deliverable=[...]) as (dns, smtp):
+            ...
+
+    The keyword arguments are those of `FakeSMTPServer`.
+    """
+
+    @asynccontextmanager
+    async def serve(domain: str, **smtp_kwargs):
+        dns = FakeDNSServer(port=0)
+        dns.add_domain(domain)
+        smtp = FakeSMTPServer(port=0, **smtp_kwargs)
+        async with trio.open_nursery() as nursery:
+            await nursery.start(dns.run)
+            await nursery.start(smtp.run)
+            yield dns, smtp
+            nursery.cancel_scope.cancel()
+
+    return serve
@@ -0,0 +1,130 @@
+# External imports
+from types import SimpleNamespace
+from dns import resolver
+from dns.exception import Timeout
+import pytest
+import trio
+
+# Local imports
+import dns_resolver
+from dns_resolver import AsyncResolver, DNSCache
+from exceptions import DNSLookupError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "A fake monotonic clock for the DNS cache, moved forward by `clock.now += ...`."
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(dns_resolver, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+class _Answer(list):
+    "The records of a stub answer, with its TTL."
+
+    def __init__(self, records, ttl):
+        super().__init__(
+            SimpleNamespace(to_text=lambda record=record: record) for record in records
+        )
+        self.rrset = SimpleNamespace(ttl=ttl)
+
+
+class _StubResolver:
+    """
+    Stands in for dnspython's resolver: answers the (name, rdtype) in
+    `answers` with their records, or raises their exception. Other
+    queries never get an answer.
+    """
+
+    def __init__(self, answers, ttl=60):
+        self.answers = answers
+        self.ttl = ttl
+        self.queries = []
+
+    async def resolve(self, name, rdtype):
+        self.queries.append((name, rdtype))
+        answer = self.answers.get((name, rdtype))
+        if answer is None:
+            await trio.sleep_forever()
+        if not isinstance(answer, list):
+            raise answer
+        return _Answer(answer, self.ttl)
+
+
+def _resolver(answers, ttl=60, **kwargs):
+    "An `AsyncResolver` querying a `_StubResolver` of `answers`, and the stub."
+    async_resolver = AsyncResolver(**kwargs)
+    async_resolver._resolver = _StubResolver(answers, ttl)
+    return async_resolver, async_resolver._resolver
+
+
+def test_cache_entries_expire_after_their_ttl(clock):
+    cache = DNSCache()
+    cache.set("key", ["record"], ttl=10)
+    cache.set("never", ["record"], ttl=0)
+    clock.now += 9
+    assert cache.get("key") == ["record"]
+    assert cache.get("never", None) is None
+    clock.now += 1
+    assert cache.get("key", None) is None
+    assert len(cache) == 0
+
+
+def test_cache_evicts_the_least_recently_used_entries(clock):
+    cache = DNSCache(max_size=2)
+    cache.set("a", ["1"], ttl=10)
+    cache.set("b", ["2"], ttl=10)
+    assert cache.get("a") == ["1"]
+    cache.set("c", ["3"], ttl=10)
+    assert cache.get("b", None) is None
+    assert cache.get("a") == ["1"]
+    assert cache.get("c") == ["3"]
+
+
+def test_answers_are_cached_for_their_ttl_capped(clock):
+    async def run():
+        async_resolver, stub = _resolver(
+            {("example.test", "MX"): ["10 mx.example.test."]}, ttl=7200, max_ttl=3600
+        )
+        assert await async_resolver.query_mx("example.test") == ["mx.example.test."]
+        assert await async_resolver.query_mx("EXAMPLE.test.") == ["mx.example.test."]
+        assert len(stub.queries) == 1
+        clock.now += 3600
+        await async_resolver.query_mx("example.test")
+        assert len(stub.queries) == 2
+
+    trio.run(run)
+
+
+def test_missing_records_are_cached_for_the_negative_ttl(clock):
+    async def run():
+        async_resolver, stub = _resolver(
+            {
+                ("missing.test", "MX"): resolver.NXDOMAIN,
+                ("empty.test", "MX"): resolver.NoAnswer,
+            },
+            negative_ttl=300,
+        )
+        for _ in range(2):
+            assert await async_resolver.query_mx("missing.test") is None
+            assert await async_resolver.query_mx("empty.test") is None
+        assert len(stub.queries) == 2
+        clock.now += 300
+        assert await async_resolver.query_mx("missing.test") is None
+        assert len(stub.queries) == 3
+
+    trio.run(run)
+
+
+def test_failed_queries_are_not_cached(clock):
+    async def run():
+        # One times out in dnspython, the other past the resolver's own timeout
+        async_resolver, stub = _resolver({("slow.test", "MX"): Timeout}, timeout=0.05)
+        for name in ("slow.test", "silent.test"):
+            for _ in range(2):
+                with pytest.raises(DNSLookupError):
+                    await async_resolver.query_mx(name)
+        assert len(stub.queries) == 4
+        assert len(async_resolver.cache) == 0
+
+    trio.run(run)
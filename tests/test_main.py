@@ -0,0 +1,181 @@
+# External imports
+import pytest
+import trio
+
+# Local imports
+from dns_resolver import AsyncResolver
+from domain_cache import DomainCache
+from exceptions import DNSLookupError, SMTPCatchAll, SMTPTemporaryError
+from main import discover_domain, main
+from result_store import ResultStore
+from results import DELIVERABLE, UNDELIVERABLE
+from retry import RetryPolicy
+from smtp_pool import SMTPPool
+
+FAST_RETRIES = RetryPolicy(initial_delay=0.1, greylist_delay=0.3, max_attempts=3, jitter=0)
+
+
+async def _discover(dns, smtp, **kwargs):
+    async with SMTPPool(sender="me@sender.test", port=smtp.port) as pool:
+        return await discover_domain(
+            domain_str="example.test", dns_resolver=dns.resolver(), pool=pool, **kwargs
+        )
+
+
+def test_catch_all_domain_is_detected_and_cached(fake_domain, tmp_path):
+    async def run():
+        cache = DomainCache(str(tmp_path / "domains.db"))
+        async with fake_domain("example.test", catch_all=["example.test"]) as (dns, smtp):
+            with pytest.raises(SMTPCatchAll):
+                await _discover(dns, smtp, domain_cache=cache)
+            cache.flush()
+            assert cache.get("example.test").catch_all
+        async with fake_domain("example.test") as (dns, smtp):
+            assert await _discover(dns, smtp) == ["127.0.0.1"]
+
+    trio.run(run)
+
+
+def test_greylisted_catch_all_probe_is_retried(fake_domain, tmp_path):
+    async def run():
+        cache = DomainCache(str(tmp_path / "domains.db"))
+        async with fake_domain(
+            "example.test", catch_all=["example.test"], greylist_time=0.2
+        ) as (dns, smtp):
+            # Without retries the status is unknown, and not cached
+            with pytest.raises(SMTPTemporaryError):
+                await _discover(dns, smtp, domain_cache=cache)
+            cache.flush()
+            assert cache.get("example.test").catch_all is None
+
+            with pytest.raises(SMTPCatchAll):
+                await _discover(dns, smtp, domain_cache=cache, retry_policy=FAST_RETRIES)
+
+    trio.run(run)
+
+
+def test_greylisted_addresses_are_retried(fake_domain, tmp_path):
+    names_file = tmp_path / "names.csv"
+    names_file.write_text("john,smith\n")
+
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=["john.smith@example.test"], greylist_time=0.2
+        ) as (dns, smtp):
+            found = await main(
+                "example.test",
+                str(names_file),
+                dns_resolver=dns.resolver(),
+                smtp_port=smtp.port,
+                retry_policy=FAST_RETRIES,
+                report=False,
+            )
+        assert found == {"john.smith@example.test"}
+
+    trio.run(run)
+
+
+def test_retried_person_is_learned_once(fake_domain, tmp_path):
+    names_file = tmp_path / "names.csv"
+    names_file.write_text("john,smith\n")
+    cache_path = str(tmp_path / "domains.db")
+
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=["john.smith@example.test"], greylist_time=0.2
+        ) as (dns, smtp):
+            await main(
+                "example.test",
+                str(names_file),
+                dns_resolver=dns.resolver(),
+                smtp_port=smtp.port,
+                retry_policy=FAST_RETRIES,
+                domain_cache_path=cache_path,
+                report=False,
+            )
+
+    trio.run(run)
+    cache = DomainCache(cache_path)
+    try:
+        stats = cache.get_patterns("example.test")
+    finally:
+        cache.close()
+    assert (stats["persons"], stats["found"]) == (1, 1)
+
+
+def test_results_are_committed_on_exit(fake_domain, tmp_path):
+    names_file = tmp_path / "names.csv"
+    names_file.write_text("john,smith\n")
+    store_path = str(tmp_path / "results.db")
+
+    async def run():
+        async with fake_domain("example.test", deliverable=["john.smith@example.test"]) as (
+            dns,
+            smtp,
+        ):
+            await main(
+                "example.test",
+                str(names_file),
+                dns_resolver=dns.resolver(),
+                smtp_port=smtp.port,
+                result_store_path=store_path,
+                report=False,
+            )
+
+    trio.run(run)
+    store = ResultStore(store_path)
+    try:
+        assert store.get("john.smith@example.test").verdict == DELIVERABLE
+        assert store.get("smith.john@example.test").verdict == UNDELIVERABLE
+    finally:
+        store.close()
+
+
+def test_failed_dns_lookup_is_not_cached_as_no_mx(tmp_path):
+    async def run():
+        cache = DomainCache(str(tmp_path / "domains.db"))
+        # A nameserver which never answers
+        with trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM) as silent:
+            await silent.bind(("127.0.0.1", 0))
+            dns_resolver = AsyncResolver(["127.0.0.1"], port=silent.getsockname()[1], timeout=0.2)
+            async with SMTPPool(sender="me@sender.test") as pool:
+                with pytest.raises(DNSLookupError):
+                    await discover_domain(
+                        domain_str="example.test",
+                        dns_resolver=dns_resolver,
+                        pool=pool,
+                        domain_cache=cache,
+                    )
+        cache.close()
+        cache = DomainCache(str(tmp_path / "domains.db"))
+        assert cache.get("example.test").mx_records is None
+        cache.close()
+
+    trio.run(run)
+
+
+def test_throttled_discovery_is_retried(fake_domain, tmp_path):
+    async def run():
+        cache = DomainCache(str(tmp_path / "domains.db"))
+        # Every connection is refused with a 421 at first
+        async with fake_domain("example.test", max_connections=0) as (dns, smtp):
+            with pytest.raises(SMTPTemporaryError):
+                await _discover(dns, smtp, domain_cache=cache)
+            cache.flush()
+            assert cache.get("example.test").temporary_errors
+
+            async def lift_throttling():
+                await trio.sleep(0.2)
+                smtp.max_connections = None
+
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(lift_throttling)
+                mx_records = await _discover(
+                    dns, smtp, domain_cache=cache, retry_policy=FAST_RETRIES
+                )
+            assert mx_records == ["127.0.0.1"]
+            cache.flush()
+            assert not cache.get("example.test").temporary_errors
+        cache.close()
+
+    trio.run(run)
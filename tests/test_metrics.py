@@ -0,0 +1,10 @@
+# Local imports
+from metrics import PrometheusExporter, make_exporters
+
+
+def test_metrics_are_served_locally_by_default():
+    (exporter,) = make_exporters(metrics_port=9464)
+    assert isinstance(exporter, PrometheusExporter)
+    assert exporter.host == "127.0.0.1"
+    (exporter,) = make_exporters(metrics_port=9464, metrics_host="")
+    assert exporter.host == ""
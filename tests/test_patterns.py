@@ -0,0 +1,31 @@
+# External imports
+import pytest
+
+# Local imports
+from patterns import DEFAULT_ENGINE, PatternEngine, PatternError
+from person import Person
+
+
+def test_templates_expand_in_order_without_duplicates():
+    engine = PatternEngine(["{first}.{last}", "{f}{last}", "{first}{l3}", "{f}{l}", "info"])
+    assert engine.addresses(Person("John", "Smith"), "example.test") == [
+        "john.smith@example.test",
+        "jsmith@example.test",
+        "johnsmi@example.test",
+        "js@example.test",
+        "info@example.test",
+    ]
+    # Templates collide for short names
+    assert DEFAULT_ENGINE.templated(Person("Jo", "Li"), "example.test")["joli@example.test"] == (
+        "{f2}{last}",
+        "{first}{l3}",
+        "{first}{last}",
+    )
+
+
+@pytest.mark.parametrize(
+    "template", ["", "{middle}", "{first2}", "{first!r}", "{f:>3}", "{first} {last}", ".{last}"]
+)
+def test_invalid_templates_are_rejected(template):
+    with pytest.raises(PatternError):
+        PatternEngine([template])
@@ -0,0 +1,59 @@
+# External imports
+import json
+import threading
+import trio
+
+# Local imports
+from person import Person
+from result_sink import open_sink
+from results import AddressResult, DELIVERABLE
+from sqlite_store import run_writers
+
+
+def _result(index):
+    return AddressResult(
+        address=f"user{index}@example.test",
+        verdict=DELIVERABLE,
+        mx="mx.example.test",
+        code=250,
+        text="OK",
+        checked_at=0,
+    )
+
+
+def test_records_are_written_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    sink = open_sink(path, buffer_size=10, flush_interval=60)
+    threads = []
+    write_records = sink._write_records
+
+    def _write_records(records):
+        threads.append(threading.current_thread())
+        write_records(records)
+
+    sink._write_records = _write_records
+
+    async def run():
+        async with run_writers([sink]):
+            for index in range(25):
+                sink.write(Person("john", "smith"), _result(index))
+            # The full buffers are written in the background, not by `write`
+            assert not threads
+
+    trio.run(run)
+    assert threads and threading.main_thread() not in threads
+    assert sink.written == 25
+    sink.close()
+    with open(path, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file]
+    assert [record["address"] for record in records] == [_result(i).address for i in range(25)]
+
+
+def test_records_are_written_synchronously_outside_a_run(tmp_path):
+    path = str(tmp_path / "results.csv")
+    with open_sink(path, buffer_size=2) as sink:
+        for index in range(3):
+            sink.write(Person("john", "smith"), _result(index))
+        assert sink.written == 2
+    with open(path, encoding="utf-8") as file:
+        assert len(file.readlines()) == 4
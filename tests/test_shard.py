@@ -0,0 +1,69 @@
+# External imports
+import time
+
+# Local imports
+from result_store import ResultStore
+from results import AddressResult, DELIVERABLE, UNDELIVERABLE
+from shard import _Dispatcher, _Merger
+
+
+def test_expired_lease_is_handed_out_again():
+    dispatcher = _Dispatcher(lease_time=0.1, seeds={})
+    dispatcher.add((0, "batch", ["a,b,c.test\n"], {}))
+    assert dispatcher.take()[0] == 0
+    assert dispatcher.take() is None
+    assert not dispatcher.finished()
+
+    # The first worker died: its shard is handed out again
+    time.sleep(0.15)
+    assert dispatcher.take()[0] == 0
+    dispatcher.finish(0, {"c.test": set()}, None, {})
+    # The first worker was only slow: its result doesn't count twice
+    dispatcher.finish(0, {"c.test": set()}, None, {})
+    assert dispatcher.finished()
+    assert dispatcher.result(0)[0] == 0
+    assert dispatcher.result(0) is None
+
+
+def test_renewed_lease_is_kept():
+    dispatcher = _Dispatcher(lease_time=0.1, seeds={})
+    dispatcher.add((0, "batch", ["a,b,c.test\n"], {}))
+    dispatcher.take()
+    for _ in range(3):
+        time.sleep(0.05)
+        dispatcher.renew(0)
+    assert dispatcher.take() is None
+
+
+def _result(address, verdict):
+    return AddressResult(address, verdict, "mx", 250, "", 0.0)
+
+
+def test_shard_files_are_merged_into_the_run_files(tmp_path):
+    output_file = tmp_path / "out.csv"
+    store_path = str(tmp_path / "results.db")
+    merger = _Merger(
+        dict(output_file=str(output_file), output_format="csv", result_store_path=store_path)
+    )
+    for index, verdict in enumerate((DELIVERABLE, UNDELIVERABLE)):
+        shard_store_path = str(tmp_path / f"shard{index}.db")
+        shard_store = ResultStore(shard_store_path)
+        shard_store.record(_result(f"user{index}@example.test", verdict))
+        shard_store.close()
+        with open(shard_store_path, "rb") as file:
+            store = file.read()
+        output = f"person,address\njohn smith,user{index}@example.test\n".encode()
+        merger.merge(dict(output_file=output, result_store_path=store))
+    merger.close()
+
+    assert output_file.read_text().splitlines() == [
+        "person,address",
+        "john smith,user0@example.test",
+        "john smith,user1@example.test",
+    ]
+    store = ResultStore(store_path)
+    try:
+        assert store.get("user0@example.test").verdict == DELIVERABLE
+        assert store.get("user1@example.test").verdict == UNDELIVERABLE
+    finally:
+        store.close()
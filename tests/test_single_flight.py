@@ -0,0 +1,77 @@
+# External imports
+import trio
+
+# Local imports
+from results import AddressResult, DELIVERABLE, TEMPORARY
+from single_flight import Flight, SingleFlight
+
+ADDRESS = "john.smith@example.test"
+
+
+def _result(verdict):
+    return AddressResult(
+        address=ADDRESS, verdict=verdict, mx="mx.example.test", code=250, text="", checked_at=0
+    )
+
+
+def test_waiters_share_the_result_of_the_probe():
+    async def run():
+        probes = SingleFlight()
+        assert probes.claim(ADDRESS) is None
+        waited = []
+
+        async def wait():
+            flight = probes.claim(ADDRESS.upper())
+            assert isinstance(flight, Flight)
+            waited.append(await flight.wait())
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(wait)
+            await trio.sleep(0.01)
+            assert not waited
+            probes.release(ADDRESS, _result(DELIVERABLE))
+        assert [result.verdict for result in waited] == [DELIVERABLE] * 3
+        # Settled, it's never probed again
+        assert probes.claim(ADDRESS).verdict == DELIVERABLE
+        assert len(probes) == 1
+
+    trio.run(run)
+
+
+def test_waiters_claim_again_after_a_failed_probe():
+    async def run():
+        probes = SingleFlight()
+        assert probes.claim(ADDRESS) is None
+        waited = []
+
+        async def wait():
+            result = await probes.claim(ADDRESS).wait()
+            # The probe failed without a result: the first waiter takes over
+            waited.append((result, probes.claim(ADDRESS)))
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(wait)
+            nursery.start_soon(wait)
+            await trio.sleep(0.01)
+            probes.release(ADDRESS, None)
+        (result, claim), (other_result, other_claim) = waited
+        assert result is None and other_result is None
+        assert claim is None
+        assert isinstance(other_claim, Flight)
+        assert len(probes) == 0
+
+    trio.run(run)
+
+
+def test_temporary_results_are_shared_but_not_kept():
+    async def run():
+        probes = SingleFlight()
+        probes.claim(ADDRESS)
+        flight = probes.claim(ADDRESS)
+        probes.release(ADDRESS, _result(TEMPORARY))
+        assert (await flight.wait()).verdict == TEMPORARY
+        # A retry probes it again
+        assert probes.claim(ADDRESS) is None
+
+    trio.run(run)
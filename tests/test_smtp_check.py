@@ -0,0 +1,258 @@
+# External imports
+from smtplib import SMTPServerDisconnected
+import trio
+
+# Local imports
+from deadlines import Deadlines
+from fake_servers import FakeSMTPServer
+from person import Person
+from results import DELIVERABLE, TEMPORARY, TIMED_OUT, UNDELIVERABLE
+from smtp_check import _SMTPChecker, smtp_check
+from smtp_pool import SMTPPool
+
+ADDRESSES = [f"user{index}@example.test" for index in range(10)]
+
+
+async def _check(smtp, addresses, **pool_kwargs):
+    address_results = {}
+    async with SMTPPool(sender="me@sender.test", port=smtp.port, **pool_kwargs) as pool:
+        found = await smtp_check(
+            email_addresses=addresses,
+            mx_records=[smtp.host],
+            from_address=pool.sender,
+            final_results=set(),
+            entity=Person("john", "smith"),
+            pool=pool,
+            address_results=address_results,
+            probe_digits=False,
+        )
+    return found, {address: result.verdict for address, result in address_results.items()}
+
+
+def test_pipelined_rcpts_share_a_round_trip(fake_domain):
+    async def run():
+        for pipelining in (True, False):
+            async with fake_domain(
+                "example.test", deliverable=ADDRESSES[3:4], pipelining=pipelining
+            ) as (_, smtp):
+                found, verdicts = await _check(smtp, ADDRESSES)
+            assert found
+            assert verdicts == {
+                address: DELIVERABLE if address == ADDRESSES[3] else UNDELIVERABLE
+                for address in ADDRESSES
+            }
+            rcpt_round_trips = smtp.stats["round_trips"] - 3  # EHLO, MAIL FROM and QUIT
+            if pipelining:
+                assert rcpt_round_trips < 3
+            else:
+                assert rcpt_round_trips >= len(ADDRESSES)
+
+    trio.run(run)
+
+
+def test_greylisted_rcpt_is_temporary_then_deliverable(fake_domain):
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=ADDRESSES[:1], greylist_time=0.2
+        ) as (_, smtp):
+            found, verdicts = await _check(smtp, ADDRESSES[:1])
+            assert not found
+            assert verdicts == {ADDRESSES[0]: TEMPORARY}
+
+            await trio.sleep(0.3)
+            found, verdicts = await _check(smtp, ADDRESSES[:1])
+            assert found
+            assert verdicts == {ADDRESSES[0]: DELIVERABLE}
+
+    trio.run(run)
+
+
+def test_rcpts_past_the_recipients_limit_are_resent(fake_domain):
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=ADDRESSES[8:], max_recipients=4
+        ) as (_, smtp):
+            _, verdicts = await _check(smtp, ADDRESSES)
+            assert verdicts == {
+                address: DELIVERABLE if address in ADDRESSES[8:] else UNDELIVERABLE
+                for address in ADDRESSES
+            }
+            assert smtp.stats["accepted"] == 2
+
+    trio.run(run)
+
+
+def test_rcpt_past_its_deadline_is_timed_out(fake_domain):
+    async def run():
+        async with fake_domain("example.test", latency=0.2) as (_, smtp):
+            found, verdicts = await _check(smtp, ADDRESSES[:3], deadlines=Deadlines(rcpt=0.05))
+        assert not found
+        assert verdicts == {address: TIMED_OUT for address in ADDRESSES[:3]}
+
+    trio.run(run)
+
+
+def test_silent_primary_mx_fails_over_to_the_backup():
+    async def run():
+        for coalesce_window in (None, 0.01):
+            silent = FakeSMTPServer(host="127.0.0.2", port=0, latency=60)
+            backup = FakeSMTPServer(host="127.0.0.3", port=0, deliverable=ADDRESSES[:1])
+            async with trio.open_nursery() as nursery:
+                await nursery.start(silent.run)
+                backup.port = silent.port
+                await nursery.start(backup.run)
+                async with SMTPPool(
+                    sender="me@sender.test",
+                    port=silent.port,
+                    hedge_delay=None,
+                    coalesce_window=coalesce_window,
+                    deadlines=Deadlines(greeting=0.2),
+                ) as pool:
+                    address_results = {}
+                    found = await smtp_check(
+                        email_addresses=ADDRESSES[:2],
+                        mx_records=[silent.host, backup.host],
+                        from_address=pool.sender,
+                        final_results=set(),
+                        entity=Person("john", "smith"),
+                        pool=pool,
+                        address_results=address_results,
+                        probe_digits=False,
+                    )
+                    assert pool._is_down(silent.host)
+                nursery.cancel_scope.cancel()
+            assert found == {ADDRESSES[0]}
+            assert {address: result.verdict for address, result in address_results.items()} == {
+                ADDRESSES[0]: DELIVERABLE,
+                ADDRESSES[1]: UNDELIVERABLE,
+            }
+
+    trio.run(run)
+
+
+def test_duplicate_probes_of_concurrent_checks_share_one_rcpt(fake_domain):
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=ADDRESSES[:1], latency=0.05
+        ) as (_, smtp):
+            async with SMTPPool(sender="me@sender.test", port=smtp.port) as pool:
+                checks = []
+
+                async def check(entity):
+                    address_results = {}
+                    await smtp_check(
+                        email_addresses=ADDRESSES[:4],
+                        mx_records=[smtp.host],
+                        from_address=pool.sender,
+                        final_results=set(),
+                        entity=entity,
+                        pool=pool,
+                        address_results=address_results,
+                        probe_digits=False,
+                    )
+                    checks.append(
+                        {address: result.verdict for address, result in address_results.items()}
+                    )
+
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(check, Person("john", "smith"))
+                    nursery.start_soon(check, Person("john", "smith"))
+        assert smtp.stats["rcpt"] == 4
+        expected = {
+            address: DELIVERABLE if address == ADDRESSES[0] else UNDELIVERABLE
+            for address in ADDRESSES[:4]
+        }
+        assert checks == [expected, expected]
+
+    trio.run(run)
+
+
+class _StubSession:
+    "An `SMTPSession` answering the RCPTs once `proceed` is set, or raising `failure`."
+
+    def __init__(self, host: str, failure: Exception = None):
+        self.host = host
+        self.failure = failure
+        self.proceed = trio.Event()
+        self.sent = []
+
+    async def rcpt_many(self, recips, options=None):
+        self.sent.append(list(recips))
+        await self.proceed.wait()
+        if self.failure is not None:
+            raise self.failure
+        return [(250, b"OK") if recip == ADDRESSES[0] else (550, b"No") for recip in recips]
+
+
+def _checker(pool):
+    return _SMTPChecker(
+        pool=pool, recip=ADDRESSES[:2], final_results=set(), entity=Person("john", "smith")
+    )
+
+
+async def _leader_and_waiter(leader_session: _StubSession, interrupt):
+    """
+    Probe the addresses with a leading check over `leader_session`, and
+    a waiting one, then `interrupt` the leader's probe.
+
+    :returns: The waiting check, and its session.
+    """
+    async with SMTPPool(sender="me@sender.test") as pool:
+        leader, waiter = _checker(pool), _checker(pool)
+        waiter_session = _StubSession("mx.example.test")
+        waiter_session.proceed.set()
+        # A waiter never woken up fails instead of hanging
+        with trio.fail_after(5):
+            async with trio.open_nursery() as nursery:
+                leader_scope = trio.CancelScope()
+
+                async def lead():
+                    with leader_scope:
+                        try:
+                            await leader.rcpt_many(leader_session, ADDRESSES[:2])
+                        except SMTPServerDisconnected:
+                            pass
+
+                nursery.start_soon(lead)
+                await trio.sleep(0.01)
+                nursery.start_soon(waiter.rcpt_many, waiter_session, ADDRESSES[:2])
+                await trio.sleep(0.01)
+                # The waiter waits for the leader's probe
+                assert not waiter_session.sent
+                interrupt(leader_session, leader_scope)
+    return waiter, waiter_session
+
+
+def test_waiting_check_shares_the_verdicts_of_the_leader():
+    async def run():
+        leader_session = _StubSession("mx.example.test")
+        waiter, waiter_session = await _leader_and_waiter(
+            leader_session, lambda session, scope: session.proceed.set()
+        )
+        assert leader_session.sent == [ADDRESSES[:2]]
+        assert not waiter_session.sent
+        assert {address: result.verdict for address, result in waiter.address_results.items()} == {
+            ADDRESSES[0]: DELIVERABLE,
+            ADDRESSES[1]: UNDELIVERABLE,
+        }
+
+    trio.run(run)
+
+
+def test_waiting_check_probes_itself_after_the_leader_failed_or_was_cancelled():
+    def fail(session, scope):
+        session.proceed.set()
+
+    def cancel(session, scope):
+        scope.cancel()
+
+    async def run():
+        for interrupt in (fail, cancel):
+            leader_session = _StubSession("mx.example.test", failure=SMTPServerDisconnected())
+            waiter, waiter_session = await _leader_and_waiter(leader_session, interrupt)
+            assert waiter_session.sent == [ADDRESSES[:2]]
+            assert {
+                address: result.verdict for address, result in waiter.address_results.items()
+            } == {ADDRESSES[0]: DELIVERABLE, ADDRESSES[1]: UNDELIVERABLE}
+
+    trio.run(run)
@@ -0,0 +1,45 @@
+# External imports
+from functools import partial
+import pytest
+import trio
+import trio.testing
+
+# Local imports
+from exceptions import TLSNegotiationError
+from smtp_client import SMTPClient
+
+# Replies to the greeting, EHLO and STARTTLS, the latter with an injected one
+REPLIES = [b"220 fake.local ESMTP\r\n", b"250-fake.local\r\n250 STARTTLS\r\n"]
+INJECTED = b"220 2.0.0 Ready to start TLS\r\n250 2.1.0 Injected\r\n"
+
+
+async def _serve(received: list, stream: trio.SocketStream):
+    for reply in REPLIES:
+        await stream.send_all(reply)
+        data = b""
+        while not data.endswith(b"\r\n"):
+            data += await stream.receive_some(1024)
+    await stream.send_all(INJECTED)
+    # What the client sent next: its TLS handshake, if it went on
+    received.append(await stream.receive_some(1024))
+
+
+def test_plaintext_sent_past_the_starttls_reply_is_refused():
+    async def run():
+        async with trio.open_nursery() as nursery:
+            received = []
+            listeners = await nursery.start(
+                partial(trio.serve_tcp, partial(_serve, received), 0, host="127.0.0.1")
+            )
+            port = listeners[0].socket.getsockname()[1]
+            client = SMTPClient(local_hostname="me.test", timeout=5)
+            await client.connect("127.0.0.1", port)
+            with pytest.raises(TLSNegotiationError):
+                await client.starttls()
+            assert not client.connected
+            await trio.testing.wait_all_tasks_blocked()
+            # The connection was dropped before the handshake
+            assert received == [b""]
+            nursery.cancel_scope.cancel()
+
+    trio.run(run)
@@ -0,0 +1,136 @@
+# External imports
+import trio
+
+# Local imports
+from fake_servers import FakeSMTPServer
+from smtp_pool import SMTPPool
+
+ADDRESSES = [f"user{index}@example.test" for index in range(9)]
+# The Persons' candidates, checked concurrently
+REQUESTS = [ADDRESSES[0:3], ADDRESSES[3:6], ADDRESSES[6:9]]
+DELIVERABLE = ADDRESSES[1::3]
+
+
+async def _rcpt_many(pool, host, recips, replies):
+    async with pool.batcher.session(host) as view:
+        replies[tuple(recips)] = [code for code, _ in await view.rcpt_many(recips)]
+
+
+def _expected(requests):
+    return {
+        tuple(recips): [250 if recip in DELIVERABLE else 550 for recip in recips]
+        for recips in requests
+    }
+
+
+def test_concurrent_rcpts_share_a_transaction(fake_domain):
+    async def run():
+        async with fake_domain("example.test", deliverable=DELIVERABLE) as (_, smtp):
+            async with SMTPPool(
+                sender="me@sender.test", port=smtp.port, coalesce_window=0.05
+            ) as pool:
+                replies = {}
+                async with trio.open_nursery() as nursery:
+                    for recips in REQUESTS:
+                        nursery.start_soon(_rcpt_many, pool, smtp.host, recips, replies)
+            assert replies == _expected(REQUESTS)
+            # Without coalescing, each request would have had its own connection
+            assert smtp.stats["connections"] == 1
+            assert smtp.stats["rcpt"] == len(ADDRESSES)
+
+    trio.run(run)
+
+
+def test_batch_past_the_recipients_limit_is_split(fake_domain):
+    async def run():
+        async with fake_domain(
+            "example.test", deliverable=DELIVERABLE, max_recipients=4
+        ) as (_, smtp):
+            async with SMTPPool(
+                sender="me@sender.test", port=smtp.port, coalesce_window=0.05
+            ) as pool:
+                replies = {}
+                async with trio.open_nursery() as nursery:
+                    for recips in REQUESTS:
+                        nursery.start_soon(_rcpt_many, pool, smtp.host, recips, replies)
+                assert pool.recipients_limit(smtp.host) == 4
+            # Each request gets its replies, not the 452s of the shared transaction
+            assert replies == _expected(REQUESTS)
+            assert smtp.stats["accepted"] == len(DELIVERABLE)
+
+    trio.run(run)
+
+
+def test_batch_of_a_cancelled_leader_is_sent_again(fake_domain):
+    async def run():
+        async with fake_domain("example.test", deliverable=DELIVERABLE, latency=0.1) as (
+            _,
+            smtp,
+        ):
+            async with SMTPPool(
+                sender="me@sender.test", port=smtp.port, coalesce_window=0.05
+            ) as pool:
+                replies = {}
+
+                async def leader():
+                    # Its budget runs out while the batch is being sent
+                    with trio.move_on_after(0.15) as scope:
+                        await _rcpt_many(pool, smtp.host, REQUESTS[0], replies)
+                    assert scope.cancelled_caught
+
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(leader)
+                    await trio.sleep(0.01)
+                    for recips in REQUESTS[1:]:
+                        nursery.start_soon(_rcpt_many, pool, smtp.host, recips, replies)
+            assert replies == _expected(REQUESTS[1:])
+
+    trio.run(run)
+
+
+async def _order_hosts(servers, **pool_kwargs):
+    """
+    Race the connections to the `servers` (serving on the same port),
+    returning the pool, the hosts' order and the seconds it took.
+    """
+    async with trio.open_nursery() as nursery:
+        await nursery.start(servers[0].run)
+        for server in servers[1:]:
+            server.port = servers[0].port
+            await nursery.start(server.run)
+        async with SMTPPool(sender="me@sender.test", port=servers[0].port, **pool_kwargs) as pool:
+            started = trio.current_time()
+            ordered = await pool.order_hosts([server.host for server in servers])
+            elapsed = trio.current_time() - started
+        nursery.cancel_scope.cancel()
+    return pool, ordered, elapsed
+
+
+def test_backup_mx_wins_the_race_of_a_slow_primary():
+    async def run():
+        slow = FakeSMTPServer(host="127.0.0.2", port=0, latency=5)
+        backup = FakeSMTPServer(host="127.0.0.3", port=0)
+        pool, ordered, elapsed = await _order_hosts([slow, backup], hedge_delay=0.1)
+        assert ordered == [backup.host, slow.host]
+        # The backup was tried after the hedge delay, without waiting for the primary
+        assert 0.1 <= elapsed < 1
+        assert pool._is_up(backup.host)
+        # Slow isn't down: its attempt was cancelled, not failed
+        assert not pool._is_down(slow.host)
+        assert slow.stats["connections"] == backup.stats["connections"] == 1
+
+    trio.run(run)
+
+
+def test_race_of_failing_mxs_keeps_their_order():
+    async def run():
+        first = FakeSMTPServer(host="127.0.0.2", port=0, max_connections=0)
+        second = FakeSMTPServer(host="127.0.0.3", port=0, max_connections=0)
+        pool, ordered, elapsed = await _order_hosts([first, second], hedge_delay=1)
+        assert ordered == [first.host, second.host]
+        # A failed attempt starts the next one right away
+        assert elapsed < 1
+        assert pool._is_down(first.host) and pool._is_down(second.host)
+        assert first.stats["refused"] == second.stats["refused"] == 1
+
+    trio.run(run)